@@ -0,0 +1,746 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2010-2013 James Raftery <james@now.ie>
+# All rights reserved.
+# $Revision$ $Date$
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the author nor the names of contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Benchmark route53d without a network.
+
+Runs route53d.py against a local stand-in for the Route 53 API and a fake
+master server, drives it with UPDATE and NOTIFY traffic, and reports
+throughput, latency and API calls per update for each engine and worker
+count.
+
+    route53d-bench.py --engines fork,async --workers 1,4 --count 1000
+
+"""
+
+import BaseHTTPServer
+import SocketServer
+import ConfigParser
+import imp
+import os
+import random
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+import xml.etree.ElementTree as ElementTree
+from optparse import OptionParser
+from xml.sax.saxutils import escape
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.opcode
+import dns.query
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+import dns.tsigkeyring
+import dns.update
+
+
+ZONE = 'bench.example.'
+ZONEID = 'ZBENCH'
+XMLNS = 'https://route53.amazonaws.com/doc/2013-04-01/'
+
+#############################################################################
+
+def sort_key(name, rdtype):
+    """Route 53 lists record sets in order of their reversed labels."""
+
+    labels = name.lower().rstrip('.').split('.')
+    labels.reverse()
+    return (labels, rdtype)
+
+
+class FakeRoute53(object):
+    """Just enough of the Route 53 API for route53d: ListResourceRecordSets,
+    ChangeResourceRecordSets and GetChange on a single hosted zone.
+
+    Every request is delayed by `latency' seconds. More than `throttle'
+    requests a second (0 for no limit) get a Throttling error, which boto
+    retries. Changes turn INSYNC `insync' seconds after they're made.
+
+    """
+
+    def __init__(self, latency=0.0, throttle=0, insync=0.0):
+        self.latency = latency
+        self.throttle = throttle
+        self.insync = insync
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.rrsets = dict()
+            self.changes = dict()
+            self.calls = dict()
+            self.throttled = 0
+            self.errors = 0
+            self.tokens = self.throttle
+            self.refilled = time.time()
+            self.set_serial(1)
+
+    def set_serial(self, serial):
+        self.rrsets[(ZONE, 'SOA')] = ('900', ['ns1.%s hostmaster.%s %d '
+                                      '3600 600 86400 300' % (ZONE, ZONE,
+                                                              serial)])
+        self.rrsets[(ZONE, 'NS')] = ('86400', ['ns1.%s' % ZONE])
+
+    def serial(self):
+        with self.lock:
+            ttl, values = self.rrsets[(ZONE, 'SOA')]
+            return int(values[0].split()[2])
+
+    def count(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+            if not self.throttle:
+                return True
+
+            now = time.time()
+            self.tokens = min(self.throttle, self.tokens +
+                                    (now - self.refilled) * self.throttle)
+            self.refilled = now
+            if self.tokens < 1:
+                self.throttled += 1
+                return False
+            self.tokens -= 1
+            return True
+
+    def list_rrsets(self, query):
+        name = query.get('name', [None])[0]
+        rdtype = query.get('type', [None])[0]
+        maxitems = int(query.get('maxitems', ['100'])[0])
+
+        with self.lock:
+            keys = sorted(self.rrsets, key=lambda k: sort_key(*k))
+            if name is not None:
+                start = sort_key(name, rdtype or '')
+                keys = [k for k in keys if sort_key(*k) >= start]
+            page, rest = keys[:maxitems], keys[maxitems:]
+
+            body = ['<ListResourceRecordSetsResponse xmlns="%s">'
+                    '<ResourceRecordSets>' % XMLNS]
+            for key in page:
+                ttl, values = self.rrsets[key]
+                body.append('<ResourceRecordSet><Name>%s</Name><Type>%s'
+                            '</Type><TTL>%s</TTL><ResourceRecords>' % \
+                                        (escape(key[0]), key[1], ttl))
+                for value in values:
+                    body.append('<ResourceRecord><Value>%s</Value>'
+                                '</ResourceRecord>' % escape(value))
+                body.append('</ResourceRecords></ResourceRecordSet>')
+            body.append('</ResourceRecordSets>')
+
+        if rest:
+            body.append('<IsTruncated>true</IsTruncated><NextRecordName>%s'
+                        '</NextRecordName><NextRecordType>%s'
+                        '</NextRecordType>' % (escape(rest[0][0]),
+                                               rest[0][1]))
+        else:
+            body.append('<IsTruncated>false</IsTruncated>')
+        body.append('<MaxItems>%d</MaxItems>'
+                    '</ListResourceRecordSetsResponse>' % maxitems)
+        return 200, ''.join(body)
+
+    def change_rrsets(self, data):
+        ns = '{%s}' % XMLNS
+        root = ElementTree.fromstring(data)
+        changes = list()
+        for change in root.iter(ns + 'Change'):
+            rrset = change.find(ns + 'ResourceRecordSet')
+            name = rrset.findtext(ns + 'Name').lower()
+            if not name.endswith('.'):
+                name += '.'
+            values = [v.text for v in rrset.iter(ns + 'Value')]
+            changes.append((change.findtext(ns + 'Action'), name,
+                            rrset.findtext(ns + 'Type'),
+                            rrset.findtext(ns + 'TTL'), values))
+
+        with self.lock:
+            # A batch is applied whole or not at all
+            rrsets = dict(self.rrsets)
+            for action, name, rdtype, ttl, values in changes:
+                current = rrsets.get((name, rdtype))
+                if action == 'DELETE':
+                    if current is None or \
+                            sorted(current[1]) != sorted(values):
+                        return self.error('InvalidChangeBatch',
+                                'Tried to delete resource record set %s %s '
+                                'but it was not found' % (name, rdtype))
+                    del rrsets[(name, rdtype)]
+                elif action == 'CREATE':
+                    if current is not None:
+                        return self.error('InvalidChangeBatch',
+                                'Tried to create resource record set %s %s '
+                                'but it already exists' % (name, rdtype))
+                    rrsets[(name, rdtype)] = (ttl, values)
+                else:
+                    return self.error('InvalidInput', 'bad action %s' % action)
+            self.rrsets = rrsets
+
+            change_id = 'C%06d' % (len(self.changes) + 1)
+            self.changes[change_id] = time.time()
+
+        return 200, '<ChangeResourceRecordSetsResponse xmlns="%s">' \
+                    '<ChangeInfo><Id>/change/%s</Id><Status>PENDING</Status>' \
+                    '<SubmittedAt>%s</SubmittedAt></ChangeInfo>' \
+                    '</ChangeResourceRecordSetsResponse>' % \
+                    (XMLNS, change_id, time.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    def get_change(self, change_id):
+        with self.lock:
+            try:
+                submitted = self.changes[change_id]
+            except KeyError:
+                return self.error('NoSuchChange', change_id, 404)
+
+        if time.time() - submitted >= self.insync:
+            status = 'INSYNC'
+        else:
+            status = 'PENDING'
+        return 200, '<GetChangeResponse xmlns="%s"><ChangeInfo><Id>/change/' \
+                    '%s</Id><Status>%s</Status><SubmittedAt>%s</SubmittedAt>' \
+                    '</ChangeInfo></GetChangeResponse>' % (XMLNS, change_id,
+                                status, time.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    def error(self, code, message, status=400):
+        with self.lock:
+            self.errors += 1
+        return status, '<ErrorResponse xmlns="%s"><Error><Type>Sender</Type>' \
+                       '<Code>%s</Code><Message>%s</Message></Error>' \
+                       '<RequestId>bench</RequestId></ErrorResponse>' % \
+                                            (XMLNS, code, escape(message))
+
+    def handle(self, method, path, data):
+        """Return (status, body) for a request."""
+
+        url = urlparse.urlparse(path)
+        parts = url.path.strip('/').split('/')
+        if len(parts) == 4 and parts[1] == 'hostedzone' and \
+                                                    parts[3] == 'rrset':
+            if method == 'POST':
+                operation = 'ChangeResourceRecordSets'
+            else:
+                operation = 'ListResourceRecordSets'
+        elif len(parts) == 3 and parts[1] == 'change':
+            operation = 'GetChange'
+        else:
+            return self.error('InvalidInput', 'unsupported %s %s' % \
+                                                        (method, path), 404)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if not self.count(operation):
+            return 400, '<ErrorResponse xmlns="%s"><Error><Type>Sender' \
+                        '</Type><Code>Throttling</Code><Message>Rate ' \
+                        'exceeded</Message></Error><RequestId>bench' \
+                        '</RequestId></ErrorResponse>' % XMLNS
+
+        if parts[2] != ZONEID and operation != 'GetChange':
+            return self.error('NoSuchHostedZone', parts[2], 404)
+
+        if operation == 'ListResourceRecordSets':
+            return self.list_rrsets(urlparse.parse_qs(url.query))
+        elif operation == 'ChangeResourceRecordSets':
+            return self.change_rrsets(data)
+        else:
+            return self.get_change(parts[2])
+
+
+class Route53Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # write each response in one segment
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def reply(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = length and self.rfile.read(length) or ''
+        status, body = self.server.api.handle(method, self.path, data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def do_GET(self):
+        self.reply('GET')
+
+    def do_POST(self):
+        self.reply('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Route53Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+#############################################################################
+
+class FakeMaster(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Master server for the benchmark zone. Each serial adds one A record
+    and IXFR serves the increments a client is missing."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        SocketServer.TCPServer.__init__(self, address, FakeMasterHandler)
+        self.serial = 1
+
+    def soa(self, serial):
+        return dns.rrset.from_text(ZONE, 900, 'IN', 'SOA',
+                                   'ns1.%s hostmaster.%s %d 3600 600 86400 '
+                                   '300' % (ZONE, ZONE, serial))
+
+    def ixfr(self, query):
+        """Return the answer section for an IXFR query."""
+
+        serial = self.serial
+        try:
+            client = query.authority[0][0].serial
+        except (IndexError, AttributeError):
+            client = serial
+
+        answer = [self.soa(serial)]
+        if client < serial:
+            for n in xrange(client, serial):
+                answer.append(self.soa(n))
+                answer.append(self.soa(n + 1))
+                answer.append(dns.rrset.from_text('h%d.%s' % (n + 1, ZONE),
+                                                  300, 'IN', 'A',
+                                                  '192.0.2.%d' % (n % 250 + 1)))
+            answer.append(self.soa(serial))
+        return answer
+
+
+class FakeMasterHandler(SocketServer.BaseRequestHandler):
+
+    def recv(self, count):
+        data = ''
+        while len(data) < count:
+            chunk = self.request.recv(count - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def handle(self):
+        while True:
+            length = self.recv(2)
+            if length is None:
+                return
+            wire = self.recv(struct.unpack('!H', length)[0])
+            if wire is None:
+                return
+
+            query = dns.message.from_wire(wire)
+            response = dns.message.make_response(query)
+            response.flags |= dns.flags.AA
+            rdtype = query.question[0].rdtype
+            if rdtype == dns.rdatatype.IXFR:
+                response.answer = self.server.ixfr(query)
+            elif rdtype == dns.rdatatype.SOA:
+                response.answer = [self.server.soa(self.server.serial)]
+            else:
+                response.set_rcode(dns.rcode.REFUSED)
+
+            wire = response.to_wire(max_size=65535)
+            self.request.sendall(struct.pack('!H', len(wire)) + wire)
+
+#############################################################################
+
+def free_port():
+    """Return a port that's free for both UDP and TCP on 127.0.0.1."""
+
+    while True:
+        port = random.randint(20000, 60000)
+        try:
+            for kind in (socket.SOCK_DGRAM, socket.SOCK_STREAM):
+                s = socket.socket(socket.AF_INET, kind)
+                s.bind(('127.0.0.1', port))
+                s.close()
+        except socket.error:
+            continue
+        return port
+
+
+class Daemon(object):
+    """A route53d.py process pointed at the fake API and master."""
+
+    def __init__(self, opt, engine, workers, api_port, master_port):
+        self.port = free_port()
+        self.ini = tempfile.NamedTemporaryFile(suffix='.ini')
+        self.log = tempfile.NamedTemporaryFile(suffix='.log')
+
+        cfg = ConfigParser.SafeConfigParser()
+        for section, option, value in (
+                ('server', 'processes', str(workers)),
+                ('server', 'listen_ip', '127.0.0.1'),
+                ('server', 'listen_port', str(self.port)),
+                ('server', 'username', opt.user),
+                ('kludge', 'delete_ttl', '300'),
+                ('hostedzone', ZONE, ZONEID),
+                ('slave', ZONE, '127.0.0.1'),
+                ('xfr', 'master_port', str(master_port)),
+                ('route53', 'host', '127.0.0.1'),
+                ('route53', 'port', str(api_port)),
+                ('route53', 'secure', '0')):
+            if not cfg.has_section(section):
+                cfg.add_section(section)
+            cfg.set(section, option, value)
+
+        for setting in opt.set:
+            try:
+                name, value = setting.split('=', 1)
+                section, option = name.split('.', 1)
+            except ValueError:
+                raise SystemExit('bad --set %s' % setting)
+            if not cfg.has_section(section):
+                cfg.add_section(section)
+            cfg.set(section, option, value)
+
+        cfg.write(self.ini)
+        self.ini.flush()
+
+        env = dict(os.environ)
+        env.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+        env.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+
+        self.proc = subprocess.Popen([sys.executable, opt.route53d,
+                                      '--config', self.ini.name,
+                                      '--engine', engine],
+                                     stdout=self.log, stderr=self.log,
+                                     env=env, preexec_fn=os.setsid)
+
+    def wait(self, timeout=15):
+        """Wait until the daemon answers a query."""
+
+        query = dns.message.make_query(ZONE, 'SOA')
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                break
+            try:
+                dns.query.udp(query, '127.0.0.1', timeout=0.5,
+                              port=self.port)
+                return
+            except dns.exception.Timeout:
+                pass
+            except socket.error:
+                time.sleep(0.2)
+
+        self.stop()
+        self.log.seek(0)
+        raise SystemExit('route53d did not start:\n%s' % self.log.read())
+
+    def stop(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGTERM)
+            time.sleep(0.5)
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.proc.wait()
+
+#############################################################################
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_updates(daemon, opt):
+    """Send opt.count UPDATEs from opt.clients threads. Return the list of
+    latencies and the number of failures."""
+
+    latencies = list()
+    failures = [0]
+    lock = threading.Lock()
+    names = iter(xrange(opt.count))
+
+    def client():
+        while True:
+            with lock:
+                try:
+                    n = names.next()
+                except StopIteration:
+                    return
+
+            update = dns.update.Update(ZONE)
+            update.add('u%d' % n, 300, 'A', '198.51.100.%d' % (n % 250 + 1))
+            start = time.time()
+            try:
+                response = dns.query.udp(update, '127.0.0.1',
+                                         timeout=opt.timeout,
+                                         port=daemon.port)
+            except dns.exception.Timeout:
+                response = None
+            elapsed = time.time() - start
+
+            with lock:
+                if response is None or response.rcode() != dns.rcode.NOERROR:
+                    failures[0] += 1
+                else:
+                    latencies.append(elapsed)
+
+    threads = [threading.Thread(target=client) for i in xrange(opt.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return latencies, failures[0]
+
+
+def run_notifies(daemon, opt, api, master):
+    """Bump the master's serial and NOTIFY opt.notifies times, waiting each
+    time for the IXFR to reach the API. Return the latencies and the number
+    of failures."""
+
+    latencies = list()
+    failures = 0
+
+    for i in xrange(opt.notifies):
+        master.serial += 1
+        notify = dns.message.make_query(ZONE, 'SOA')
+        notify.set_opcode(dns.opcode.NOTIFY)
+        notify.flags |= dns.flags.AA
+
+        start = time.time()
+        try:
+            dns.query.udp(notify, '127.0.0.1', timeout=opt.timeout,
+                          port=daemon.port)
+        except dns.exception.Timeout:
+            failures += 1
+            continue
+
+        while api.serial() != master.serial:
+            if time.time() - start > opt.timeout:
+                failures += 1
+                # don't wait on a transfer that won't come
+                master.serial = api.serial()
+                break
+            time.sleep(0.001)
+        else:
+            latencies.append(time.time() - start)
+
+    return latencies, failures
+
+
+def report(label, latencies, failures, elapsed, api, calls_before):
+    ok = len(latencies)
+    calls = dict()
+    for operation, n in api.calls.items():
+        calls[operation] = n - calls_before.get(operation, 0)
+    total = sum(calls.values())
+
+    print '%-26s %6d %5d %8.1f %8.1f %8.1f %7.2f  %s' % (label, ok, failures,
+            ok / max(elapsed, 1e-9), percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000, total / float(max(ok, 1)),
+            ' '.join(['%s=%d' % (op, n) for op, n in sorted(calls.items())]))
+
+
+def sample_updates():
+    """Return (label, wire, keyring) UPDATE messages for the parser
+    benchmark."""
+
+    keyring = dns.tsigkeyring.from_text({'bench.': 'YmVuY2hiZW5jaGJlbmNoYmVuY2g='})
+    samples = list()
+
+    update = dns.update.Update(ZONE)
+    update.add('www', 300, 'A', '192.0.2.1')
+    samples.append(('1 A', update.to_wire(), None))
+
+    update = dns.update.Update(ZONE)
+    for n in xrange(5):
+        update.add('a%d' % n, 300, 'A', '192.0.2.%d' % n)
+        update.add('b%d' % n, 300, 'AAAA', '2001:db8::%d' % n)
+        update.add('c%d' % n, 300, 'CNAME', 'www.%s' % ZONE)
+        update.add('m%d' % n, 300, 'MX', '10 mx%d.%s' % (n, ZONE))
+        update.delete('t%d' % n, 'TXT', '"text %d"' % n)
+    samples.append(('25 mixed', update.to_wire(), None))
+
+    update = dns.update.Update(ZONE)
+    for n in xrange(5):
+        update.add('s%d' % n, 300, 'SRV', '0 5 5060 sip%d.%s' % (n, ZONE))
+    samples.append(('5 SRV', update.to_wire(), None))
+
+    update = dns.update.Update(ZONE, keyring=keyring, keyname='bench.')
+    update.add('www', 300, 'A', '192.0.2.1')
+    samples.append(('1 A, TSIG', update.to_wire(), keyring))
+
+    return samples
+
+
+def describe(msg):
+    return (msg.to_text(), msg.had_tsig, msg.keyname, msg.mac,
+            [rrset.deleting for rrset in msg.authority])
+
+
+def micro(opt):
+    """Compare route53d's UPDATE parser with dnspython's."""
+
+    path = os.path.join(os.path.dirname(os.path.abspath(opt.route53d)),
+                        'route53d.py')
+    route53d = imp.load_source('route53d', path)
+
+    print '%-12s %10s %10s %8s' % ('message', 'dnspython', 'route53d',
+                                   'speedup')
+    for label, wire, keyring in sample_updates():
+        if describe(route53d.message_from_wire(wire, keyring)) != \
+                describe(dns.message.from_wire(wire, keyring=keyring)):
+            raise SystemExit('%s: the parsers disagree' % label)
+
+        times = list()
+        for parse in (lambda: dns.message.from_wire(wire, keyring=keyring),
+                      lambda: route53d.message_from_wire(wire, keyring)):
+            start = time.time()
+            for i in xrange(opt.micro):
+                parse()
+            times.append((time.time() - start) / opt.micro * 1e6)
+
+        print '%-12s %8.1fus %8.1fus %7.2fx' % (label, times[0], times[1],
+                                               times[0] / times[1])
+
+    return 0
+
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--route53d', default=os.path.join(
+                      os.path.dirname(os.path.abspath(__file__)),
+                      'route53d.py'), help='path to route53d.py')
+    parser.add_option('--engines', default='fork',
+                      help='comma-separated engines to run. default: fork')
+    parser.add_option('--workers', default='1,4',
+                      help='comma-separated worker counts for the fork '
+                           'engine. default: 1,4')
+    parser.add_option('--count', type='int', default=500,
+                      help='UPDATE messages per run. default: 500')
+    parser.add_option('--clients', type='int', default=16,
+                      help='concurrent UPDATE clients. default: 16')
+    parser.add_option('--notifies', type='int', default=20,
+                      help='NOTIFY/IXFR rounds per run. default: 20')
+    parser.add_option('--timeout', type='float', default=10.0,
+                      help='seconds to wait for a reply. default: 10')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='seconds the fake API takes per request')
+    parser.add_option('--throttle', type='int', default=0,
+                      help='fake API requests per second before Throttling '
+                           'errors. default: no limit')
+    parser.add_option('--insync', type='float', default=0.0,
+                      help='seconds until a change is INSYNC. default: 0')
+    parser.add_option('--set', action='append', default=[],
+                      help='extra route53d setting, section.option=value. '
+                           'May be repeated.')
+    parser.add_option('--user', default='nobody',
+                      help='user route53d runs as when started as root')
+    parser.add_option('--micro', type='int', default=0,
+                      help='instead, time this many parses of sample UPDATE '
+                           'messages with dnspython and with route53d')
+    opt, args = parser.parse_args()
+
+    if opt.micro:
+        return micro(opt)
+
+    api = FakeRoute53(opt.latency, opt.throttle, opt.insync)
+    api_server = Route53Server(('127.0.0.1', 0), Route53Handler)
+    api_server.api = api
+    master = FakeMaster(('127.0.0.1', 0))
+    for server in (api_server, master):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    runs = list()
+    for engine in opt.engines.split(','):
+        if engine == 'async':
+            runs.append((engine, 1))
+        else:
+            runs.extend([(engine, int(n)) for n in opt.workers.split(',')])
+
+    print '%-26s %6s %5s %8s %8s %8s %7s  %s' % ('run', 'ok', 'fail',
+                        'per sec', 'p50 ms', 'p99 ms', 'api/op', 'api calls')
+
+    for engine, workers in runs:
+        api.reset()
+        master.serial = 1
+        daemon = Daemon(opt, engine, workers, api_server.server_address[1],
+                        master.server_address[1])
+        try:
+            daemon.wait()
+
+            if opt.count:
+                before = dict(api.calls)
+                start = time.time()
+                latencies, failures = run_updates(daemon, opt)
+                report('UPDATE %s/%d' % (engine, workers), latencies,
+                       failures, time.time() - start, api, before)
+
+            if opt.notifies:
+                before = dict(api.calls)
+                start = time.time()
+                latencies, failures = run_notifies(daemon, opt, api, master)
+                report('NOTIFY+IXFR %s/%d' % (engine, workers), latencies,
+                       failures, time.time() - start, api, before)
+        finally:
+            daemon.stop()
+
+        if api.throttled or api.errors:
+            print '%-26s throttled=%d errors=%d' % ('', api.throttled,
+                                                    api.errors)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+#
+# EOF
+#
@@ -37,24 +37,1555 @@ import sys
 import os
 import pwd
 import SocketServer
+import BaseHTTPServer
 import ConfigParser
 import binascii
 import struct
 import time
+import re
+import threading
+import errno
+import ctypes
+import ctypes.util
+import heapq
+import json
+import random
+import mmap
+import hashlib
+import tempfile
 from optparse import OptionParser
-from multiprocessing import Process, Queue
+import multiprocessing
+from multiprocessing import Process, Queue, Array
+from multiprocessing.pool import ThreadPool
 from Queue import Empty, Full
+from collections import OrderedDict
+from contextlib import contextmanager
+from cStringIO import StringIO
 from types import *
+import dns.flags
+import dns.inet
 import dns.message
 import dns.query
 import dns.rdatatype
 import dns.tsigkeyring
+import dns.ipv4
+import dns.wiredata
+import dns.ipv6
+import dns.rdtypes.IN.A
+import dns.rdtypes.IN.AAAA
+import dns.rdtypes.ANY.CNAME
+import dns.rdtypes.ANY.MX
+import dns.rdtypes.ANY.NS
+import dns.rdtypes.ANY.PTR
+import dns.rdtypes.ANY.TXT
 import boto.route53
 import boto.route53.record
 import boto.route53.exception
 
 #############################################################################
 
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+INSYNC_BUCKETS = (5, 10, 20, 30, 45, 60, 90, 120, 300, 600)
+
+class Metrics(object):
+    """Counters, gauges and histograms for one process.
+
+    Values are keyed by (name, labels), where labels is a tuple of
+    (label, value) pairs. snapshot() returns the cumulative values so the
+    parent can add up the latest snapshot of every process. Values
+    inherited across fork() are discarded.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = dict()
+        self._after_fork()
+
+    def _after_fork(self):
+        self.pid = os.getpid()
+        self.values = dict()
+        self.histograms = dict()
+
+    def _check_fork(self):
+        if self.pid != os.getpid():
+            self._after_fork()
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self._check_fork()
+            self.types[name] = 'counter'
+            self.values[(name, labels)] = \
+                                self.values.get((name, labels), 0) + value
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self._check_fork()
+            self.types[name] = 'gauge'
+            self.values[(name, labels)] = value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        with self.lock:
+            self._check_fork()
+            self.types[name] = 'histogram'
+            try:
+                bounds, counts, total, count = \
+                                        self.histograms[(name, labels)]
+            except KeyError:
+                bounds, counts, total, count = buckets, [0] * len(buckets), \
+                                               0.0, 0
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.histograms[(name, labels)] = (bounds, counts,
+                                               total + value, count + 1)
+
+    def snapshot(self):
+        with self.lock:
+            self._check_fork()
+            return (dict(self.types), dict(self.values),
+                    dict([(k, (b, list(c), t, n)) for k, (b, c, t, n)
+                                            in self.histograms.items()]))
+
+
+metrics = Metrics()
+
+def count_packet(name, wire):
+    """Count a DNS message by the opcode and rcode in its header."""
+
+    if len(wire) < 4:
+        return
+    opcode = (ord(wire[2]) >> 3) & 0xf
+    rcode = ord(wire[3]) & 0xf
+    metrics.inc(name, (('opcode', dns.opcode.to_text(opcode)),
+                       ('rcode', dns.rcode.to_text(rcode))))
+
+
+class MetricsCollector(object):
+    """Keep the latest snapshot from each process and render the sum of
+    them, and of this process, in the Prometheus text format."""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.lock = threading.Lock()
+        self.snapshots = dict()
+
+    def run(self):
+        while True:
+            try:
+                pid, snapshot = self.queue.get()
+            except (IOError, OSError), e:
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+            with self.lock:
+                self.snapshots[pid] = snapshot
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def render(self):
+        with self.lock:
+            snapshots = self.snapshots.values()
+        snapshots.append(metrics.snapshot())
+
+        types = dict()
+        values = dict()
+        histograms = dict()
+        for t, v, h in snapshots:
+            types.update(t)
+            for key, value in v.items():
+                values[key] = values.get(key, 0) + value
+            for key, (bounds, counts, total, count) in h.items():
+                try:
+                    _, c, t, n = histograms[key]
+                except KeyError:
+                    c, t, n = [0] * len(bounds), 0.0, 0
+                histograms[key] = (bounds, [a + b for a, b in zip(c, counts)],
+                                   t + total, n + count)
+
+        lines = list()
+        for name in sorted(types):
+            lines.append('# TYPE %s %s' % (name, types[name]))
+            for key in sorted(values):
+                if key[0] == name:
+                    lines.append('%s%s %s' % (name, format_labels(key[1]),
+                                              values[key]))
+            for key in sorted(histograms):
+                if key[0] != name:
+                    continue
+                bounds, counts, total, count = histograms[key]
+                cumulative = 0
+                for bound, n in zip(bounds, counts):
+                    cumulative += n
+                    lines.append('%s_bucket%s %d' % (name,
+                            format_labels(key[1] + (('le', str(bound)),)),
+                            cumulative))
+                lines.append('%s_bucket%s %d' % (name,
+                            format_labels(key[1] + (('le', '+Inf'),)), count))
+                lines.append('%s_sum%s %f' % (name, format_labels(key[1]),
+                                              total))
+                lines.append('%s_count%s %d' % (name, format_labels(key[1]),
+                                                count))
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                                    .replace('"', '\\"'))
+                              for k, v in labels])
+
+
+class MetricsHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve GET /metrics."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.collector.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('metrics: %s - %s', self.client_address[0],
+                      format % args)
+
+
+class Spans(object):
+    """Timers around the hot paths, recorded in the route53d_span_seconds
+    histogram. Disabled, a timed section costs one attribute lookup:
+
+        start = spans.enabled and time.time()
+        ...
+        if start:
+            spans.record('name', start)
+
+    """
+
+    def __init__(self):
+        self.enabled = False
+
+    def record(self, name, start):
+        metrics.observe('route53d_span_seconds', time.time() - start,
+                        (('span', name),))
+
+
+spans = Spans()
+
+
+class SamplingProfiler(threading.Thread):
+    """Sample the stack of every thread in the process every `interval'
+    seconds for `seconds' seconds, then write the samples to `directory' as
+    folded stacks, one `thread;outer;...;inner count' line per stack, for
+    flamegraph.pl and the like.
+
+    A profiler hooked into the interpreter only sees the thread that turns
+    it on, which misses the handler threads of the async and TCP engines.
+
+    """
+
+    def __init__(self, seconds, interval, directory):
+        threading.Thread.__init__(self, name='profiler')
+        self.daemon = True
+        self.seconds = seconds
+        self.interval = interval
+        self.directory = directory
+
+    def run(self):
+        logging.info('profiling for %ds' % self.seconds)
+        me = threading.current_thread().ident
+        samples = dict()
+        end = time.time() + self.seconds
+        while time.time() < end:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = list()
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name,
+                                        os.path.basename(code.co_filename),
+                                        code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-%d' % ident))
+                key = ';'.join(reversed(stack))
+                samples[key] = samples.get(key, 0) + 1
+            time.sleep(self.interval)
+
+        path = os.path.join(self.directory, 'route53d-%d-%s.stacks' % \
+                            (os.getpid(), time.strftime('%Y%m%d%H%M%S')))
+        try:
+            f = open(path, 'w')
+            try:
+                for key, count in sorted(samples.items()):
+                    f.write('%s %d\n' % (key, count))
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            logging.error('cannot write profile: %s' % e)
+        else:
+            logging.info('wrote profile to %s' % path)
+
+
+def profile_settings():
+    """Return the [profile] seconds, interval and directory settings."""
+
+    settings = list()
+    for option, default in (('seconds', 30),
+                            ('interval', 0.01),
+                            ('directory', '/tmp')):
+        try:
+            settings.append(type(default)(config.get('profile', option)))
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            settings.append(default)
+    return settings
+
+def setup_spans():
+    """Turn the span timers on or off from [profile] spans."""
+
+    try:
+        spans.enabled = config.getboolean('profile', 'spans')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        spans.enabled = False
+
+
+# Workers send snapshots to the parent on this queue
+metrics_queue = None
+
+def bind_metrics_server():
+    """Bind the metrics HTTP server if [metrics] port is set. Return it or
+    None."""
+
+    try:
+        port = config.getint('metrics', 'port')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return None
+
+    try:
+        ip = config.get('metrics', 'listen_ip')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        ip = '127.0.0.1'
+
+    try:
+        server = BaseHTTPServer.HTTPServer((ip, port), MetricsHTTPHandler)
+    except socket.error, e:
+        logging.error('cannot bind metrics server to %s:%d: %s' % (ip, port,
+                                                                   e))
+        return None
+
+    logging.info('serving metrics on http://%s:%d/metrics' % (ip, port))
+    return server
+
+
+def start_metrics_server(server):
+    """Collect the worker snapshots and serve the metrics from a thread."""
+
+    collector = MetricsCollector(metrics_queue)
+    collector.start()
+    server.collector = collector
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def start_metrics_reporter():
+    """Send this process's metrics to the parent every [metrics] interval
+    seconds."""
+
+    if metrics_queue is None:
+        return
+
+    try:
+        interval = config.getfloat('metrics', 'interval')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        interval = 5.0
+
+    def report():
+        pid = os.getpid()
+        while True:
+            time.sleep(interval)
+            try:
+                metrics_queue.put_nowait((pid, metrics.snapshot()))
+            except Full:
+                pass
+
+    thread = threading.Thread(target=report)
+    thread.daemon = True
+    thread.start()
+
+#############################################################################
+
+class CountingRoute53Connection(boto.route53.Route53Connection):
+    """Route53Connection that counts new and reused HTTP connections.
+
+    Boto keeps finished HTTP connections alive in a pool on each connection
+    object and only opens a new one when none is ready.
+
+    """
+
+    def __init__(self, stats, is_secure=True, *args, **kwargs):
+        self.stats = stats
+        self.kind = 'read'
+        boto.route53.Route53Connection.__init__(self, *args, **kwargs)
+        try:
+            self.num_retries = config.getint('route53', 'retries')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            self.num_retries = 10
+        if not is_secure:
+            # Route53Connection always asks for https
+            self.is_secure = False
+            self.protocol = 'http'
+            if 'port' not in kwargs:
+                self.port = 80
+
+    def get_http_connection(self, host, port, is_secure):
+        self.stats['requests'] += 1
+        return boto.route53.Route53Connection.get_http_connection(self, host,
+                                                          port, is_secure)
+
+    def new_http_connection(self, host, port, is_secure):
+        self.stats['new'] += 1
+        return boto.route53.Route53Connection.new_http_connection(self, host,
+                                                          port, is_secure)
+
+    def make_request(self, action, path, headers=None, data='', params=None):
+        operation = api_operation(action, path)
+        self.kind = API_CALL_KINDS.get(operation, 'read')
+        if rate_limiter is not None:
+            waited = rate_limiter.acquire(self.kind)
+            metrics.observe('route53d_ratelimit_wait_seconds', waited,
+                            (('kind', self.kind),))
+
+        status = 'error'
+        start = time.time()
+        try:
+            response = boto.route53.Route53Connection.make_request(self,
+                                    action, path, headers, data, params)
+            status = str(response.status)
+            return response
+        finally:
+            if spans.enabled:
+                spans.record('api', start)
+            labels = (('operation', operation),)
+            metrics.observe('route53d_api_seconds', time.time() - start,
+                            labels)
+            metrics.inc('route53d_api_calls_total',
+                        labels + (('status', status),))
+
+    def _retry_handler(self, response, i, next_sleep):
+        """Back off from a Throttling (or similar) error with full jitter,
+        drain the shared rate limit so other processes back off too and
+        wait for a new token before boto retries."""
+
+        status = boto.route53.Route53Connection._retry_handler(self,
+                                                    response, i, next_sleep)
+        if status is None:
+            return None
+
+        msg, i, next_sleep = status
+        try:
+            backoff = config.getfloat('route53', 'backoff')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            backoff = 0.1
+        try:
+            max_backoff = config.getfloat('route53', 'max_backoff')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            max_backoff = 10.0
+
+        delay = random.uniform(0, min(max_backoff, backoff * 2 ** i))
+        logging.info('%s, retrying in %.2fs', msg, delay)
+        metrics.inc('route53d_api_retries_total', (('kind', self.kind),))
+        if rate_limiter is not None:
+            rate_limiter.throttled()
+        time.sleep(delay)
+        if rate_limiter is not None:
+            rate_limiter.acquire(self.kind)
+        return msg, i, 0
+
+
+# The rate limit budget each API operation is charged to
+API_CALL_KINDS = {
+    'ChangeResourceRecordSets': 'write',
+    'GetChange': 'poll',
+}
+
+
+def api_operation(action, path):
+    """Name the Route 53 API operation for a request."""
+
+    if '/rrset' in path:
+        if action == 'POST':
+            return 'ChangeResourceRecordSets'
+        return 'ListResourceRecordSets'
+    if '/change/' in path:
+        return 'GetChange'
+    if '/hostedzone' in path:
+        return action == 'GET' and 'GetHostedZone' or 'HostedZone' + action
+    return action
+
+
+class Route53ConnectionPool(object):
+    """Long-lived Route 53 API connections shared by everything in a process.
+
+    Connections idle for longer than `idle_timeout' seconds are replaced
+    rather than reused. A pool inherited across fork() is emptied so that
+    processes never share a socket. Any keyword arguments are passed on to
+    the connections, e.g. to point them at another endpoint.
+
+    """
+
+    def __init__(self, idle_timeout, **kwargs):
+        self.idle_timeout = idle_timeout
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self._after_fork()
+
+    def _after_fork(self):
+        self.pid = os.getpid()
+        self.idle = list()
+        self.stats = dict(requests=0, new=0, connections=0, recycled=0)
+
+    def get(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._after_fork()
+
+            while self.idle:
+                last_used, cnxn = self.idle.pop()
+                if time.time() - last_used <= self.idle_timeout:
+                    return cnxn
+                self.stats['recycled'] += 1
+
+            self.stats['connections'] += 1
+
+        return CountingRoute53Connection(self.stats, **self.kwargs)
+
+    def put(self, cnxn):
+        with self.lock:
+            if self.pid == os.getpid():
+                self.idle.append((time.time(), cnxn))
+
+    @contextmanager
+    def connection(self):
+        """Check a connection out of the pool for the duration of a with
+        block. A connection that raised an exception is discarded."""
+
+        cnxn = self.get()
+        yield cnxn
+        self.put(cnxn)
+
+    def __str__(self):
+        return 'Route53ConnectionPool requests: %d new http: %d ' \
+               'reused http: %d connections: %d recycled: %d' % \
+                (self.stats['requests'], self.stats['new'],
+                 self.stats['requests'] - self.stats['new'],
+                 self.stats['connections'], self.stats['recycled'])
+
+
+api_pool = None
+
+def api_endpoint():
+    """Return the connection arguments for the Route 53 endpoint set in the
+    [route53] section, if any."""
+
+    kwargs = dict()
+
+    try:
+        kwargs['host'] = config.get('route53', 'host')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+
+    try:
+        kwargs['port'] = config.getint('route53', 'port')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+
+    try:
+        kwargs['is_secure'] = config.getboolean('route53', 'secure')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+
+    return kwargs
+
+
+class RateLimiter(object):
+    """Token buckets for the API shared by every process.
+
+    Each call takes a token from the account-wide bucket and one from the
+    bucket for its kind: `read', `write' or `poll' (GetChange). A bucket
+    holds up to `burst' tokens and refills at `rate' per second; a rate of
+    0 means no limit. Polls give way to writes that are waiting, for up
+    to poll_yield seconds, so status polling never holds up an update.
+
+    The buckets live in shared memory allocated before the workers are
+    forked, guarded by a lock.
+
+    """
+
+    BUCKETS = ('account', 'read', 'write', 'poll')
+    _fields = 4     # tokens, last refill, rate, burst
+
+    def __init__(self, settings, poll_yield=5.0):
+        # the first slot counts the writes waiting for a token
+        self.shared = Array('d', 1 + self._fields * len(self.BUCKETS),
+                            lock=False)
+        self.lock = multiprocessing.Lock()
+        self.poll_yield = poll_yield
+        self.configure(settings)
+        for i, bucket in enumerate(self.BUCKETS):
+            base = 1 + self._fields * i
+            self.shared[base] = self.shared[base + 3]
+            self.shared[base + 1] = time.time()
+
+    def configure(self, settings):
+        """Set the (rate, burst) of each bucket from a dict. Called at
+        startup and from the reloader thread, never from a signal handler,
+        so it takes the lock like the other updates."""
+
+        with self.lock:
+            for i, bucket in enumerate(self.BUCKETS):
+                rate, burst = settings[bucket]
+                base = 1 + self._fields * i
+                self.shared[base + 2] = rate
+                self.shared[base + 3] = max(1, burst)
+
+    def acquire(self, kind):
+        """Wait for a token for a call of this kind. Return the seconds
+        waited."""
+
+        start = time.time()
+        if kind == 'write':
+            with self.lock:
+                self.shared[0] += 1
+        try:
+            while True:
+                with self.lock:
+                    wait = self._take(kind, time.time() - start)
+                if not wait:
+                    return time.time() - start
+                # spread the waiters out so they don't all wake at once
+                time.sleep(wait * (1 + random.random() * 0.2))
+        finally:
+            if kind == 'write':
+                with self.lock:
+                    self.shared[0] -= 1
+
+    def _take(self, kind, waited):
+        """Take a token from each bucket the call is charged to and return
+        0, or return how long to wait for them. Called with the lock held."""
+
+        if kind == 'poll' and self.shared[0] > 0 and waited < self.poll_yield:
+            return 0.05
+
+        now = time.time()
+        bases = list()
+        wait = 0
+        for i in (0, self.BUCKETS.index(kind)):
+            base = 1 + self._fields * i
+            tokens, refilled, rate, burst = self.shared[base:base + 4]
+            if rate <= 0:
+                continue
+            tokens = min(burst, tokens + (now - refilled) * rate)
+            self.shared[base] = tokens
+            self.shared[base + 1] = now
+            bases.append(base)
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) / rate)
+
+        if wait:
+            return wait
+        for base in bases:
+            self.shared[base] -= 1
+        return 0
+
+    def throttled(self):
+        """Empty the account-wide bucket after the API throttled a call."""
+
+        with self.lock:
+            self.shared[1] = min(self.shared[1], 0)
+            self.shared[2] = time.time()
+
+
+rate_limiter = None
+
+def rate_settings():
+    """Return the (rate, burst) of each rate limit bucket from [route53],
+    or None if no account-wide rate is set."""
+
+    try:
+        rate = config.getfloat('route53', 'rate')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return None
+
+    try:
+        burst = config.getfloat('route53', 'burst')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        burst = rate
+
+    settings = dict(account=(rate, burst))
+    for kind in ('read', 'write', 'poll'):
+        try:
+            kind_rate = config.getfloat('route53', '%s_rate' % kind)
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            kind_rate = 0
+        settings[kind] = (kind_rate, max(burst, kind_rate))
+    return settings
+
+
+def setup_rate_limiter():
+    """Create the shared rate limiter. Called before forking."""
+
+    global rate_limiter
+    settings = rate_settings()
+    if settings is None:
+        rate_limiter = None
+        return
+
+    try:
+        poll_yield = config.getfloat('route53', 'poll_yield')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        poll_yield = 5.0
+
+    rate_limiter = RateLimiter(settings, poll_yield)
+
+
+def route53_connection():
+    """Return a context manager holding a pooled Route 53 connection."""
+
+    global api_pool
+    if api_pool is None:
+        try:
+            idle_timeout = config.getint('server', 'api_idle_timeout')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            idle_timeout = 50
+        api_pool = Route53ConnectionPool(idle_timeout, **api_endpoint())
+
+    return api_pool.connection()
+
+#############################################################################
+
+class ZoneIndex(object):
+    """Map DNS names to the zones listed in a config section.
+
+    The zones are keyed by dns.name.Name so a lookup needs no string
+    formatting, and either form of a zone name (with or without the final
+    dot) in the config matches.
+
+    """
+
+    def __init__(self, section):
+        self.zones = dict()
+        try:
+            items = config.items(section)
+        except ConfigParser.NoSectionError:
+            return
+
+        for zonename, value in items:
+            self.zones[dns.name.from_text(zonename)] = value
+
+    def find(self, name):
+        """Return (zone name, value) for the closest enclosing zone of name.
+        Raise KeyError if name isn't in any zone."""
+
+        while True:
+            try:
+                return name, self.zones[name]
+            except KeyError:
+                if name == dns.name.root:
+                    raise
+            name = name.parent()
+
+
+# Built from the config on first use; replaced, never modified, on change
+_hosted_zones = None
+_master_servers = None
+
+def hosted_zones():
+    """Return the ZoneIndex of hosted zone IDs."""
+    if _hosted_zones is None:
+        build_zone_indexes()
+    return _hosted_zones
+
+def master_servers():
+    """Return the ZoneIndex of master server IPs for slaved zones."""
+    if _master_servers is None:
+        build_zone_indexes()
+    return _master_servers
+
+def build_zone_indexes():
+    global _hosted_zones, _master_servers
+    _hosted_zones = ZoneIndex('hostedzone')
+    _master_servers = ZoneIndex('slave')
+    logging.debug('%d hosted zones, %d slaved zones' % \
+                    (len(_hosted_zones.zones), len(_master_servers.zones)))
+
+#############################################################################
+
+class RRsetCache(object):
+    """Size-bounded LRU cache of the RRsets in one hosted zone.
+
+    Entries are keyed by (name, rdtype) and expire `ttl' seconds after they
+    were stored. A cached None records that the API has no such RRset.
+
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        # OrderedDict isn't safe for concurrent updates
+        self.lock = threading.Lock()
+
+    def get(self, name, rdtype):
+        """Return a (found, rrset) tuple. The rrset is a private copy."""
+
+        with self.lock:
+            try:
+                expires, rrset = self.entries.pop((name, rdtype))
+            except KeyError:
+                self.misses += 1
+                return False, None
+
+            if expires < time.time():
+                self.misses += 1
+                return False, None
+
+            # re-insert as the most recently used entry
+            self.entries[(name, rdtype)] = (expires, rrset)
+            self.hits += 1
+
+        if rrset is None:
+            return True, None
+        return True, rrset.copy()
+
+    def put(self, name, rdtype, rrset):
+        if self.size <= 0:
+            return
+
+        if rrset is not None:
+            rrset = rrset.copy()
+
+        with self.lock:
+            self.entries.pop((name, rdtype), None)
+            self.entries[(name, rdtype)] = (time.time() + self.ttl, rrset)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, name, rdtype):
+        with self.lock:
+            self.entries.pop((name, rdtype), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __str__(self):
+        return 'RRsetCache entries: %d hits: %d misses: %d evictions: %d' % \
+                    (len(self.entries), self.hits, self.misses, self.evictions)
+
+
+# One cache per hosted zone ID, per process
+rrset_caches = dict()
+
+def cache_settings():
+    """Return the configured (size, ttl) of the RRset caches."""
+
+    try:
+        size = config.getint('cache', 'size')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        size = 10000
+
+    try:
+        ttl = config.getint('cache', 'ttl')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        ttl = 60
+
+    return size, ttl
+
+def get_rrset_cache(zoneid):
+    """Return the RRsetCache for zoneid, creating it on first use."""
+
+    try:
+        return rrset_caches[zoneid]
+    except KeyError:
+        pass
+
+    size, ttl = cache_settings()
+    rrset_caches[zoneid] = RRsetCache(size, ttl)
+    return rrset_caches[zoneid]
+
+
+class ChangeFeed(object):
+    """Tell the other processes which RRsets this one has changed, so their
+    caches don't go on handing out the old values.
+
+    Records are written to a ring buffer in shared memory allocated before
+    the workers are forked, guarded by a lock. Each process reads the
+    records written since it last looked and skips its own. One that falls
+    more than the ring's size behind has missed records; read() returns
+    None and everything it has cached is suspect.
+
+    """
+
+    _length = struct.Struct('!I')
+
+    def __init__(self, size):
+        self.size = size
+        self.ring = Array('c', size, lock=False)
+        # total bytes ever written; the ring holds the last `size' of them
+        self.head = Array('L', 1, lock=False)
+        self.lock = multiprocessing.Lock()
+        self.position = 0
+
+    def publish(self, zoneid, name, rdtype, rrset, known=True):
+        """Record the state of an RRset after a change: rrset, or None if
+        it's gone. With known False the state is uncertain."""
+
+        record = {'p': os.getpid(), 'z': zoneid, 'n': name.to_text(),
+                  't': rdtype}
+        if known and rrset is not None:
+            record['l'] = rrset.ttl
+            record['r'] = [rdata.to_text() for rdata in rrset]
+        elif not known:
+            record['u'] = 1
+        data = json.dumps(record, separators=(',', ':'))
+        if len(data) > self.size / 4:
+            del record['l'], record['r']
+            record['u'] = 1
+            data = json.dumps(record, separators=(',', ':'))
+        self._append(data)
+
+    def publish_reload(self, zoneid, loaded, complete=True):
+        """Record that this process reloaded a zone at time loaded and has
+        published its changes, or with complete False that there were too
+        many to publish."""
+
+        record = {'p': os.getpid(), 'z': zoneid}
+        if complete:
+            record['L'] = loaded
+        else:
+            record['s'] = 1
+        self._append(json.dumps(record, separators=(',', ':')))
+
+    def _append(self, data):
+        data = self._length.pack(len(data)) + data
+        with self.lock:
+            self._write(self.head[0], data)
+            self.head[0] += len(data)
+
+    def read(self):
+        """Return the other processes' records written since the last call,
+        or None if some were overwritten before this process read them."""
+
+        # the common case, nothing new, needs no lock
+        if self.head[0] == self.position:
+            return []
+
+        with self.lock:
+            head = self.head[0]
+            if head - self.position > self.size:
+                self.position = head
+                return None
+            data = self._read(self.position, head - self.position)
+            self.position = head
+
+        pid = os.getpid()
+        records = list()
+        offset = 0
+        while offset < len(data):
+            length, = self._length.unpack_from(data, offset)
+            offset += self._length.size
+            record = json.loads(data[offset:offset + length])
+            offset += length
+            if record['p'] != pid:
+                records.append(record)
+        return records
+
+    def _write(self, offset, data):
+        start = offset % self.size
+        first = data[:self.size - start]
+        self.ring[start:start + len(first)] = first
+        rest = data[len(first):]
+        if rest:
+            self.ring[:len(rest)] = rest
+
+    def _read(self, offset, length):
+        start = offset % self.size
+        data = self.ring[start:min(self.size, start + length)]
+        if len(data) < length:
+            data += self.ring[:length - len(data)]
+        return data
+
+
+change_feed = None
+
+def setup_change_feed():
+    """Create the shared change feed. Called before forking."""
+
+    global change_feed
+
+    try:
+        size = config.getint('cache', 'feed_size')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        size = 1048576
+
+    if size > 0:
+        change_feed = ChangeFeed(size)
+
+
+def publish_change(zoneid, name, rdtype, rrset, known=True):
+    """Pass a changed RRset on to the other processes."""
+
+    if change_feed is not None:
+        change_feed.publish(zoneid, name, rdtype, rrset, known)
+
+
+def follow_change_feed():
+    """Drop the RRsets other processes have changed from this process's
+    caches and apply them to its zone stores, along with their reloads."""
+
+    if change_feed is None:
+        return
+
+    records = change_feed.read()
+    if records is None:
+        logging.warn('missed changes made by other processes, '
+                     'emptying the RRset caches and reloading the zones')
+        for cache in rrset_caches.values():
+            cache.clear()
+        for store in zone_stores.values():
+            store.mark_stale()
+        refresh_wanted.set()
+        return
+
+    for record in records:
+        cache = rrset_caches.get(record['z'])
+        store = zone_stores.get(record['z'])
+        if 'L' in record:
+            # another process has reloaded the zone and published the
+            # changes, so this copy is as good as reloaded too
+            if store is not None and store.ready():
+                store.loaded = max(store.loaded, record['L'])
+            continue
+        if 's' in record:
+            if cache is not None:
+                cache.clear()
+            if store is not None:
+                store.mark_stale()
+                refresh_wanted.set()
+            continue
+
+        name = dns.name.from_text(str(record['n']))
+        rdtype = record['t']
+        if cache is not None:
+            cache.invalidate(name, rdtype)
+
+        if store is None:
+            continue
+        if record.get('u'):
+            store.forget(name, rdtype)
+            refresh_wanted.set()
+        elif 'r' in record:
+            store.put(name, rdtype, dns.rrset.from_text_list(name,
+                            record['l'], dns.rdataclass.IN, rdtype,
+                            [str(r) for r in record['r']]))
+        else:
+            store.put(name, rdtype, None)
+
+#############################################################################
+
+class ZoneSnapshot(object):
+    """The RRsets of one hosted zone, indexed by (name, rdtype), and the
+    name and type indexes built from them."""
+
+    def __init__(self):
+        self.rrsets = dict()
+        # alias and weighted RRsets
+        self.opaque = set()
+        # RRsets at or below each name, to tell NXDOMAIN from NODATA
+        self.names = dict()
+        # RRset types at each owner name
+        self.types = dict()
+
+    def add(self, name, rdtype, rrset):
+        """Add an RRset read from the API, or None for an opaque one."""
+
+        if (name, rdtype) not in self.opaque and \
+                                    (name, rdtype) not in self.rrsets:
+            self._count(name, rdtype, 1)
+        if rrset is None:
+            self.opaque.add((name, rdtype))
+        else:
+            self.rrsets[(name, rdtype)] = rrset
+
+    def put(self, name, rdtype, rrset):
+        """Set an RRset to a copy of rrset, or delete it if None."""
+
+        if rrset is None:
+            if self.rrsets.pop((name, rdtype), None) is not None:
+                self._count(name, rdtype, -1)
+        else:
+            if (name, rdtype) not in self.rrsets:
+                self._count(name, rdtype, 1)
+            self.rrsets[(name, rdtype)] = rrset.copy()
+
+    def diff(self, old):
+        """Return the (name, rdtype, rrset) changes that turn old into this
+        snapshot, or None if an opaque RRset has come or gone."""
+
+        if self.opaque != old.opaque:
+            return None
+
+        changes = list()
+        for key, rrset in self.rrsets.iteritems():
+            was = old.rrsets.get(key)
+            if was is None or was != rrset or was.ttl != rrset.ttl:
+                changes.append(key + (rrset,))
+        for key in old.rrsets:
+            if key not in self.rrsets:
+                changes.append(key + (None,))
+        return changes
+
+    def _count(self, name, rdtype, delta):
+        """Add (delta 1) or remove (delta -1) an RRset from the indexes."""
+
+        if delta > 0:
+            self.types.setdefault(name, set()).add(rdtype)
+        else:
+            self.types.get(name, set()).discard(rdtype)
+            if not self.types.get(name, True):
+                del self.types[name]
+
+        while True:
+            count = self.names.get(name, 0) + delta
+            if count > 0:
+                self.names[name] = count
+            else:
+                self.names.pop(name, None)
+            if name == dns.name.root:
+                break
+            name = name.parent()
+
+
+class ZoneStore(object):
+    """Complete in-memory copy of one hosted zone.
+
+    Unlike RRsetCache a miss means the RRset does not exist, as far as the
+    copy knows. Alias and weighted RRsets have no DNS presentation so
+    lookups for their name and type are passed through to the API, as are
+    lookups for RRsets forgotten because a change to them failed part-way
+    or was made by another process with no record of the result. Those are
+    read again by the refresher. A store that's stale, having missed
+    changes made by other processes, passes every lookup through until it's
+    reloaded.
+
+    A load builds a new ZoneSnapshot and swaps it in whole, then applies the
+    changes put() while it was loading. Readers take the snapshot once and
+    use only that.
+
+    """
+
+    def __init__(self, zoneid):
+        assert type(zoneid) is StringType, 'zoneid is not String obj'
+        self.zoneid = zoneid
+        self.snapshot = ZoneSnapshot()
+        self.loaded = None
+        self.forgotten = set()
+        self.stale = False
+        self.stale_marks = 0
+        # changes put() during a load, applied again once it's swapped in
+        self.loading = None
+        # guards the snapshot against a put() from another thread
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Read every RRset in the zone from the API, following all pages
+        of the listing. Return the changes from the copy it replaces, as
+        for ZoneSnapshot.diff()."""
+
+        logging.info('loading hosted zone %s' % self.zoneid)
+        start = time.time()
+        with self.lock:
+            forgotten = set(self.forgotten)
+            stale_marks = self.stale_marks
+            self.loading = list()
+        snapshot = ZoneSnapshot()
+
+        try:
+            with route53_connection() as cnxn:
+                # Iterating the ResourceRecordSets object fetches the next
+                # page when the listing is truncated
+                for rr in cnxn.get_all_rrsets(self.zoneid):
+                    name = name_from_api(rr.name)
+                    rdtype = dns.rdatatype.from_text(rr.type)
+                    if rr.alias_dns_name or rr.identifier:
+                        snapshot.add(name, rdtype, None)
+                        continue
+                    snapshot.add(name, rdtype, dns.rrset.from_text_list(name,
+                                            int(rr.ttl), dns.rdataclass.IN,
+                                            rdtype, [str(v) for v in
+                                                     rr.resource_records]))
+
+            # catch up with the other processes before comparing
+            follow_change_feed()
+        except:
+            with self.lock:
+                self.loading = None
+            raise
+
+        with self.lock:
+            for name, rdtype, rrset in self.loading:
+                snapshot.put(name, rdtype, rrset)
+            self.loading = None
+            changes = snapshot.diff(self.snapshot)
+            self.snapshot = snapshot
+            # unless forgotten again or marked stale while loading
+            self.forgotten -= forgotten
+            self.stale = self.stale_marks != stale_marks
+            self.loaded = time.time()
+        logging.info('loaded hosted zone %s: %d rrsets in %.2fs' % \
+                    (self.zoneid, len(snapshot.rrsets), self.loaded - start))
+        return changes
+
+    def age(self):
+        if self.loaded is None:
+            return None
+        return time.time() - self.loaded
+
+    def ready(self):
+        """Whether the store can be used: loaded and not stale."""
+        return self.loaded is not None and not self.stale
+
+    def get(self, name, rdtype):
+        """Return a (found, rrset) tuple. The rrset is a private copy."""
+
+        snapshot = self.snapshot
+        if not self.ready() or (name, rdtype) in snapshot.opaque or \
+                                        (name, rdtype) in self.forgotten:
+            return False, None
+
+        try:
+            return True, snapshot.rrsets[(name, rdtype)].copy()
+        except KeyError:
+            return True, None
+
+    def put(self, name, rdtype, rrset):
+        with self.lock:
+            self.forgotten.discard((name, rdtype))
+            self.snapshot.put(name, rdtype, rrset)
+            if self.loading is not None:
+                self.loading.append((name, rdtype, rrset))
+
+    def forget(self, name, rdtype):
+        """Stop trusting the copy of an RRset until it's read again."""
+        with self.lock:
+            self.forgotten.add((name, rdtype))
+
+    def mark_stale(self):
+        """Stop trusting the whole copy until it's reloaded."""
+        with self.lock:
+            self.stale = True
+            self.stale_marks += 1
+
+    def refetch(self):
+        """Read the forgotten RRsets from the API."""
+
+        for name, rdtype in list(self.forgotten):
+            qtype = dns.rdatatype.to_text(rdtype)
+            with route53_connection() as cnxn:
+                result = cnxn.get_all_rrsets(self.zoneid, type=qtype,
+                                             name=name.to_text(), maxitems=1)
+            # index rather than iterate, which would fetch the next page
+            rr = len(result) and result[0]
+            if rr and name_from_api(rr.name) == name and rr.type == qtype:
+                if rr.alias_dns_name or rr.identifier:
+                    with self.lock:
+                        self.snapshot.opaque.add((name, rdtype))
+                        self.forgotten.discard((name, rdtype))
+                    continue
+                rrset = dns.rrset.from_text_list(name, int(rr.ttl),
+                                            dns.rdataclass.IN, rdtype,
+                                            [str(v) for v in
+                                             rr.resource_records])
+            else:
+                rrset = None
+            self.put(name, rdtype, rrset)
+
+    def resolve(self, zonename, qname, rdtype):
+        """Answer a query for qname/rdtype in the zone. Return (rcode,
+        authoritative, answer, authority), or None if the answer depends on
+        an alias or weighted RRset or one the store has forgotten."""
+
+        if self.forgotten and qname in set(n for n, t in self.forgotten):
+            return None
+        snapshot = self.snapshot
+
+        # Delegations between the apex and qname
+        cuts = list()
+        name = qname
+        while name != zonename:
+            cuts.append(name)
+            name = name.parent()
+        for name in reversed(cuts):
+            ns = snapshot.rrsets.get((name, dns.rdatatype.NS))
+            if ns is not None and not \
+                        (name == qname and rdtype == dns.rdatatype.DS):
+                return dns.rcode.NOERROR, False, [], [ns]
+
+        owner = qname
+        if qname not in snapshot.names:
+            # Find the closest encloser and try its wildcard
+            encloser = qname.parent()
+            while encloser not in snapshot.names and encloser != zonename:
+                encloser = encloser.parent()
+            owner = dns.name.Name(('*',) + encloser.labels)
+            if owner not in snapshot.types:
+                return dns.rcode.NXDOMAIN, True, [], \
+                                        self._negative(snapshot, zonename)
+
+        answer = list()
+        for i in xrange(8):
+            if rdtype == dns.rdatatype.ANY:
+                rdtypes = sorted(snapshot.types.get(owner, ()))
+            else:
+                rdtypes = [rdtype]
+                if rdtype != dns.rdatatype.CNAME and \
+                        dns.rdatatype.CNAME in snapshot.types.get(owner, ()):
+                    rdtypes = [dns.rdatatype.CNAME]
+
+            for t in rdtypes:
+                if (owner, t) in snapshot.opaque or \
+                                            (owner, t) in self.forgotten:
+                    return None
+                rrset = snapshot.rrsets.get((owner, t))
+                if rrset is None:
+                    continue
+                if owner != qname:
+                    # wildcard or CNAME target synthesis keeps the query name
+                    synth = dns.rrset.RRset(qname, rrset.rdclass, rrset.rdtype)
+                    synth.update(rrset)
+                    rrset = synth
+                answer.append(rrset)
+
+            if rdtypes != [dns.rdatatype.CNAME] or rdtype == dns.rdatatype.CNAME \
+                                                    or not answer:
+                break
+
+            # Follow the CNAME while it stays in the zone
+            target = answer[-1][0].target
+            if not target.is_subdomain(zonename) or \
+                                            target not in snapshot.types:
+                break
+            qname = owner = target
+
+        if answer:
+            return dns.rcode.NOERROR, True, answer, []
+        return dns.rcode.NOERROR, True, [], self._negative(snapshot, zonename)
+
+    def _negative(self, snapshot, zonename):
+        """The SOA for the authority section of a negative answer, with the
+        TTL it may be cached for."""
+
+        soa = snapshot.rrsets.get((zonename, dns.rdatatype.SOA))
+        if soa is None:
+            return []
+        soa = soa.copy()
+        soa.ttl = min(soa.ttl, soa[0].minimum)
+        return [soa]
+
+
+def name_from_api(text):
+    """Convert an API name to a dns.name.Name.
+
+    The API escapes characters with three-digit octal codes (e.g. \\052 for
+    `*') where DNS presentation format uses decimal.
+
+    """
+
+    return dns.name.from_text(re.sub(r'\\(\d{3})',
+                              lambda m: '\\%03d' % int(m.group(1), 8), text))
+
+
+# Loaded zone stores keyed by hosted zone ID, per process
+zone_stores = dict()
+
+def preload_mode():
+    try:
+        mode = config.get('preload', 'mode')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        mode = 'off'
+
+    if mode not in ('off', 'startup', 'lazy'):
+        logging.error('invalid preload mode: %s' % mode)
+        mode = 'off'
+    return mode
+
+
+def get_zone_store(zoneid):
+    """Return the ZoneStore for zoneid or None if the zone isn't preloaded.
+
+    Stores are loaded and reloaded by the refresher, never here. In lazy
+    mode a zone's store is created the first time it is used and the
+    refresher is woken to load it; until then it passes every lookup
+    through.
+
+    """
+
+    try:
+        return zone_stores[zoneid]
+    except KeyError:
+        if preload_mode() != 'lazy':
+            return None
+
+    store = zone_stores.setdefault(zoneid, ZoneStore(zoneid))
+    refresh_wanted.set()
+    return store
+
+
+def query_store(zoneid):
+    """Return the ZoneStore to answer queries for zoneid from, or None."""
+
+    return zone_stores.get(zoneid) or get_zone_store(zoneid)
+
+
+# Set to have the refresher look at the stores at once
+refresh_wanted = threading.Event()
+
+# Most RRset changes a reload publishes; past this the other processes
+# are told to reload the zone themselves
+MAX_RELOAD_CHANGES = 1000
+
+def refresh_zone_stores(max_age):
+    """Load the stores that aren't loaded or have gone stale, read the
+    RRsets they've forgotten and, if max_age is given, reload those older
+    than that.
+
+    The changes a reload finds are published so the other processes don't
+    each reload the zone too: their copies count as reloaded when they see
+    them.
+
+    """
+
+    for zoneid, store in zone_stores.items():
+        try:
+            if not store.ready():
+                store.load()
+            elif store.forgotten:
+                store.refetch()
+
+            if max_age is None or store.age() <= max_age:
+                continue
+            changes = store.load()
+            cache = get_rrset_cache(zoneid)
+            if changes is None or len(changes) > MAX_RELOAD_CHANGES:
+                cache.clear()
+                if change_feed is not None:
+                    change_feed.publish_reload(zoneid, store.loaded, False)
+                continue
+            for name, rdtype, rrset in changes:
+                cache.invalidate(name, rdtype)
+                publish_change(zoneid, name, rdtype, rrset)
+            if change_feed is not None:
+                change_feed.publish_reload(zoneid, store.loaded)
+            if changes:
+                logging.info('hosted zone %s: %d RRsets changed since the '
+                             'last load' % (zoneid, len(changes)))
+        except Exception, e:
+            logging.error('cannot load hosted zone %s: %s' % (zoneid, e))
+
+
+def start_zone_refresher():
+    """Keep this process's zone stores up to date in a thread, so that
+    queries and updates never wait on a load: follow the changes other
+    processes make, load new and stale stores and read forgotten RRsets as
+    soon as they need it, and reload the stores older than [preload]
+    max_age every [preload] refresh seconds."""
+
+    if preload_mode() == 'off':
+        return
+
+    try:
+        interval = config.getfloat('preload', 'refresh')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        interval = 30.0
+
+    def refresh():
+        # out of step with the other processes, so that one of them reloads
+        # a zone and the rest see its changes first
+        due = time.time() + random.uniform(0.5, 1.5) * interval
+        while True:
+            refresh_wanted.wait(min(1.0, interval))
+            refresh_wanted.clear()
+            follow_change_feed()
+
+            max_age = None
+            if time.time() >= due:
+                due = time.time() + random.uniform(0.5, 1.5) * interval
+                try:
+                    max_age = config.getint('preload', 'max_age')
+                except (ConfigParser.NoSectionError,
+                        ConfigParser.NoOptionError):
+                    max_age = 300
+            refresh_zone_stores(max_age)
+
+    thread = threading.Thread(target=refresh, name='refresher')
+    thread.daemon = True
+    thread.start()
+
+
+def preload_zones():
+    """Load every zone in the [hostedzone] section that isn't loaded yet.
+    At startup the parent loads them once for every child it forks, then
+    drops its own copies."""
+
+    if preload_mode() != 'startup':
+        return
+
+    for zonename, zoneid in hosted_zones().zones.iteritems():
+        if zoneid in zone_stores:
+            continue
+        store = ZoneStore(zoneid)
+        try:
+            store.load()
+        except Exception, e:
+            logging.error('cannot load %s (%s): %s' % (zonename, zoneid, e))
+        else:
+            zone_stores[zoneid] = store
+
+#############################################################################
+
+# Route 53 limits per ChangeResourceRecordSets request
+MAX_RR_ELEMENTS = 1000
+MAX_RR_CHARS = 32000
+
+class UpdateError(Exception):
+    """An UPDATE's changes can't be applied to the hosted zone. Answer it
+    with rcode."""
+
+    def __init__(self, rcode, message):
+        Exception.__init__(self, message)
+        self.rcode = rcode
+
+
 class Route53HostedZoneRequest(object):
 
     def __init__(self, zonename):
@@ -62,38 +1593,39 @@ class Route53HostedZoneRequest(object):
         self.zonename = zonename
 
         try:
-            self.zoneid = config.get('hostedzone',
-                                     self.zonename.to_text())
-        except ConfigParser.NoSectionError:
+            apex, self.zoneid = hosted_zones().find(self.zonename)
+        except KeyError:
             logging.error('no zoneid for %s' % self.zonename)
-            raise
-        except ConfigParser.NoOptionError:
-            try:
-                self.zoneid = config.get('hostedzone',
-                                         self.zonename.to_text(omit_final_dot=True))
-            except ConfigParser.NoOptionError:
-                logging.error('no zoneid for %s' % self.zonename)
-                raise
+            raise ConfigParser.NoOptionError(self.zonename.to_text(),
+                                             'hostedzone')
         else:
-            logging.debug('found %s zoneid: %s' % (self.zonename, self.zoneid))
+            logging.debug('found %s zoneid: %s' % (apex, self.zoneid))
 
         assert type(self.zoneid) is StringType, 'zoneid is not String obj'
+        self._reset()
+        # set to read every RRset from the API, bypassing the cache
+        self.fresh = False
+        follow_change_feed()
+        self.cache = get_rrset_cache(self.zoneid)
+        self.store = get_zone_store(self.zoneid)
+
+    def _reset(self):
         self.r = boto.route53.record.ResourceRecordSets(hosted_zone_id=self.zoneid)
         self.changequeue = dict()
-
-    # TODO
-    #  Max of 1000 ResourceRecord elements
-    #  Max of 32000 characters in record data
-    #
+        # the changes passed to update(), replayed by retry_update()
+        self.updates = list()
+        # running totals checked against the per-request API limits
+        self.rrcount = 0
+        self.rrchars = 0
 
     def add(self, rrset):
-        logging.debug('additions: %s' % rrset)
+        logging.debug('additions: %s', rrset)
         if dns.rdatatype.is_singleton(rrset.rdtype):
             self._enqueue_change('CREATE', rrset)
             return
 
         current_rrset = self.get_record_set(rrset.name, rrset.rdtype)
-        logging.debug('current set: %s' % current_rrset)
+        logging.debug('current set: %s', current_rrset)
         if current_rrset is None:
             self._enqueue_change('CREATE', rrset)
             return
@@ -104,74 +1636,218 @@ class Route53HostedZoneRequest(object):
             self._enqueue_change('CREATE', current_rrset)
 
     def delete(self, rrset, fix_ttl=False):
-        logging.debug('deletions: %s' % rrset)
+        logging.debug('deletions: %s', rrset)
         if dns.rdatatype.is_singleton(rrset.rdtype):
             if fix_ttl:
-                # XXX what if not found
                 current_rrset = self.get_record_set(rrset.name, rrset.rdtype)
-                logging.debug('setting TTL: %d' % current_rrset.ttl)
+                if current_rrset is None:
+                    raise UpdateError(dns.rcode.NXRRSET,
+                                      'no %s to delete' % rrset)
+                logging.debug('setting TTL: %d', current_rrset.ttl)
                 rrset.ttl = current_rrset.ttl
             self._enqueue_change('DELETE', rrset)
             return
 
-        # XXX what if not found
         current_rrset = self.get_record_set(rrset.name, rrset.rdtype)
-        logging.debug('current set: %s' % current_rrset)
+        logging.debug('current set: %s', current_rrset)
+
+        if current_rrset is None:
+            raise UpdateError(dns.rcode.NXRRSET, 'no %s to delete' % rrset)
 
         if fix_ttl:
-            logging.debug('setting TTL: %d' % current_rrset.ttl)
+            logging.debug('setting TTL: %d', current_rrset.ttl)
             rrset.ttl = current_rrset.ttl
 
-        if current_rrset is None:
-            # XXX how did this happen?!
-            self._enqueue_change('DELETE', rrset)
-            return
-
         self._enqueue_change('DELETE', current_rrset)
         current_rrset.difference_update(rrset)
         if len(current_rrset):
             self._enqueue_change('CREATE', current_rrset)
 
+    def update(self, changes):
+        """Apply a list of ('add'|'delete', rrset) changes from an UPDATE
+        message."""
+
+        self.updates.extend(changes)
+        for action, rrset in changes:
+            if action == 'add':
+                self.add(rrset)
+            else:
+                self.delete(rrset, fix_ttl=True)
+
+    def checkpoint(self):
+        """Return the state of the queued changes for rollback()."""
+
+        return (list(self.r.changes), dict(self.changequeue),
+                [(c, list(c.resource_records)) for a, c in self.r.changes],
+                list(self.updates), self.rrcount, self.rrchars)
+
+    def rollback(self, state):
+        """Drop the changes queued since checkpoint() returned state."""
+
+        changes, changequeue, values, updates, self.rrcount, self.rrchars = \
+                                                                        state
+        self.r.changes = list(changes)
+        self.updates = list(updates)
+        self.changequeue = dict(changequeue)
+        for change, resource_records in values:
+            change.resource_records = list(resource_records)
+
     def _enqueue_change(self, action, rrset):
         if action not in ('CREATE', 'DELETE'):
             raise RuntimeError()
         assert type(rrset) is dns.rrset.RRset, 'rrset is not RRset obj: %s' % type(rrset)
-        logging.debug('%s %s' % (action, rrset))
+        logging.debug('%s %s', action, rrset)
+
+        name = rrset.name.to_text().lower()
+
+        if action == 'DELETE':
+            # Deleting values this batch has yet to create cancels them
+            try:
+                create = self.changequeue[(name,rrset.rdtype,'CREATE')]
+            except KeyError:
+                pass
+            else:
+                rrset = rrset.copy()
+                for rdata in list(rrset):
+                    if rdata in create.resource_records:
+                        create.resource_records.remove(rdata)
+                        rrset.discard(rdata)
+                        self.rrcount -= 1
+                        self.rrchars -= len(str(rdata))
+                if len(create.resource_records) == 0:
+                    logging.debug('CREATE cancelled %s', name)
+                    del self.changequeue[(name,rrset.rdtype,'CREATE')]
+                    self.r.changes = [c for c in self.r.changes
+                                        if c[1] is not create]
+                if len(rrset) == 0:
+                    return
 
         try:
-            change = self.changequeue[(rrset.name.to_text().lower(),rrset.rdtype,action)]
+            change = self.changequeue[(name,rrset.rdtype,action)]
         except KeyError:
             change = self.r.add_change(action, rrset.name,
                                        dns.rdatatype.to_text(rrset.rdtype),
                                        rrset.ttl)
-            self.changequeue[(rrset.name.to_text().lower(),rrset.rdtype,action)] = change
+            self.changequeue[(name,rrset.rdtype,action)] = change
 
         for rdata in rrset:
             change.add_value(rdata)
+            self.rrcount += 1
+            self.rrchars += len(str(rdata))
+
+    def cancel_noops(self):
+        """Drop DELETE and CREATE pairs that would leave an RRset as it is,
+        e.g. after a batch adds a record and later deletes it again. Return
+        the number of pairs dropped."""
+
+        noops = list()
+        for (name, rdtype, action), delete in self.changequeue.items():
+            if action != 'DELETE':
+                continue
+            create = self.changequeue.get((name, rdtype, 'CREATE'))
+            if create is None or str(create.ttl) != str(delete.ttl):
+                continue
+            values = sorted(str(v) for v in delete.resource_records)
+            if values == sorted(str(v) for v in create.resource_records):
+                noops.append((name, rdtype, delete, create))
+
+        for name, rdtype, delete, create in noops:
+            del self.changequeue[(name, rdtype, 'DELETE')]
+            del self.changequeue[(name, rdtype, 'CREATE')]
+            for change in (delete, create):
+                self.rrcount -= len(change.resource_records)
+                self.rrchars -= sum([len(str(v))
+                                     for v in change.resource_records])
+
+        if noops:
+            dropped = set(id(c) for n, t, d, cr in noops for c in (d, cr))
+            self.r.changes = [c for c in self.r.changes
+                                if id(c[1]) not in dropped]
+        return len(noops)
+
+    def replace(self, old, new):
+        """Queue a DELETE of old and a CREATE of new without reading the
+        current RRset. Either may be None."""
+
+        if old is not None:
+            self._enqueue_change('DELETE', old)
+        if new is not None:
+            self._enqueue_change('CREATE', new)
+
+    def _queued_record_set(self, qname, rdtype):
+        """Return a (found, rrset) tuple for the state of qname/rdtype once
+        the changes queued in this batch are committed."""
+
+        name = qname.to_text().lower()
+
+        try:
+            create = self.changequeue[(name,rdtype,'CREATE')]
+        except KeyError:
+            if (name,rdtype,'DELETE') in self.changequeue:
+                return True, None
+            return False, None
+
+        rrset = dns.rrset.RRset(qname, dns.rdataclass.IN, rdtype)
+        for rdata in create.resource_records:
+            rrset.add(rdata, create.ttl)
+        return True, rrset
 
     def get_record_set(self, qname, qtype):
 
         if isinstance(qtype, int):
+            rdtype = qtype
             qtype = dns.rdatatype.to_text(qtype)
-
-        logging.debug('get %s %s %s %s' % (qname, type(qname), qtype, type(qtype)))
-        cnxn = boto.route53.Route53Connection()
-        # result is a boto.route53.record.ResourceRecordSets object
-        result = cnxn.get_all_rrsets(self.zoneid, type=qtype, name=qname, maxitems=1)
-
+        else:
+            rdtype = dns.rdatatype.from_text(qtype)
+
+        found, rrset = self._queued_record_set(qname, rdtype)
+        if found:
+            logging.debug('queued %s %s: %s', qname, qtype, rrset)
+            metrics.inc('route53d_lookups_total', (('source', 'queued'),))
+            return rrset
+
+        if self.store is not None and not self.fresh:
+            found, rrset = self.store.get(qname, rdtype)
+            if found:
+                logging.debug('stored %s %s: %s', qname, qtype, rrset)
+                metrics.inc('route53d_lookups_total', (('source', 'store'),))
+                return rrset
+
+        if not self.fresh:
+            found, rrset = self.cache.get(qname, rdtype)
+            if found:
+                logging.debug('cached %s %s: %s', qname, qtype, rrset)
+                metrics.inc('route53d_lookups_total', (('source', 'cache'),))
+                return rrset
+
+        metrics.inc('route53d_lookups_total', (('source', 'api'),))
+        rrset = self._get_record_set(qname, qtype)
+        self.cache.put(qname, rdtype, rrset)
+        return rrset
+
+    def _get_record_set(self, qname, qtype):
+        """Read qname/qtype from the API."""
+
+        logging.debug('get %s %s %s %s', qname, type(qname), qtype, type(qtype))
         rdatas = list()
-        # rrset is a boto.route53.record.Record object
-        for rrset in result:
-            logging.debug('got %s %s' % (rrset.name, rrset.type))
-            if rrset.name == qname.to_text() and rrset.type == qtype:
-                logging.debug('populating %s %s' % (rrset.name, rrset.type))
-                for rr in rrset.resource_records:
-                    rdatas.append(str(rr))
-            if result.is_truncated and (result.next_record_name != qname.to_text()
-                    or result.next.record_type != qtype):
-                break
-
-        logging.debug('%s %s rdatas: %s' % (qname, qtype, ','.join(rdatas)))
+        with route53_connection() as cnxn:
+            # result is a boto.route53.record.ResourceRecordSets object
+            result = cnxn.get_all_rrsets(self.zoneid, type=qtype, name=qname,
+                                         maxitems=1)
+
+            # rrset is a boto.route53.record.Record object
+            for rrset in result:
+                logging.debug('got %s %s', rrset.name, rrset.type)
+                if rrset.name == qname.to_text() and rrset.type == qtype:
+                    logging.debug('populating %s %s', rrset.name, rrset.type)
+                    for rr in rrset.resource_records:
+                        rdatas.append(str(rr))
+                if result.is_truncated and (result.next_record_name != qname.to_text()
+                        or result.next.record_type != qtype):
+                    break
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('%s %s rdatas: %s', qname, qtype, ','.join(rdatas))
 
         if len(rdatas) == 0:
             return None
@@ -181,7 +1857,7 @@ class Route53HostedZoneRequest(object):
 
     def submit(self, serial=None):
 
-        # XXX - use the serial/comment
+        # XXX - use the comment
 
         try:
             dryrun = config.getint('server', 'dry-run')
@@ -192,10 +1868,105 @@ class Route53HostedZoneRequest(object):
             logging.debug('Dry-run. No change submitted')
             return
 
-        result = self.r.commit()
-        logging.debug(result)
-        self.r = boto.route53.record.ResourceRecordSets(hosted_zone_id=self.zoneid)
-        self.changequeue = dict()
+        if serial is None:
+            serial = self._new_serial()
+
+        try:
+            with route53_connection() as cnxn:
+                batches = self._split()
+                for i, rrsets in enumerate(batches):
+                    rrsets.connection = cnxn
+                    result = rrsets.commit()
+                    logging.debug(result)
+                    # only the last batch completes the new serial
+                    if i == len(batches) - 1:
+                        self._queue_change(result, serial)
+                    else:
+                        self._queue_change(result)
+        except Exception:
+            # The API state of these RRsets is now uncertain
+            for action, change in self.r.changes:
+                rdtype = dns.rdatatype.from_text(change.type)
+                self.cache.invalidate(change.name, rdtype)
+                publish_change(self.zoneid, change.name, rdtype, None,
+                               known=False)
+            # and the store's copies of them until they're read again
+            if self.store is not None:
+                for action, change in self.r.changes:
+                    self.store.forget(change.name,
+                                      dns.rdatatype.from_text(change.type))
+                refresh_wanted.set()
+            raise
+
+        self._update_cache()
+        self._reset()
+        logging.debug(api_pool)
+
+    def _split(self):
+        """Return a list of ResourceRecordSets, each within the API's limits
+        on ResourceRecord elements and characters per request.
+
+        The changes to an RRset (its DELETE and CREATE) are always sent in
+        the same request.
+
+        """
+
+        if self.rrcount <= MAX_RR_ELEMENTS and self.rrchars <= MAX_RR_CHARS:
+            return [self.r]
+
+        groups = OrderedDict()
+        for action, change in self.r.changes:
+            key = (change.name, change.type)
+            groups.setdefault(key, list()).append((action, change))
+
+        # the new SOA goes in the last request, so the zone's serial only
+        # moves once all its changes are in
+        for key in [k for k in groups if k[1] == 'SOA']:
+            groups[key] = groups.pop(key)
+
+        batches = list()
+        rrsets = None
+        for key, changes in groups.iteritems():
+            count = sum([len(c.resource_records) for a, c in changes])
+            chars = sum([len(str(v)) for a, c in changes
+                                        for v in c.resource_records])
+            if count > MAX_RR_ELEMENTS or chars > MAX_RR_CHARS:
+                logging.warn('%s %s exceeds API limits: %d rrs, %d chars' % \
+                                        (key[0], key[1], count, chars))
+
+            if rrsets is None or \
+                    rrsets.rrcount + count > MAX_RR_ELEMENTS or \
+                    rrsets.rrchars + chars > MAX_RR_CHARS:
+                rrsets = boto.route53.record.ResourceRecordSets(
+                                            connection=self.r.connection,
+                                            hosted_zone_id=self.zoneid,
+                                            comment=self.r.comment)
+                rrsets.rrcount = rrsets.rrchars = 0
+                batches.append(rrsets)
+
+            for action, change in changes:
+                rrsets.add_change_record(action, change)
+            rrsets.rrcount += count
+            rrsets.rrchars += chars
+
+        logging.info('%s: split %d rrs, %d chars into %d requests' % \
+                        (self.zonename, self.rrcount, self.rrchars, len(batches)))
+        return batches
+
+    def _new_serial(self):
+        """Return the serial of the SOA this batch creates, if any."""
+
+        for action, change in self.r.changes:
+            if action == 'CREATE' and change.type == 'SOA':
+                try:
+                    return int(change.resource_records[0].split()[2])
+                except (IndexError, ValueError):
+                    return None
+        return None
+
+    def _queue_change(self, result, serial=None):
+        """Pass the change ID of a pending request to the status poller,
+        with the zone and the serial it brings the zone to for the journal."""
 
         try:
             info = result.get('ChangeResourceRecordSetsResponse').get('ChangeInfo')
@@ -206,54 +1977,342 @@ class Route53HostedZoneRequest(object):
         else:
             change_id = info.get('Id').lstrip('/change/')
             status = info.get('Status')
-            logging.info('ChangeID: %s Status: %s' % (change_id, status))
+            logging.info('ChangeID: %s Status: %s', change_id, status)
             if status == 'PENDING':
                 global q
                 try:
-                    q.put(change_id)
+                    q.put((change_id, time.time(),
+                           self.zonename.to_text(), serial))
                 except Full:
                     logging.warn('status poller queue full, '
                                  'discarding change %s' % change_id)
 
+    def submit_update(self):
+        """Submit the batch on behalf of UPDATE clients. Return the rcode
+        for their replies."""
+
+        try:
+            self.submit()
+        except AssertionError:
+            raise
+        except boto.route53.exception.DNSServerError, e:
+            if e.error_code == 'InvalidChangeBatch' and self.updates and \
+                                                            not self.fresh:
+                # most likely built from a stale copy of an RRset
+                logging.warn('UPDATE batch for %s rejected, retrying with '
+                             'RRsets read from the API: %s' % \
+                                            (self.zonename, e.error_message))
+                return self.retry_update()
+            logging.error('UPDATE API call failed: %s - %s' % \
+                                        (e.code, str(e)))
+            return dns.rcode.SERVFAIL
+        except Exception, e:
+            logging.error('UPDATE API call failed: %s' % e)
+            return dns.rcode.SERVFAIL
+        else:
+            logging.debug('UPDATE successful')
+            return dns.rcode.NOERROR
+
+    def retry_update(self):
+        """Rebuild the batch from the changes passed to update(), reading
+        every RRset from the API, and submit it once more. Return the rcode
+        for the replies."""
+
+        updates = self.updates
+        self._reset()
+        self.fresh = True
+        try:
+            self.update(updates)
+        except AssertionError:
+            raise
+        except Exception, e:
+            logging.error('UPDATE failed: %s' % e)
+            return dns.rcode.SERVFAIL
+        return self.submit_update()
+
+    def _update_cache(self):
+        """Apply the committed changes to the RRset cache and pass them on
+        to the other processes."""
+
+        done = set()
+        for action, change in self.r.changes:
+            rdtype = dns.rdatatype.from_text(change.type)
+            if (change.name, rdtype) in done:
+                continue
+            done.add((change.name, rdtype))
+            found, rrset = self._queued_record_set(change.name, rdtype)
+            self.cache.put(change.name, rdtype, rrset)
+            if self.store is not None:
+                self.store.put(change.name, rdtype, rrset)
+            publish_change(self.zoneid, change.name, rdtype, rrset)
+
+        logging.debug('%s %s', self.zonename, self.cache)
+
+#############################################################################
+
+class UpdateCoalescer(object):
+    """Merge the changes from UPDATE messages for the same hosted zone into
+    one change batch.
+
+    A batch is committed `window' seconds after its first message arrives or
+    as soon as it holds `max_changes' RRset changes. Every client waiting on
+    the batch is then answered with the shared result. A message whose
+    changes can't be applied is answered on its own and leaves the batch as
+    it was. If the batch is rejected each of its messages is submitted
+    alone, so one bad message doesn't fail the others.
+
+    """
+
+    def __init__(self, window, max_changes):
+        self.window = window
+        self.max_changes = max_changes
+        self.lock = threading.Lock()
+        self.batches = dict()
+
+    def add(self, APIRequest, changes, reply):
+        """Queue changes on the batch for APIRequest's hosted zone. reply
+        is called with the rcode once the batch is committed."""
+
+        zoneid = APIRequest.zoneid
+        while True:
+            with self.lock:
+                try:
+                    batch = self.batches[zoneid]
+                except KeyError:
+                    batch = CoalescedBatch(APIRequest)
+                    self.batches[zoneid] = batch
+                    batch.timer = threading.Timer(self.window, self.flush,
+                                                  (zoneid, batch))
+                    batch.timer.daemon = True
+                    batch.timer.start()
+
+            with batch.lock:
+                if batch.closed:
+                    # flushed while we waited for the lock; start another
+                    continue
+                state = batch.APIRequest.checkpoint()
+                try:
+                    batch.APIRequest.update(changes)
+                except UpdateError, e:
+                    batch.APIRequest.rollback(state)
+                    logging.warn('UPDATE refused: %s' % e)
+                    reply(e.rcode)
+                    return
+                except Exception, e:
+                    batch.APIRequest.rollback(state)
+                    logging.error('UPDATE failed: %s' % e)
+                    reply(dns.rcode.SERVFAIL)
+                    return
+                batch.messages.append((changes, reply))
+                batch.changes += len(changes)
+                full = batch.changes >= self.max_changes
+            break
+
+        logging.debug('coalesced %d changes for %s, %d waiting',
+                      batch.changes, zoneid, len(batch.messages))
+        if full:
+            self.flush(zoneid, batch)
+
+    def flush(self, zoneid, batch):
+        """Commit a batch and answer its clients."""
+
+        with self.lock:
+            if self.batches.get(zoneid) is batch:
+                del self.batches[zoneid]
+        batch.timer.cancel()
+
+        with batch.lock:
+            if batch.closed:
+                return
+            batch.closed = True
+
+        logging.info('UPDATE batch for %s: %d changes from %d messages' % \
+                        (zoneid, batch.changes, len(batch.messages)))
+        rcode = batch.APIRequest.submit_update()
+
+        if rcode != dns.rcode.NOERROR and len(batch.messages) > 1:
+            logging.warn('UPDATE batch for %s failed, submitting its %d '
+                         'messages one at a time' % (zoneid,
+                                                     len(batch.messages)))
+            for changes, reply in batch.messages:
+                self.answer(reply, self.submit_alone(batch.APIRequest.zonename,
+                                                     changes))
+            return
+
+        for changes, reply in batch.messages:
+            self.answer(reply, rcode)
+
+    def submit_alone(self, zonename, changes):
+        """Submit one message's changes in a batch of their own. Return the
+        rcode for its reply."""
+
+        try:
+            APIRequest = Route53HostedZoneRequest(zonename)
+            APIRequest.update(changes)
+        except UpdateError, e:
+            logging.warn('UPDATE refused: %s' % e)
+            return e.rcode
+        except AssertionError:
+            raise
+        except Exception, e:
+            logging.error('UPDATE failed: %s' % e)
+            return dns.rcode.SERVFAIL
+        return APIRequest.submit_update()
+
+    def answer(self, reply, rcode):
+        try:
+            reply(rcode)
+        except Exception, e:
+            logging.error('UPDATE reply failed: %s' % e)
+
+
+class CoalescedBatch(object):
+
+    def __init__(self, APIRequest):
+        self.APIRequest = APIRequest
+        self.lock = threading.Lock()
+        self.timer = None
+        self.closed = False
+        # (changes, reply) for each message in the batch
+        self.messages = list()
+        self.changes = 0
+
+
+coalescer = None
+
+def setup_coalescer():
+    """Create the `coalescer' global if a coalescing window is set."""
+
+    global coalescer
+
+    try:
+        window = config.getint('coalesce', 'window')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        window = 0
+
+    try:
+        max_changes = config.getint('coalesce', 'max_changes')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        max_changes = 100
+
+    if window <= 0:
+        coalescer = None
+    elif coalescer is None:
+        logging.info('coalescing updates for %dms', window)
+        coalescer = UpdateCoalescer(window / 1000.0, max_changes)
+    else:
+        coalescer.window = window / 1000.0
+        coalescer.max_changes = max_changes
+
+#############################################################################
+
+_counts = struct.Struct('!HH')
+_reply_header = struct.Struct('!HHHHH')
+
+def error_response(wire, rcode):
+    """Return the wire format of an unsigned reply with rcode to the request
+    in wire: its ID, opcode, RD flag and question, with QR set and nothing
+    else. This is what dnspython's make_response() and to_wire() produce
+    for the question-only request. Return None if the question isn't a
+    single uncompressed name."""
+
+    if len(wire) < 12:
+        return None
+
+    flags, qdcount = _counts.unpack_from(wire, 2)
+    if qdcount > 1:
+        return None
+
+    end = 12
+    if qdcount:
+        while True:
+            if end >= len(wire):
+                return None
+            count = ord(wire[end])
+            end += 1
+            if count == 0:
+                break
+            if count >= 64:
+                return None
+            end += count
+        end += 4
+        if end > len(wire):
+            return None
+
+    flags = dns.flags.QR | (flags & (0x7800 | dns.flags.RD)) | rcode
+    return wire[:2] + _reply_header.pack(flags, qdcount, 0, 0, 0) + \
+                                                            wire[12:end]
+
 #############################################################################
 
 class UDPDNSHandler(SocketServer.BaseRequestHandler):
     """Process UDP DNS messages."""
 
     def handle(self):
+        self.dispatch(self.request[0])
+
+
+    def send(self, wire):
+        """Send a wire-format message to the client."""
+        count_packet('route53d_responses_total', wire)
+        self.request[1].sendto(wire, self.client_address)
+
+
+    def dispatch(self, wire):
         """Basic sanity check then handover to the opcode-specific function."""
 
         remote_ip = self.client_address[0]
+        # for the error replies, which are patched from the request
+        self.wire = wire
 
-        kr = TSIGKeyRing(remote_ip)
+        if packet_counts is not None:
+            with packet_count_lock:
+                packet_counts[worker_id] += 1
+        count_packet('route53d_requests_total', wire)
+
+        kr = tsig_keys().lookup(remote_ip)
 
         try:
-            msg = dns.message.from_wire(self.request[0], keyring=kr.keyring)
+            start = spans.enabled and time.time()
+            msg = message_from_wire(wire, kr.keyring)
+            if start:
+                spans.record('parse', start)
         except dns.message.BadTSIG, e:
             logging.warn('TSIG error from %s: %s' % (remote_ip, e))
-            response = self.formerr(self.get_question(self.request[0]))
+            metrics.inc('route53d_tsig_failures_total', (('reason', 'badtsig'),))
+            self.send_error(wire, dns.rcode.FORMERR)
+            return
         except dns.message.UnknownTSIGKey, e:
             logging.warn('TSIG unknown key from %s: %s' % (remote_ip, e))
-            response = self.notauth(self.get_question(self.request[0]))
+            metrics.inc('route53d_tsig_failures_total', (('reason', 'unknownkey'),))
+            self.send_error(wire, dns.rcode.NOTAUTH)
+            return
         except dns.tsig.BadSignature, e:
             logging.warn('TSIG bad signature from %s: %s' % (remote_ip, e))
-            response = self.notauth(self.get_question(self.request[0]))
+            metrics.inc('route53d_tsig_failures_total', (('reason', 'badsig'),))
+            self.send_error(wire, dns.rcode.NOTAUTH)
+            return
         except dns.tsig.BadTime, e:
             logging.warn('TSIG bad time from %s: %s' % (remote_ip, e))
-            response = self.notauth(self.get_question(self.request[0]))
+            metrics.inc('route53d_tsig_failures_total', (('reason', 'badtime'),))
+            self.send_error(wire, dns.rcode.NOTAUTH)
+            return
         except Exception, e:
             logging.error('malformed message from %s: %s' % (remote_ip, e))
-            logging.debug('packet: %s' % binascii.hexlify(self.request[0]))
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug('packet: %s', binascii.hexlify(wire))
             return
         else:
             if kr.keyring and not msg.had_tsig:
                 logging.error('No TSIG from %s' % remote_ip)
-                self.request[1].sendto(self.notauth(msg).to_wire(), self.client_address)
+                metrics.inc('route53d_tsig_failures_total',
+                            (('reason', 'missing'),))
+                self.send_error(wire, dns.rcode.NOTAUTH, msg)
                 return
 
             if msg.rcode() != dns.rcode.NOERROR:
                 logging.warn('RCODE not NOERROR from %s' % remote_ip)
-                self.request[1].sendto(self.formerr(msg).to_wire(), self.client_address)
+                self.send_error(wire, dns.rcode.FORMERR, msg)
                 return
 
             if msg.opcode() == dns.opcode.QUERY:
@@ -266,14 +2325,74 @@ class UDPDNSHandler(SocketServer.BaseRequestHandler):
             else:
                 logging.warn('unsupported opcode from %s: %d' % (remote_ip,
                                                                  msg.opcode()))
-                response = self.notimp(msg)
+                self.send_error(wire, dns.rcode.NOTIMP, msg)
+                return
+
+        if response is None:
+            # an error reply was sent, or an UPDATE's reply is sent when
+            # its change batch is committed
+            return
+        self.send_response(msg, response)
+
+
+    def send_error(self, wire, rcode, msg=None):
+        """Reply to the request in wire with an rcode and no records.
+
+        Unsigned replies without EDNS are made by patching a copy of the
+        request's header and question. Otherwise, or if the question can't
+        be copied, dnspython builds the reply from msg, or from the
+        question alone if the request couldn't be parsed.
+
+        """
+
+        reply = None
+        if msg is None or (not msg.had_tsig and msg.edns < 0):
+            reply = error_response(wire, rcode)
+
+        if reply is None:
+            if msg is None:
+                try:
+                    msg = self.get_question(wire)
+                except Exception, e:
+                    logging.error('no question from %s: %s' % \
+                                            (self.client_address[0], e))
+                    return
+            response = dns.message.make_response(msg)
+            response.set_rcode(rcode)
+            reply = response.to_wire()
+
+        self.send(reply)
+
+
+    def send_response(self, msg, response):
+        """Sign the response if the request was signed and send it."""
 
         assert type(response) is dns.message.Message, \
                                     'response is not Message obj'
         if msg.had_tsig:
-            response.use_tsig(keyring=kr.keyring)
+            response.use_tsig(keyring=msg.keyring)
+
+        start = spans.enabled and time.time()
+        try:
+            wire = response.to_wire(max_size=self.max_size(msg))
+        except dns.exception.TooBig:
+            # Only queries have answers big enough; let them retry on TCP
+            response.answer = list()
+            response.authority = list()
+            response.additional = list()
+            response.flags |= dns.flags.TC
+            wire = response.to_wire()
+        if start:
+            spans.record('to_wire', start)
+
+        self.send(wire)
 
-        self.request[1].sendto(response.to_wire(), self.client_address)
+
+    def max_size(self, msg):
+        """The largest reply the client accepts over UDP."""
+        if msg.edns >= 0:
+            return max(512, msg.payload)
+        return 512
 
 
     def handle_update(self, msg):
@@ -290,9 +2409,9 @@ class UDPDNSHandler(SocketServer.BaseRequestHandler):
             logging.warn('UPDATE parse error from %s: %s' % (remote_ip, e))
             return self.servfail(msg)
         else:
-            logging.info('UPDATE from %s: %s %s %s' % (remote_ip, qname,
+            logging.info('UPDATE from %s: %s %s %s', remote_ip, qname,
                                     dns.rdataclass.to_text(qclass),
-                                    dns.rdatatype.to_text(qtype)))
+                                    dns.rdatatype.to_text(qtype))
 
         if qtype != dns.rdatatype.SOA or qclass != dns.rdataclass.IN:
             logging.warn('UPDATE invalid question from %s' % remote_ip)
@@ -316,6 +2435,8 @@ class UDPDNSHandler(SocketServer.BaseRequestHandler):
             logging.debug('nothing to do')
             return response
 
+        # Validate the whole message before touching the change batch
+        changes = list()
         for rrset in msg.authority:
             assert type(rrset) is dns.rrset.RRset, 'rrset is not RRset obj'
 
@@ -323,21 +2444,19 @@ class UDPDNSHandler(SocketServer.BaseRequestHandler):
                 logging.warn('UPDATE NOTZONE from %s: %s %s' % (remote_ip,
                                                                 qname,
                                                                 rrset.name))
-                response.set_rcode(dns.rcode.NOTZONE)
-                return response
+                return self.error(msg, dns.rcode.NOTZONE)
 
             if not rrset.deleting and rrset.rdclass == dns.rdataclass.IN:
                 # addition
-                logging.debug('UPDATE add rrset: %s' % rrset)
+                logging.debug('UPDATE add rrset: %s', rrset)
                 if rrset.rdtype in (dns.rdatatype.ANY,  dns.rdatatype.AXFR,
                                     dns.rdatatype.IXFR, dns.rdatatype.MAILA,
                                     dns.rdatatype.MAILB):
                     logging.error('UPDATE bad rdtype from %s: %s' % \
                                                     (remote_ip, rrset))
-                    response.set_rcode(dns.rcode.FORMERR)
-                    return response
+                    return self.error(msg, dns.rcode.FORMERR)
                 else:
-                    APIRequest.add(rrset)
+                    changes.append(('add', rrset))
 
             elif rrset.deleting == dns.rdataclass.ANY:
                 # name or rrset deletion
@@ -346,13 +2465,11 @@ class UDPDNSHandler(SocketServer.BaseRequestHandler):
                                       dns.rdatatype.MAILA, dns.rdatatype.MAILB):
                     logging.error('UPDATE illegal values from %s: %s' % \
                                                         (remote_ip, rrset))
-                    response.set_rcode(dns.rcode.FORMERR)
-                    return response
+                    return self.error(msg, dns.rcode.FORMERR)
 
                 logging.warn('UPDATE unsupported delete from %s: %s' % \
                                                         (remote_ip, rrset))
-                response.set_rcode(dns.rcode.REFUSED)
-                return response
+                return self.error(msg, dns.rcode.REFUSED)
 
             elif rrset.deleting == dns.rdataclass.NONE:
                 # specific rr deletion
@@ -362,8 +2479,7 @@ class UDPDNSHandler(SocketServer.BaseRequestHandler):
                                      dns.rdatatype.MAILB):
                     logging.error('UPDATE illegal values from %s: %s' % \
                                                         (remote_ip, rrset))
-                    response.set_rcode(dns.rcode.FORMERR)
-                    return response
+                    return self.error(msg, dns.rcode.FORMERR)
 
                 # XXX TTL! Have to fake it for the moment.
                 try:
@@ -372,31 +2488,39 @@ class UDPDNSHandler(SocketServer.BaseRequestHandler):
                     logging.error('no delete ttl for %s' % qname)
                     return self.servfail(msg)
                 else:
-                    logging.debug('found delete ttl: %d' % rrset.ttl)
+                    logging.debug('found delete ttl: %d', rrset.ttl)
 
-                logging.debug('UPDATE delete rr: %s' % rrset)
-                APIRequest.delete(rrset, fix_ttl=True)
+                logging.debug('UPDATE delete rr: %s', rrset)
+                changes.append(('delete', rrset))
 
             else:
                 logging.warn('UPDATE unknown rr from %s: %s' % \
                                                     (remote_ip, rrset))
-                response.set_rcode(dns.rcode.FORMERR)
-                return response
+                return self.error(msg, dns.rcode.FORMERR)
+
+        if coalescer is not None:
+            # a TCP connection's next message replaces self.wire meanwhile
+            wire = self.wire
+            def reply(rcode):
+                if rcode != dns.rcode.NOERROR:
+                    return self.error(msg, rcode, wire)
+                self.send_response(msg, response)
+            coalescer.add(APIRequest, changes, reply)
+            return None
 
         try:
-            APIRequest.submit()
+            APIRequest.update(changes)
+        except UpdateError, e:
+            logging.warn('UPDATE refused from %s: %s' % (remote_ip, e))
+            return self.error(msg, e.rcode)
         except AssertionError:
             raise
-        except boto.route53.exception.DNSServerError, e:
-            logging.error('UPDATE API call failed: %s - %s' % \
-                                        (e.code, str(e)))
-            response.set_rcode(dns.rcode.SERVFAIL)
         except Exception, e:
-            logging.error('UPDATE API call failed: %s' % e)
-            response.set_rcode(dns.rcode.SERVFAIL)
-        else:
-            logging.debug('UPDATE successful')
-
+            logging.error('UPDATE failed from %s: %s' % (remote_ip, e))
+            return self.servfail(msg)
+        rcode = APIRequest.submit_update()
+        if rcode != dns.rcode.NOERROR:
+            return self.error(msg, rcode)
         return response
 
 
@@ -424,37 +2548,22 @@ class UDPDNSHandler(SocketServer.BaseRequestHandler):
 
         if not (msg.flags & dns.flags.AA):
             # BIND 8; how quaint
-            logging.info('NOTIFY !AA from %s' % remote_ip)
+            logging.info('NOTIFY !AA from %s', remote_ip)
 
         # Asynchronous reply
         response = dns.message.make_response(msg)
         response.flags |= dns.flags.AA
-        self.request[1].sendto(response.to_wire(), self.client_address)
-
-        try:
-            xfr = XFRClient(qname)
-        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
-            # handled in XFRClient
-            return
-        except (dns.query.BadResponse, dns.query.UnexpectedSource):
-            # handled in XFRClient
-            return
-        except Exception, e:
-            logging.error('XFRClient unhandled init exception: %s' % e)
-            return
+        self.send(response.to_wire())
 
-        try:
-            xfr.parse_ixfr()
-        except Exception:
-            logging.exception('XFRClient unhandled parse exception')
+        if xfr_queue is None:
+            transfer_zone(qname)
+        else:
+            xfr_queue.put(qname.to_text())
 
 
     def handle_query(self, msg):
-        """Process a query message."""
+        """Answer a query from the zone store of the hosted zone."""
 
-        #
-        # Not ready for release yet
-        #
         assert type(msg) is dns.message.Message, 'msg is not Message obj'
         remote_ip = self.client_address[0]
 
@@ -466,11 +2575,47 @@ class UDPDNSHandler(SocketServer.BaseRequestHandler):
             logging.warn('QUERY parse error from %s: %s' % (remote_ip, e))
             return self.servfail(msg)
         else:
-            logging.info('QUERY from %s: %s %s %s' % (remote_ip, qname,
+            logging.debug('QUERY from %s: %s %s %s', remote_ip, qname,
                                     dns.rdataclass.to_text(qclass),
-                                    dns.rdatatype.to_text(qtype)))
+                                    dns.rdatatype.to_text(qtype))
 
         response = dns.message.make_response(msg)
+
+        # without zone stores, the empty answer queries have always had
+        if preload_mode() == 'off':
+            return response
+
+        try:
+            zonename, zoneid = hosted_zones().find(qname)
+        except KeyError:
+            zonename = None
+        if zonename is None or qclass != dns.rdataclass.IN:
+            return self.error(msg, dns.rcode.REFUSED)
+
+        # pick up the changes other processes have made
+        follow_change_feed()
+
+        store = query_store(zoneid)
+        if store is None:
+            logging.debug('no zone store for %s', zonename)
+            return self.error(msg, dns.rcode.REFUSED)
+        if not store.ready():
+            # the refresher is loading it
+            logging.debug('zone store for %s not ready', zonename)
+            return self.error(msg, dns.rcode.SERVFAIL)
+
+        result = store.resolve(zonename, qname, qtype)
+        if result is None:
+            logging.debug('QUERY %s %s needs an RRset the store lacks',
+                          qname, dns.rdatatype.to_text(qtype))
+            return self.error(msg, dns.rcode.SERVFAIL)
+
+        rcode, authoritative, response.answer, response.authority = result
+        if authoritative:
+            response.flags |= dns.flags.AA
+        response.set_rcode(rcode)
+        metrics.inc('route53d_queries_total',
+                    (('rcode', dns.rcode.to_text(rcode)),))
         return response
 
 
@@ -495,61 +2640,435 @@ class UDPDNSHandler(SocketServer.BaseRequestHandler):
             return n, c, t
 
 
-    def get_question(self, msg):
-        return dns.message.from_wire(msg, question_only=True)
+    def get_question(self, msg):
+        return dns.message.from_wire(msg, question_only=True)
+
+
+    def error(self, msg, rcode, wire=None):
+        """Send the reply to msg with an rcode and no records. A signed
+        request gets a signed reply from dnspython; send_error() patches
+        the rest from the request's wire, self.wire unless given. Return
+        None, for the handlers to return to dispatch() once the reply is
+        sent."""
+
+        if msg.had_tsig:
+            response = dns.message.make_response(msg)
+            response.set_rcode(rcode)
+            self.send_response(msg, response)
+        else:
+            self.send_error(wire or self.wire, rcode, msg)
+        return None
+
+    # (Quasi-) One-liners for replies with common error rcodes
+    def servfail(self, msg):
+        return self.error(msg, dns.rcode.SERVFAIL)
+
+    def notimp(self, msg):
+        return self.error(msg, dns.rcode.NOTIMP)
+
+    def formerr(self, msg):
+        return self.error(msg, dns.rcode.FORMERR)
+
+    def notauth(self, msg):
+        return self.error(msg, dns.rcode.NOTAUTH)
+
+#############################################################################
+
+class ReusePortUDPServer(SocketServer.UDPServer):
+    """UDPServer whose socket shares its address with the other workers'
+    sockets. The kernel spreads incoming datagrams across them."""
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        SocketServer.UDPServer.server_bind(self)
+
+#############################################################################
+
+class TCPDNSHandler(UDPDNSHandler):
+    """Process DNS messages on a TCP connection.
+
+    Each message is preceded by its two-byte length. The connection stays
+    open for further messages, which may be sent before the replies to
+    earlier ones arrive, until the client closes it or it has been idle for
+    the server's idle_timeout.
+
+    """
+
+    def handle(self):
+        remote_ip = self.client_address[0]
+        self.request.settimeout(self.server.idle_timeout)
+        # replies to coalesced updates are sent from other threads
+        self.send_lock = threading.Lock()
+
+        while True:
+            try:
+                length = self.recv(2)
+                if length is None:
+                    break
+                wire = self.recv(struct.unpack('!H', length)[0])
+                if wire is None:
+                    logging.warn('short message from %s' % remote_ip)
+                    break
+            except socket.timeout:
+                logging.debug('idle connection from %s' % remote_ip)
+                break
+            except socket.error, e:
+                logging.warn('socket error from %s: %s' % (remote_ip, e))
+                break
+
+            self.dispatch(wire)
+
+
+    def recv(self, count):
+        """Read exactly count bytes. Return None if the client closes the
+        connection first."""
+
+        data = ''
+        while len(data) < count:
+            chunk = self.request.recv(count - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+
+    def max_size(self, msg):
+        return 65535
+
+    def send(self, wire):
+        count_packet('route53d_responses_total', wire)
+        with self.send_lock:
+            self.request.sendall(struct.pack('!H', len(wire)) + wire)
+
+
+class TCPDNSServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Threaded TCP server that limits the number of open connections."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, RequestHandlerClass, idle_timeout,
+                 max_connections):
+        SocketServer.TCPServer.__init__(self, server_address,
+                                        RequestHandlerClass)
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def verify_request(self, request, client_address):
+        with self.lock:
+            if self.connections >= self.max_connections:
+                logging.warn('%d TCP connections open, refusing %s' % \
+                                    (self.connections, client_address[0]))
+                return False
+            self.connections += 1
+        return True
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request,
+                                                            client_address)
+        finally:
+            with self.lock:
+                self.connections -= 1
+
+#############################################################################
+
+class AsyncDNSServer(object):
+    """Serve UDP DNS messages from one process without blocking on the API.
+
+    An event loop reads datagrams from the socket of a bound
+    SocketServer.UDPServer and hands each one to a pool of threads that run
+    its RequestHandlerClass. A worker waiting on the Route 53 API no longer
+    stops the socket being read, so one process can keep many updates in
+    flight. Datagrams arriving while `max_pending' are queued are dropped;
+    the client will retry.
 
+    """
 
-    # (Quasi-) One-liners for replies with common error rcodes
-    def servfail(self, msg):
-        msg = dns.message.make_response(msg)
-        msg.set_rcode(dns.rcode.SERVFAIL)
-        return msg
+    def __init__(self, server, threads, max_pending):
+        self.server = server
+        self.threads = threads
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def serve_forever(self):
+        # Threads don't survive fork() so start them in the serving process
+        if self.pool is None:
+            logging.debug('starting %d handler threads' % self.threads)
+            self.pool = ThreadPool(self.threads)
+
+        sock = self.server.socket
+        sock.setblocking(0)
+
+        while True:
+            select.select([sock], [], [])
+            while True:
+                try:
+                    data, client_address = \
+                                    sock.recvfrom(self.server.max_packet_size)
+                except socket.error, e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
 
-    def notimp(self, msg):
-        msg = dns.message.make_response(msg)
-        msg.set_rcode(dns.rcode.NOTIMP)
-        return msg
+                with self.lock:
+                    if self.pending >= self.max_pending:
+                        logging.warn('%d messages pending, dropping message '
+                                     'from %s' % (self.pending,
+                                                  client_address[0]))
+                        continue
+                    self.pending += 1
 
-    def formerr(self, msg):
-        msg = dns.message.make_response(msg)
-        msg.set_rcode(dns.rcode.FORMERR)
-        return msg
+                self.pool.apply_async(self.handle,
+                                      ((data, sock), client_address))
 
-    def notauth(self, msg):
-        msg = dns.message.make_response(msg)
-        msg.set_rcode(dns.rcode.NOTAUTH)
-        return msg
+    def handle(self, request, client_address):
+        """Run the request handler. Called in a pool thread."""
+
+        try:
+            self.server.RequestHandlerClass(request, client_address,
+                                            self.server)
+        except Exception:
+            self.server.handle_error(request, client_address)
+        finally:
+            with self.lock:
+                self.pending -= 1
 
 #############################################################################
 
 class TSIGKeyRing(object):
 
-    def __init__(self, ip):
+    def __init__(self, ip, value=None):
         assert type(ip) is StringType, 'ip is not String obj'
         self.keyring = None
         self.keyname = None
+        self.secret = None
 
-        try:
-            self.keyname, self.secret = config.get('tsig', ip).split()
-        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
-            logging.debug('no tsig config for %s' % ip)
+        if value is None:
             return
+
+        try:
+            self.keyname, self.secret = value.split()
         except ValueError, e:
             logging.error('invalid tsig config for %s: %s' % (ip, e))
             return
         else:
             logging.debug(self)
 
-        # XXX catch exceptions
-        self.keyring = dns.tsigkeyring.from_text({self.keyname: self.secret})
+        try:
+            self.keyring = dns.tsigkeyring.from_text({self.keyname: self.secret})
+        except Exception, e:
+            logging.error('invalid tsig secret for %s: %s' % (ip, e))
+            return
         logging.debug('tsig keyring %s' % self.keyring)
 
 
     def __str__(self):
         return 'TSIGKeyRing %s %s' % (self.keyname, self.secret)
 
+
+class TSIGKeyTable(object):
+    """The TSIGKeyRing for each address or prefix in the [tsig] section.
+
+    Keyrings are built once and shared by every message from an address.
+    An exact address match wins, then the longest matching prefix (e.g.
+    192.0.2.0/24).
+
+    """
+
+    def __init__(self):
+        self.addresses = dict()
+        # {(family, prefix length): {network as int: TSIGKeyRing}}
+        self.prefixes = dict()
+        self.nokey = TSIGKeyRing('')
+
+        try:
+            items = config.items('tsig')
+        except ConfigParser.NoSectionError:
+            items = list()
+
+        for ip, value in items:
+            if '/' not in ip:
+                self.addresses[ip] = TSIGKeyRing(ip, value)
+                continue
+
+            try:
+                network, length = ip.split('/')
+                family, address = address_to_int(network)
+                length = int(length)
+            except (ValueError, socket.error), e:
+                logging.error('invalid tsig prefix %s: %s' % (ip, e))
+                continue
+
+            bits = family == socket.AF_INET and 32 or 128
+            network = address >> (bits - length)
+            self.prefixes.setdefault((family, length), dict())[network] = \
+                                                    TSIGKeyRing(ip, value)
+
+        # longest prefixes first
+        self.lengths = sorted(self.prefixes.keys(), key=lambda k: -k[1])
+
+    def lookup(self, ip):
+        """Return the TSIGKeyRing for ip. Its keyring is None if no key is
+        configured."""
+
+        try:
+            return self.addresses[ip]
+        except KeyError:
+            if not self.prefixes:
+                return self.nokey
+
+        try:
+            family, address = address_to_int(ip)
+        except socket.error:
+            return self.nokey
+
+        bits = family == socket.AF_INET and 32 or 128
+        for key in self.lengths:
+            if key[0] != family:
+                continue
+            try:
+                return self.prefixes[key][address >> (bits - key[1])]
+            except KeyError:
+                pass
+
+        return self.nokey
+
+
+def address_to_int(ip):
+    """Return (address family, address as an int) for an IP address."""
+
+    family = ':' in ip and socket.AF_INET6 or socket.AF_INET
+    return family, int(binascii.hexlify(socket.inet_pton(family, ip)), 16)
+
+
+_tsig_keys = None
+
+def tsig_keys():
+    """Return the TSIGKeyTable."""
+    if _tsig_keys is None:
+        build_tsig_keys()
+    return _tsig_keys
+
+def build_tsig_keys():
+    global _tsig_keys
+    _tsig_keys = TSIGKeyTable()
+    logging.debug('%d tsig addresses, %d tsig prefixes' % \
+                    (len(_tsig_keys.addresses),
+                     sum([len(p) for p in _tsig_keys.prefixes.values()])))
+
 #############################################################################
 
+def master_port():
+    """Return the port zones are transferred from."""
+
+    try:
+        return config.getint('xfr', 'master_port')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return 53
+
+
+class TransferIndex(object):
+    """Digests of the RRsets in a full zone transfer, for comparing it with
+    the hosted zone.
+
+    Only a digest of each RRset's name and type, and of its TTL and rdata,
+    is held in memory. The rdata is spooled to a temporary file and read
+    back for the RRsets that have to be created. An RRset's rdata digest is
+    the sum of the digests of its rdatas, so an RRset split across messages
+    adds up to the same digest as it would in one piece.
+
+    """
+
+    # TTL, rdata digest, spool offset and length of one piece of an RRset
+    _entry = struct.Struct('!I16sQI')
+
+    def __init__(self):
+        self.index = dict()
+        self.spool = tempfile.TemporaryFile()
+        self.offset = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    @staticmethod
+    def _key(name, rdtype):
+        return hashlib.md5('%s/%d' % (name.to_text().lower(),
+                                      rdtype)).digest()
+
+    @staticmethod
+    def digest(rrset):
+        total = 0
+        for rdata in rrset:
+            total += int(hashlib.md5(rdata.to_digestable()).hexdigest(), 16)
+        return total % (1 << 128)
+
+    def add(self, rrset):
+        data = '\n'.join(['%s %d' % (rrset.name, rrset.rdtype)] +
+                         [rdata.to_text() for rdata in rrset])
+        self.spool.seek(self.offset)
+        self.spool.write(data)
+        entry = self._entry.pack(rrset.ttl,
+                                 binascii.unhexlify('%032x' % \
+                                                    self.digest(rrset)),
+                                 self.offset, len(data))
+        self.offset += len(data)
+
+        key = self._key(rrset.name, rrset.rdtype)
+        self.index[key] = self.index.get(key, '') + entry
+
+    def pop(self, name, rdtype):
+        """Remove and return the entries for name/rdtype, or None."""
+
+        return self.index.pop(self._key(name, rdtype), None)
+
+    def matches(self, entries, rrset):
+        """Return True if the entries hold the same TTL and rdata as rrset."""
+
+        ttl = None
+        total = 0
+        for i in xrange(0, len(entries), self._entry.size):
+            piece_ttl, digest, offset, length = \
+                                    self._entry.unpack_from(entries, i)
+            if ttl is None:
+                ttl = piece_ttl
+            total += int(binascii.hexlify(digest), 16)
+        return ttl == rrset.ttl and \
+                    total % (1 << 128) == self.digest(rrset)
+
+    def rrset(self, entries):
+        """Read back the RRset for the entries from the spool."""
+
+        rrset = None
+        for i in xrange(0, len(entries), self._entry.size):
+            ttl, digest, offset, length = self._entry.unpack_from(entries, i)
+            self.spool.seek(offset)
+            lines = self.spool.read(length).split('\n')
+            name, rdtype = lines[0].split(' ')
+            piece = dns.rrset.from_text_list(dns.name.from_text(name), ttl,
+                                             dns.rdataclass.IN, int(rdtype),
+                                             lines[1:])
+            if rrset is None:
+                rrset = piece
+            else:
+                rrset.union_update(piece)
+        return rrset
+
+    def remaining(self):
+        """Yield the RRsets that are still in the index."""
+
+        for entries in self.index.itervalues():
+            yield self.rrset(entries)
+
+    def close(self):
+        self.spool.close()
+        self.index = dict()
+
+
 class XFRClient(object):
 
     def __init__(self, zonename):
@@ -562,6 +3081,14 @@ class XFRClient(object):
         self.doit = None
         self.rrsetcount = 0
         self.markers = 0
+        self.serials = 0
+        # the serial the hosted zone is known to be at
+        self.applied_serial = None
+
+        try:
+            self.condense = config.getboolean('xfr', 'condense')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            self.condense = False
 
         try:
             self.APIRequest = Route53HostedZoneRequest(self.zonename)
@@ -569,56 +3096,41 @@ class XFRClient(object):
             logging.debug('exception: %s' % e)
             raise
 
-        try:
-            self.zoneid = config.get('hostedzone',
-                                     zonename.to_text())
-        except ConfigParser.NoSectionError:
-            logging.error('no zoneid for %s' % zonename)
-            raise
-        except ConfigParser.NoOptionError:
-            try:
-                self.zoneid = config.get('hostedzone',
-                                         zonename.to_text(omit_final_dot=True))
-            except ConfigParser.NoOptionError:
-                logging.error('no zoneid for %s' % zonename)
-                raise
-        else:
-            logging.debug('found %s zoneid: %s' % (zonename, self.zoneid))
-
-        self.cnxn = boto.route53.Route53Connection()
-        # result is a boto.route53.record.ResourceRecordSets object
-        result = self.cnxn.get_all_rrsets(self.zoneid, type='SOA', maxitems=1,
-                                          name=zonename.to_text())
-        if len(result) != 1:
-            raise RuntimeError('uh-oh')
-
-        # rr is a boto.route53.record.Record object
-        rr = result[0]
-        if rr.type == 'SOA':
-            rrset = dns.rrset.from_text(zonename, rr.ttl,
-                                        dns.rdataclass.IN, dns.rdatatype.SOA,
-                                        str(rr.resource_records[0]))
+        self.zoneid = self.APIRequest.zoneid
+
+        store = self.APIRequest.store
+        serial = journal_serials.pop(zonename.to_text(), None)
+        found, rrset = False, None
+        if store is not None:
+            found, rrset = store.get(zonename, dns.rdatatype.SOA)
+            if found and rrset is None:
+                raise RuntimeError('no SOA for %s' % zonename)
+        if not found and serial is None:
+            rrset = self.get_soa()
+
+        if rrset is None:
+            logging.info('Journal serial for %s: %s' % (zonename, serial))
+            self.local_serial = serial
         else:
-            raise RuntimeError()
-
-        logging.info('API serial for %s: %s' % (zonename, rrset[0].serial))
-        self.local_serial = rrset[0].serial
+            logging.info('API serial for %s: %s' % (zonename, rrset[0].serial))
+            self.local_serial = rrset[0].serial
+        self.applied_serial = self.local_serial
 
         try:
-            self.masterip = config.get('slave',
-                                       self.zonename.to_text())
-        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            self.masterip = master_servers().zones[self.zonename]
+        except KeyError:
             # XXX
             logging.error('no master ip for %s' % self.zonename)
-            raise
+            raise ConfigParser.NoOptionError(self.zonename.to_text(), 'slave')
 
-        kr = TSIGKeyRing(self.masterip)
+        kr = tsig_keys().lookup(self.masterip)
 
         try:
             logging.debug('xfr %s %s %d' % (self.masterip, self.zonename,
                                             self.local_serial))
             # XXX Argh. xfr() requires a keyname
             self.msgs = dns.query.xfr(self.masterip, self.zonename,
+                            port=master_port(),
                             serial=self.local_serial, relativize=False,
                             rdtype=dns.rdatatype.IXFR,
                             keyring=kr.keyring, keyname=kr.keyname)
@@ -627,6 +3139,11 @@ class XFRClient(object):
             raise
 
 
+    def get_soa(self):
+        """Read the zone's SOA RRset from the API."""
+        return get_hosted_soa(self.zonename, self.zoneid)
+
+
     def parse_soa(self, rrset):
         assert type(rrset) is dns.rrset.RRset, 'rrset is RRset obj'
         assert rrset.rdtype == dns.rdatatype.SOA, 'rrset is not SOA RRset'
@@ -640,6 +3157,17 @@ class XFRClient(object):
             # start of deletion block
             self.doit = self.APIRequest.delete
             if rrset[0].serial != self.local_serial:
+                self.serials += 1
+
+            # Condensed transfers queue every serial's changes in the one
+            # request and submit the net difference at the end
+            if rrset[0].serial != self.local_serial and \
+                    (not self.condense or rrset[0].serial == self.remote_serial):
+                if self.condense:
+                    noops = self.APIRequest.cancel_noops()
+                    logging.info('%s: condensed %d serials, dropped %d no-op '
+                                 'pairs', self.zonename,
+                                 self.serials, noops)
                 try:
                     # XXX - save SOA to RR cache
                     self.APIRequest.submit(serial=rrset[0].serial)
@@ -653,6 +3181,7 @@ class XFRClient(object):
                     logging.error('XFR API call failed: %s' % e)
                     raise
                 else:
+                    self.applied_serial = rrset[0].serial
                     logging.debug('XFR stage, %s serial %d' % \
                                     (self.zonename, rrset[0].serial))
 
@@ -665,7 +3194,7 @@ class XFRClient(object):
     def parse_ixfr(self):
         try:
           for msg in self.msgs:
-            for rrset in msg.answer:
+            for position, rrset in enumerate(msg.answer):
                 self.rrsetcount += 1
                 logging.debug('RR %d: %s' % (self.rrsetcount, rrset))
 
@@ -676,11 +3205,19 @@ class XFRClient(object):
                     else:
                         self.remote_serial = rrset[0].serial
                         logging.debug('remote_serial: %d' % self.remote_serial)
+                        first_soa = rrset
                         continue
 
                 if self.rrsetcount == 2:
-                    if rrset[0].rdtype != dns.rdatatype.SOA or \
-                            rrset[0].serial != self.local_serial:
+                    if rrset[0].rdtype != dns.rdatatype.SOA:
+                        # the master sent the whole zone instead; use it
+                        logging.warn('AXFR-style IXFR response for %s' % \
+                                                                self.zonename)
+                        self.axfr(self._rest_of_transfer(first_soa, msg,
+                                                         position))
+                        return
+
+                    if rrset[0].serial != self.local_serial:
                         logging.error('protocol error: %s' % rrset)
                         return
 
@@ -719,10 +3256,903 @@ class XFRClient(object):
             logging.error('TSIG bad truncation from %s: %s' % (self.masterip, e))
             return
 
-        if self.rrsetcount == 1:
-            # XXX  remote_serial == local_serial means no update needed
-            logging.warn('one SOA rr - AXFR fallback')
+        if self.rrsetcount == 1:
+            if self.remote_serial == self.local_serial:
+                logging.info('%s serial %d is up to date' % \
+                                        (self.zonename, self.local_serial))
+                return
+
+            logging.warn('one SOA rr - AXFR fallback')
+            self.axfr()
+
+    def _rest_of_transfer(self, first_soa, msg, position):
+        """Yield the RRsets of an AXFR-style IXFR response from its first
+        SOA on, continuing from msg.answer[position]."""
+
+        yield first_soa
+        for rrset in msg.answer[position:]:
+            yield rrset
+        for msg in self.msgs:
+            for rrset in msg.answer:
+                yield rrset
+
+    def axfr(self, rrsets=None):
+        """Bring the hosted zone in line with a full transfer from the
+        master: the RRsets given, or a new AXFR.
+
+        The transfer is indexed by digest, then compared with a listing of
+        the hosted zone one page at a time. RRsets that differ are replaced,
+        RRsets missing from the transfer are deleted and those left over in
+        the index are created. Changes are submitted whenever a request's
+        worth has been queued, so neither side of the comparison is ever
+        held in full. The SOA goes in the last request. Route 53's apex NS
+        RRset, and alias and weighted RRsets, are left alone; a transferred
+        RRset with the same name and type as one of those is skipped, as
+        Route 53 won't hold both.
+
+        """
+
+        start = time.time()
+        index = TransferIndex()
+        try:
+            soa = self._index_axfr(index, rrsets)
+            if soa is None:
+                return
+            transferred = len(index) + 1
+
+            deleted = replaced = created = skipped = 0
+            current_soa = None
+            with route53_connection() as cnxn:
+                # Iterating the ResourceRecordSets object fetches the next
+                # page when the listing is truncated
+                for rr in cnxn.get_all_rrsets(self.zoneid):
+                    name = name_from_api(rr.name)
+                    rdtype = dns.rdatatype.from_text(rr.type)
+                    if rr.alias_dns_name or rr.identifier:
+                        if index.pop(name, rdtype) is not None:
+                            logging.warn('%s %s is an alias or weighted '
+                                         'RRset in the hosted zone, not '
+                                         'transferring it' % (name, rr.type))
+                            skipped += 1
+                        continue
+                    current = dns.rrset.from_text_list(name, int(rr.ttl),
+                                            dns.rdataclass.IN, rdtype,
+                                            [str(v) for v in
+                                             rr.resource_records])
+                    if name == self.zonename:
+                        if rdtype == dns.rdatatype.SOA:
+                            current_soa = current
+                            continue
+                        if rdtype == dns.rdatatype.NS:
+                            continue
+
+                    entries = index.pop(name, rdtype)
+                    if entries is None:
+                        self.APIRequest.replace(current, None)
+                        deleted += 1
+                    elif not index.matches(entries, current):
+                        self.APIRequest.replace(current,
+                                                index.rrset(entries))
+                        replaced += 1
+                    self._submit_full()
+
+            for rrset in index.remaining():
+                self.APIRequest.replace(None, rrset)
+                created += 1
+                self._submit_full()
+
+            self.APIRequest.replace(current_soa, soa)
+            self.APIRequest.submit(serial=soa[0].serial)
+            self.applied_serial = soa[0].serial
+        except boto.route53.exception.DNSServerError, e:
+            logging.error('AXFR API call failed: %s - %s' % (e.code, str(e)))
+            return
+        finally:
+            index.close()
+
+        logging.info('AXFR successful, %s serial %d: %d rrsets transferred, '
+                     '%d deleted, %d replaced, %d created, %d skipped in '
+                     '%.1fs', self.zonename, soa[0].serial, transferred,
+                     deleted, replaced, created, skipped, time.time() - start)
+
+    def _axfr_rrsets(self):
+        """Yield the RRsets of a new AXFR from the master."""
+
+        kr = tsig_keys().lookup(self.masterip)
+        msgs = dns.query.xfr(self.masterip, self.zonename,
+                             port=master_port(), relativize=False,
+                             rdtype=dns.rdatatype.AXFR,
+                             keyring=kr.keyring, keyname=kr.keyname)
+        for msg in msgs:
+            for rrset in msg.answer:
+                yield rrset
+
+    def _index_axfr(self, index, rrsets=None):
+        """Transfer the zone into the index and return its SOA RRset, or
+        None if the transfer failed. rrsets is a transfer that's already
+        under way; without it a new AXFR is made."""
+
+        if rrsets is None:
+            rrsets = self._axfr_rrsets()
+        soa = None
+        try:
+            for rrset in rrsets:
+                if rrset.name == self.zonename:
+                    if rrset.rdtype == dns.rdatatype.SOA:
+                        soa = rrset
+                        continue
+                    if rrset.rdtype == dns.rdatatype.NS:
+                        continue
+                index.add(rrset)
+        except (dns.exception.DNSException, socket.error), e:
+            logging.error('AXFR failed: %s %s' % (self.zonename, e))
+            return None
+
+        if soa is None:
+            logging.error('AXFR failed: %s no SOA' % self.zonename)
+        return soa
+
+    def _submit_full(self):
+        """Submit the queued changes once they fill a request."""
+
+        if self.APIRequest.rrcount >= MAX_RR_ELEMENTS or \
+                self.APIRequest.rrchars >= MAX_RR_CHARS:
+            self.APIRequest.submit()
+
+
+def get_hosted_soa(zonename, zoneid):
+    """Read a hosted zone's SOA RRset from the API."""
+
+    with route53_connection() as cnxn:
+        # result is a boto.route53.record.ResourceRecordSets object
+        result = cnxn.get_all_rrsets(zoneid, type='SOA', maxitems=1,
+                                     name=zonename.to_text())
+    if len(result) != 1:
+        raise RuntimeError('uh-oh')
+
+    # rr is a boto.route53.record.Record object
+    rr = result[0]
+    if rr.type == 'SOA':
+        return dns.rrset.from_text(zonename, rr.ttl,
+                                   dns.rdataclass.IN, dns.rdatatype.SOA,
+                                   str(rr.resource_records[0]))
+    else:
+        raise RuntimeError()
+
+
+def transfer_zone(zonename):
+    """Bring the hosted zone up to date with its master by IXFR. Return the
+    serial the hosted zone is then known to be at, or None."""
+
+    try:
+        xfr = XFRClient(zonename)
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        # handled in XFRClient
+        return None
+    except (dns.query.BadResponse, dns.query.UnexpectedSource):
+        # handled in XFRClient
+        return None
+    except Exception, e:
+        logging.error('XFRClient unhandled init exception: %s' % e)
+        return None
+
+    try:
+        xfr.parse_ixfr()
+    except Exception:
+        logging.exception('XFRClient unhandled parse exception')
+    return xfr.applied_serial
+
+#############################################################################
+
+class TransferScheduler(object):
+    """Run the zone transfers requested by NOTIFY messages.
+
+    Zone names arrive on a queue from the workers. At most `max_transfers'
+    transfers run at once, each in its own thread. A NOTIFY for a zone that
+    is already queued is dropped, and NOTIFYs for a zone that is being
+    transferred are collapsed into one follow-up transfer. The serial each
+    transfer leaves a hosted zone at is kept for the RefreshScheduler.
+
+    """
+
+    def __init__(self, queue, max_transfers):
+        self.queue = queue
+        self.max_transfers = max_transfers
+        self.lock = threading.Lock()
+        self.running = set()
+        self.waiting = OrderedDict()
+        self.followup = set()
+        self.serials = dict()
+
+    def run(self):
+        logging.debug('Starting transfer scheduler')
+        while True:
+            try:
+                zonename = dns.name.from_text(self.queue.get())
+            except (IOError, OSError), e:
+                # a signal interrupted the read
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+            self.request(zonename)
+
+    def request(self, zonename):
+        with self.lock:
+            if zonename in self.running:
+                logging.debug('%s: transfer running, will repeat' % zonename)
+                self.followup.add(zonename)
+                return
+            if zonename in self.waiting:
+                logging.debug('%s: transfer already queued' % zonename)
+                return
+            self.waiting[zonename] = None
+
+        self.start()
+
+    def start(self):
+        """Start waiting transfers while there are free slots."""
+
+        with self.lock:
+            while self.waiting and len(self.running) < self.max_transfers:
+                zonename, _ = self.waiting.popitem(last=False)
+                self.running.add(zonename)
+                thread = threading.Thread(target=self.transfer,
+                                          args=(zonename,))
+                thread.daemon = True
+                thread.start()
+
+            logging.debug('transfers running: %d waiting: %d' % \
+                                    (len(self.running), len(self.waiting)))
+
+    def transfer(self, zonename):
+        serial = None
+        try:
+            serial = transfer_zone(zonename)
+        finally:
+            with self.lock:
+                if serial is not None:
+                    self.serials[zonename] = serial
+                self.running.discard(zonename)
+                if zonename in self.followup:
+                    self.followup.discard(zonename)
+                    self.waiting[zonename] = None
+            self.start()
+
+
+class RefreshScheduler(object):
+    """Check the serial of every slaved zone on its master on the SOA's
+    refresh timer, and transfer the zones that have moved on.
+
+    Zones are kept in a heap ordered by when their next check is due. A
+    check is one SOA query over UDP, signed if the master has a TSIG key,
+    and all queries go out over one socket per address family with up to
+    `max_outstanding' in flight. A zone whose serial differs from the one
+    its hosted zone is known to be at is handed to the TransferScheduler.
+    After a check the zone is due again after the SOA's refresh interval,
+    or its retry interval if the master didn't answer. A zone whose master
+    hasn't answered for the expire interval is logged as expired.
+
+    Every interval gets up to 10% of random jitter, and the first checks
+    are spread over `spread' seconds, so checks don't bunch up.
+
+    """
+
+    def __init__(self, transfers, spread, timeout, max_outstanding,
+                 min_refresh, max_refresh):
+        self.transfers = transfers
+        self.spread = spread
+        self.timeout = timeout
+        self.max_outstanding = max_outstanding
+        self.min_refresh = min_refresh
+        self.max_refresh = max_refresh
+        self.heap = list()
+        # zonename: [refresh, retry, expire, last answer, expired]
+        self.timers = dict()
+        # (query id, master ip): (zonename, query, deadline)
+        self.outstanding = dict()
+        self.sockets = dict()
+        # set from the SIGHUP handler to pick up changes to [slave]
+        self.reloaded = True
+
+    def jitter(self, interval):
+        return interval * (1 + random.uniform(-0.1, 0.1))
+
+    def sync_zones(self):
+        """Start checking new slaved zones and forget removed ones."""
+
+        self.reloaded = False
+        zones = master_servers().zones
+        now = time.time()
+        for zonename in zones:
+            if zonename not in self.timers:
+                # refresh, retry and expire until the master's SOA is seen
+                self.timers[zonename] = [self.max_refresh, self.min_refresh,
+                                         None, now, False]
+                heapq.heappush(self.heap,
+                               (now + random.uniform(0, self.spread),
+                                zonename))
+        for zonename in self.timers.keys():
+            if zonename not in zones:
+                del self.timers[zonename]
+        logging.debug('refresh scheduler: %d zones' % len(self.timers))
+
+    def run(self):
+        logging.debug('Starting refresh scheduler')
+        while True:
+            try:
+                if self.reloaded:
+                    self.sync_zones()
+                self.send_due()
+                self.receive(self.wait())
+                self.expire_queries()
+            except Exception:
+                logging.exception('refresh scheduler')
+                time.sleep(1)
+
+    def wait(self):
+        """Return the seconds until a check falls due or a query times out,
+        at most 1."""
+
+        now = time.time()
+        timeout = 1.0
+        if self.heap and len(self.outstanding) < self.max_outstanding:
+            timeout = min(timeout, self.heap[0][0] - now)
+        for zonename, query, deadline in self.outstanding.itervalues():
+            timeout = min(timeout, deadline - now)
+        return max(0, timeout)
+
+    def send_due(self):
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now and \
+                    len(self.outstanding) < self.max_outstanding:
+            due, zonename = heapq.heappop(self.heap)
+            if zonename not in self.timers:
+                # no longer slaved
+                continue
+            try:
+                self.send(zonename)
+            except (socket.error, KeyError, dns.exception.DNSException), e:
+                logging.error('SOA check for %s failed: %s' % (zonename, e))
+                self.failed(zonename)
+
+    def socket(self, family):
+        try:
+            return self.sockets[family]
+        except KeyError:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(0)
+            self.sockets[family] = sock
+            return sock
+
+    def send(self, zonename):
+        masterip = master_servers().zones[zonename]
+        query = dns.message.make_query(zonename, dns.rdatatype.SOA)
+        query.flags &= ~dns.flags.RD
+        kr = tsig_keys().lookup(masterip)
+        if kr.keyring is not None:
+            query.use_tsig(kr.keyring, kr.keyname)
+
+        family = dns.inet.af_for_address(masterip)
+        self.socket(family).sendto(query.to_wire(),
+                                   (masterip, master_port()))
+        self.outstanding[(query.id, masterip)] = (zonename, query,
+                                                  time.time() + self.timeout)
+
+    def receive(self, timeout):
+        socks = self.sockets.values()
+        if not socks:
+            time.sleep(timeout)
+            return
+
+        try:
+            readable, _, _ = select.select(socks, [], [], timeout)
+        except select.error, e:
+            # a signal interrupted the wait
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+
+        for sock in readable:
+            while True:
+                try:
+                    wire, address = sock.recvfrom(65535)
+                except socket.error, e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                self.answer(wire, address[0])
+
+    def answer(self, wire, masterip):
+        if len(wire) < 2:
+            return
+        key = (struct.unpack('!H', wire[:2])[0], masterip)
+        if key not in self.outstanding:
+            return
+        zonename, query, deadline = self.outstanding[key]
+
+        try:
+            response = dns.message.from_wire(wire, keyring=query.keyring,
+                                             request_mac=query.mac)
+            if not query.is_response(response):
+                return
+            del self.outstanding[key]
+            soa = response.find_rrset(response.answer, zonename,
+                                      dns.rdataclass.IN, dns.rdatatype.SOA)
+        except (KeyError, dns.exception.DNSException), e:
+            logging.error('bad SOA answer for %s from %s: %s' % \
+                                                    (zonename, masterip, e))
+            self.outstanding.pop(key, None)
+            self.failed(zonename)
+            return
+
+        self.checked(zonename, soa[0])
+
+    def expire_queries(self):
+        now = time.time()
+        for key, (zonename, query, deadline) in self.outstanding.items():
+            if deadline <= now:
+                del self.outstanding[key]
+                logging.debug('SOA check for %s timed out', zonename)
+                self.failed(zonename)
+
+    def checked(self, zonename, soa):
+        timers = self.timers.get(zonename)
+        if timers is None:
+            return
+
+        clamp = lambda t: min(self.max_refresh, max(self.min_refresh, t))
+        timers[:] = [clamp(soa.refresh), clamp(soa.retry), soa.expire,
+                     time.time(), False]
+
+        with self.transfers.lock:
+            serial = self.transfers.serials.get(zonename)
+        if serial is None:
+            serial = journal_serials.get(zonename.to_text())
+        if serial is None:
+            serial = self.hosted_serial(zonename)
+
+        if serial == soa.serial:
+            logging.debug('%s serial %d is current' % (zonename, soa.serial))
+            metrics.inc('route53d_refresh_checks_total',
+                        (('result', 'current'),))
+        else:
+            logging.info('%s: master serial %d, hosted zone at %s, '
+                         'transferring', zonename, soa.serial, serial)
+            metrics.inc('route53d_refresh_checks_total',
+                        (('result', 'changed'),))
+            self.transfers.request(zonename)
+
+        heapq.heappush(self.heap, (time.time() + self.jitter(timers[0]),
+                                   zonename))
+
+    def hosted_serial(self, zonename):
+        """Return the serial of zonename's hosted zone when neither a
+        transfer nor the journal knows it, as after a restart. Read it from
+        the zone store if that's loaded, otherwise from the API once, and
+        keep it as if a transfer had left the zone there. Return None if it
+        can't be read."""
+
+        try:
+            apex, zoneid = hosted_zones().find(zonename)
+            found, rrset = False, None
+            store = zone_stores.get(zoneid)
+            if store is not None:
+                found, rrset = store.get(zonename, dns.rdatatype.SOA)
+            if not found:
+                rrset = get_hosted_soa(zonename, zoneid)
+        except Exception, e:
+            logging.error('cannot read the hosted SOA of %s: %s' % \
+                                                            (zonename, e))
+            return None
+        if rrset is None:
+            return None
+
+        with self.transfers.lock:
+            return self.transfers.serials.setdefault(zonename,
+                                                     rrset[0].serial)
+
+    def failed(self, zonename):
+        timers = self.timers.get(zonename)
+        if timers is None:
+            return
+
+        metrics.inc('route53d_refresh_checks_total', (('result', 'failed'),))
+        refresh, retry, expire, answered, expired = timers
+        if expire is not None and not expired and \
+                                    time.time() - answered > expire:
+            logging.error('%s expired, no answer from its master for %ds' % \
+                                            (zonename, time.time() - answered))
+            timers[4] = True
+
+        heapq.heappush(self.heap, (time.time() + self.jitter(retry),
+                                   zonename))
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+
+xfr_queue = None
+transfer_scheduler = None
+refresh_scheduler = None
+
+def xfr_scheduler():
+    """Transfer scheduler process."""
+
+    try:
+        max_transfers = config.getint('xfr', 'max_transfers')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        max_transfers = 4
+
+    close_listen_servers()
+    start_signal_threads()
+    start_metrics_reporter()
+    start_zone_refresher()
+
+    global transfer_scheduler
+    transfer_scheduler = TransferScheduler(xfr_queue, max_transfers)
+
+    try:
+        refresh = config.getboolean('xfr', 'refresh')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        refresh = True
+
+    if refresh:
+        global refresh_scheduler
+        refresh_scheduler = RefreshScheduler(transfer_scheduler,
+                                             *refresh_settings())
+        refresh_scheduler.start()
+
+    try:
+        transfer_scheduler.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def refresh_settings():
+    """Return the RefreshScheduler's spread, timeout, max_outstanding,
+    min_refresh and max_refresh from [xfr]."""
+
+    settings = list()
+    for option, default in (('refresh_spread', 60.0),
+                            ('refresh_timeout', 5.0),
+                            ('refresh_outstanding', 100),
+                            ('min_refresh', 60.0),
+                            ('max_refresh', 86400.0)):
+        try:
+            settings.append(type(default)(config.get('xfr', option)))
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            settings.append(default)
+    return settings
+
+#############################################################################
+
+class Journal(object):
+    """An append-only journal of submitted changes in a memory-mapped file.
+
+    Each record is a length and CRC32 followed by a JSON object: `submit'
+    for a change batch accepted by the API, with its zone and the serial it
+    brings the zone to, `insync' once the batch is INSYNC, `abandon' once
+    the poller gives up on it and `serial' for the last serial applied to a
+    zone. Only the parent process writes to it. A record torn by a crash fails its check and ends the replay.
+
+    When the file fills up it's compacted by writing the pending changes
+    and zone serials to a new file and renaming it over the old one.
+
+    """
+
+    MAGIC = 'R53J0001'
+    _record = struct.Struct('!II')
+
+    def __init__(self, path, size, sync=True):
+        self.path = path
+        self.size = size
+        self.sync = sync
+        self.pending = OrderedDict()
+        self.serials = dict()
+        self.offset = len(self.MAGIC)
+        self.map = None
+        self._open()
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            if os.fstat(fd).st_size < self.size:
+                os.ftruncate(fd, self.size)
+            self.map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+
+    def replay(self):
+        """Rebuild the pending changes and zone serials from the file."""
+
+        count = 0
+        if self.map[:len(self.MAGIC)] == self.MAGIC:
+            offset = len(self.MAGIC)
+            while offset + self._record.size <= len(self.map):
+                length, crc = self._record.unpack_from(self.map, offset)
+                if length == 0:
+                    break
+                start = offset + self._record.size
+                data = self.map[start:start + length]
+                if len(data) < length or \
+                        binascii.crc32(data) & 0xffffffff != crc:
+                    logging.warn('journal %s: ignoring torn record at %d' % \
+                                                        (self.path, offset))
+                    break
+                try:
+                    self._apply(json.loads(data))
+                except (ValueError, KeyError, TypeError), e:
+                    logging.warn('journal %s: bad record at %d: %s' % \
+                                                    (self.path, offset, e))
+                    break
+                count += 1
+                offset = start + length
+        elif self.map[:len(self.MAGIC)].strip('\0'):
+            logging.error('journal %s: bad header, starting afresh' % \
+                                                                self.path)
+
+        logging.info('journal %s: replayed %d records, %d changes pending, '
+                     '%d zone serials', self.path, count, len(self.pending),
+                     len(self.serials))
+        self.compact()
+
+    def _apply(self, record):
+        kind = record['t']
+        if kind == 'submit':
+            self.pending[record['id']] = record
+            if record.get('serial') is not None:
+                self.serials[record['zone']] = record['serial']
+        elif kind in ('insync', 'abandon'):
+            self.pending.pop(record['id'], None)
+        elif kind == 'serial':
+            self.serials[record['zone']] = record['serial']
+
+    def _encode(self, record):
+        data = json.dumps(record, separators=(',', ':'), sort_keys=True)
+        return self._record.pack(len(data),
+                                 binascii.crc32(data) & 0xffffffff) + data
+
+    def submitted(self, change_id, submitted, zone, serial):
+        record = {'t': 'submit', 'id': change_id, 'at': submitted,
+                  'zone': zone}
+        if serial is not None:
+            record['serial'] = serial
+        self.append(record)
+
+    def insync(self, change_id):
+        self.append({'t': 'insync', 'id': change_id})
+
+    def abandoned(self, change_id):
+        self.append({'t': 'abandon', 'id': change_id})
+
+    def append(self, record):
+        self._apply(record)
+        data = self._encode(record)
+        if self.offset + len(data) > len(self.map):
+            # the state now includes this record
+            self.compact()
+            return
+
+        start = self.offset
+        self.map[start:start + len(data)] = data
+        self.offset += len(data)
+        if self.sync:
+            page = start - start % mmap.PAGESIZE
+            self.map.flush(page, self.offset - page)
+
+    def compact(self):
+        """Replace the file with one holding just the current state."""
+
+        # serials last, so an older pending submit can't wind one back
+        records = list(self.pending.values())
+        records.extend({'t': 'serial', 'zone': zone, 'serial': serial}
+                       for zone, serial in sorted(self.serials.items()))
+        data = self.MAGIC + ''.join(self._encode(r) for r in records)
+
+        # leave room for at least as much again before the next compaction
+        size = self.size
+        while size < 2 * len(data):
+            size *= 2
+
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(data)
+            f.truncate(size)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        self.map.close()
+        self._open()
+        self.offset = len(data)
+        logging.debug('journal %s: compacted to %d records, %d bytes' % \
+                                        (self.path, len(records), len(data)))
+
+
+journal = None
+
+# zone serials replayed from the journal, used once in place of the API's
+journal_serials = dict()
+
+def open_journal():
+    """Open and replay the change journal, if one is configured."""
+
+    try:
+        path = config.get('journal', 'path')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return None
+
+    try:
+        size = config.getint('journal', 'size')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        size = 1048576
+
+    try:
+        sync = config.getboolean('journal', 'sync')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        sync = True
+
+    # whole pages, so the file can be mapped and flushed by page
+    size = max(mmap.PAGESIZE, size - size % mmap.PAGESIZE)
+    j = Journal(path, size, sync)
+    j.replay()
+    return j
+
+#############################################################################
+
+class ChangePoller(object):
+    """Poll the API for submitted changes until they're INSYNC.
+
+    Pending changes are kept in a heap ordered by the time they're next due
+    to be polled. Each change is first polled `interval' seconds after it
+    arrives and the wait doubles after every PENDING answer, up to
+    `max_interval'. Up to `concurrency' changes are polled at once, each as
+    soon as a pool thread is free, so a slow poll holds up no other. A
+    change whose poll fails `max_failures' times running is given up on.
+
+    Changes are written to the journal, if there is one, as they arrive and
+    as they go INSYNC. Changes still pending in the journal are polled again
+    at startup.
+
+    """
+
+    def __init__(self, queue, concurrency, interval, max_interval,
+                 journal=None, max_failures=10):
+        self.queue = queue
+        self.journal = journal
+        self.concurrency = concurrency
+        self.interval = interval
+        self.max_interval = max_interval
+        self.max_failures = max_failures
+        self.heap = list()
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.pool = ThreadPool(concurrency)
+        self.insync = 0
+        self.insync_seconds = 0.0
+
+        if journal is not None:
+            now = time.time()
+            for change_id, record in journal.pending.items():
+                logging.info('ChangeID: %s resumed from journal' % change_id)
+                heapq.heappush(self.heap, (now, str(change_id),
+                                           self.interval, record['at'], 0))
+
+    def run(self):
+        logging.debug('Starting status poller')
+        while True:
+            self.receive()
+
+            with self.lock:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now and \
+                                        self.inflight < self.concurrency:
+                    item = heapq.heappop(self.heap)
+                    self.inflight += 1
+                    self.pool.apply_async(self.poll, (item,),
+                            callback=lambda status, item=item: \
+                                                    self.polled(item, status))
+                metrics.set('route53d_poller_pending',
+                            len(self.heap) + self.inflight)
+
+    def receive(self):
+        """Move newly submitted changes from the queue to the heap,
+        waiting no longer than it takes for the next change to fall due."""
+
+        with self.lock:
+            if self.heap and self.inflight < self.concurrency:
+                timeout = max(0, self.heap[0][0] - time.time())
+            else:
+                # a finished poll wakes us when the pool is full
+                timeout = 1
+
+        try:
+            item = self.queue.get(timeout=timeout)
+            while True:
+                if item is not None:
+                    change_id, submitted, zone, serial = item
+                    with self.lock:
+                        if self.journal is not None:
+                            self.journal.submitted(change_id, submitted, zone,
+                                                   serial)
+                        heapq.heappush(self.heap, (submitted + self.interval,
+                                                   change_id, self.interval,
+                                                   submitted, 0))
+                item = self.queue.get_nowait()
+        except Empty:
+            pass
+        except (IOError, OSError), e:
+            # a signal interrupted the read
+            if e.errno != errno.EINTR:
+                raise
+
+    def poll(self, item):
+        """Return the status of a change or None on error. Called in a pool
+        thread."""
+
+        next_poll, change_id, interval, submitted, failures = item
+        try:
+            with route53_connection() as cnxn:
+                result = cnxn.get_change(change_id)
+            logging.debug(result)
+            info = result.get('GetChangeResponse').get('ChangeInfo')
+            return info.get('Status')
+        except Exception, e:
+            logging.error('ChangeID: %s poll failed: %s' % (change_id, e))
+            return None
+
+    def polled(self, item, status):
+        """Record a poll's result and wake the main loop. Called in the
+        pool's result thread."""
+
+        with self.lock:
+            self.inflight -= 1
+            self.done(item, status)
+        self.queue.put(None)
+
+    def done(self, item, status):
+        next_poll, change_id, interval, submitted, failures = item
+
+        if status == 'INSYNC':
+            elapsed = time.time() - submitted
+            self.insync += 1
+            self.insync_seconds += elapsed
+            metrics.observe('route53d_change_insync_seconds', elapsed,
+                            buckets=INSYNC_BUCKETS)
+            logging.info('ChangeID: %s Status: INSYNC after %.1fs' % \
+                                                    (change_id, elapsed))
+            if self.journal is not None:
+                self.journal.insync(change_id)
+            return
+
+        if status is None:
+            failures += 1
+            if failures >= self.max_failures:
+                logging.error('ChangeID: %s giving up after %d failed polls' \
+                                                    % (change_id, failures))
+                metrics.inc('route53d_poller_abandoned_total')
+                if self.journal is not None:
+                    self.journal.abandoned(change_id)
+                return
+        else:
+            logging.info('ChangeID: %s Status: %s' % (change_id, status))
+            failures = 0
 
+        interval = min(interval * 2, self.max_interval)
+        heapq.heappush(self.heap, (time.time() + interval, change_id,
+                                   interval, submitted, failures))
+        logging.debug('%d changes pending' % len(self.heap))
 
 #############################################################################
 
@@ -791,6 +4221,12 @@ def _get_section(self, section, count):
             secret = self.message.keyring.get(absolute_name)
             if secret is None:
                 raise dns.message.UnknownTSIGKey("key '%s' unknown" % name)
+            # make_response() needs these to sign the reply
+            self.message.keyname = absolute_name
+            (self.message.keyalgorithm, self.message.mac) = \
+                    dns.tsig.get_algorithm_and_mac(self.wire, self.current,
+                                                   rdlen)
+            start = spans.enabled and time.time()
             self.message.tsig_ctx = \
                                   dns.tsig.validate(self.wire,
                                       absolute_name,
@@ -803,6 +4239,8 @@ def _get_section(self, section, count):
                                       self.message.tsig_ctx,
                                       self.message.multi,
                                       self.message.first)
+            if start:
+                spans.record('tsig', start)
             self.message.had_tsig = True
         else:
             if ttl < 0:
@@ -840,9 +4278,330 @@ def _get_section(self, section, count):
 dns.message._WireReader._get_section = _get_section
 
 
+class FallBack(Exception):
+    """Let dnspython parse this message."""
+
+
+_header = struct.Struct('!HHHHHH')
+_question = struct.Struct('!HH')
+_rr = struct.Struct('!HHIH')
+_preference = struct.Struct('!H')
+
+def _name_from_wire(wire, current, limit=None):
+    """Return (name, end) for the name at current, which must lie before
+    limit. Only plain labels and backward compression pointers are
+    handled."""
+
+    if limit is None:
+        limit = len(wire)
+
+    labels = list()
+    biggest_pointer = current
+    end = None
+    while True:
+        if current >= limit:
+            raise FallBack()
+        count = ord(wire[current])
+        current += 1
+        if count == 0:
+            break
+        if count < 64:
+            if current + count > limit:
+                raise FallBack()
+            labels.append(wire[current:current + count])
+            current += count
+        elif count >= 192:
+            if current >= limit:
+                raise FallBack()
+            pointer = ((count & 0x3f) << 8) + ord(wire[current])
+            if end is None:
+                end = current + 1
+            if pointer >= biggest_pointer:
+                raise FallBack()
+            biggest_pointer = current = pointer
+        else:
+            raise FallBack()
+
+    labels.append('')
+    if end is None:
+        end = current
+    return dns.name.Name(labels), end
+
+
+def _rdata_from_wire(rdclass, rdtype, wire, current, rdlen):
+    """Decode the common rdata types directly and the rest with dnspython."""
+
+    end = current + rdlen
+    if rdclass == dns.rdataclass.IN:
+        if rdtype == dns.rdatatype.A and rdlen == 4:
+            return dns.rdtypes.IN.A.A(rdclass, rdtype,
+                                dns.ipv4.inet_ntoa(wire[current:end]))
+        if rdtype == dns.rdatatype.AAAA and rdlen == 16:
+            return dns.rdtypes.IN.AAAA.AAAA(rdclass, rdtype,
+                                dns.ipv6.inet_ntoa(wire[current:end]))
+
+    if rdtype in _target_types:
+        target, used = _name_from_wire(wire, current, end)
+        if used != end:
+            raise FallBack()
+        return _target_types[rdtype](rdclass, rdtype, target)
+
+    if rdtype == dns.rdatatype.MX and rdlen > 2:
+        preference, = _preference.unpack_from(wire, current)
+        exchange, used = _name_from_wire(wire, current + 2, end)
+        if used != end:
+            raise FallBack()
+        return dns.rdtypes.ANY.MX.MX(rdclass, rdtype, preference, exchange)
+
+    if rdtype == dns.rdatatype.TXT and rdlen > 0:
+        strings = list()
+        while current < end:
+            count = ord(wire[current])
+            current += 1
+            if current + count > end:
+                raise FallBack()
+            strings.append(wire[current:current + count])
+            current += count
+        return dns.rdtypes.ANY.TXT.TXT(rdclass, rdtype, strings)
+
+    return dns.rdata.from_wire(rdclass, rdtype, wire, current, rdlen)
+
+_target_types = {
+    dns.rdatatype.CNAME: dns.rdtypes.ANY.CNAME.CNAME,
+    dns.rdatatype.NS: dns.rdtypes.ANY.NS.NS,
+    dns.rdatatype.PTR: dns.rdtypes.ANY.PTR.PTR,
+}
+
+
+def _update_from_wire(wire, keyring):
+    """Decode an UPDATE message. Return the message and the position of its
+    TSIG record, if any, as (name, start, rdata start, rdlen).
+
+    struct.Struct.unpack_from() reads the header fields in place, without
+    slicing the datagram. Anything out of the ordinary raises FallBack.
+
+    """
+
+    (id, flags, qcount, ancount, aucount, adcount) = \
+                                            _header.unpack_from(wire, 0)
+    if qcount != 1:
+        raise FallBack()
+
+    message = dns.message.Message(id=id)
+    message.flags = flags
+    message.keyring = keyring
+
+    zname, current = _name_from_wire(wire, 12)
+    zrdtype, zone_rdclass = _question.unpack_from(wire, current)
+    current += 4
+    message.find_rrset(message.question, zname, zone_rdclass, zrdtype,
+                       create=True, force_unique=True)
+
+    tsig = None
+    for section, count in ((message.answer, ancount),
+                           (message.authority, aucount),
+                           (message.additional, adcount)):
+        for i in xrange(count):
+            rr_start = current
+            name, current = _name_from_wire(wire, current)
+            rdtype, rdclass, ttl, rdlen = _rr.unpack_from(wire, current)
+            current += 10
+
+            if rdtype == dns.rdatatype.TSIG:
+                if section is not message.additional or i != count - 1:
+                    raise FallBack()
+                tsig = (name, rr_start, current, rdlen)
+            elif rdtype == dns.rdatatype.OPT or rdlen == 0:
+                raise FallBack()
+            else:
+                if rdclass == dns.rdataclass.ANY or \
+                                    rdclass == dns.rdataclass.NONE:
+                    deleting = rdclass
+                    rdclass = zone_rdclass
+                else:
+                    deleting = None
+
+                rd = _rdata_from_wire(rdclass, rdtype, wire, current, rdlen)
+                if deleting == dns.rdataclass.ANY or \
+                   (deleting == dns.rdataclass.NONE and
+                    section is message.answer):
+                    covers = dns.rdatatype.NONE
+                else:
+                    covers = rd.covers()
+
+                rrset = message.find_rrset(section, name, rdclass, rdtype,
+                                           covers, deleting, True, True)
+                rrset.add(rd, ttl)
+
+            current += rdlen
+
+    if current != len(wire):
+        raise FallBack()
+
+    return message, tsig
+
+
+def update_from_wire(wire, keyring):
+    """Parse an UPDATE message like dns.message.from_wire() does, only
+    faster. Messages the fast decoder doesn't handle, including every
+    malformed one, are handed to dnspython so that the errors raised are
+    the same."""
+
+    try:
+        message, tsig = _update_from_wire(wire, keyring)
+    except Exception:
+        return dns.message.from_wire(wire, keyring=keyring)
+
+    if tsig is not None:
+        name, rr_start, current, rdlen = tsig
+        if keyring is None:
+            raise dns.message.UnknownTSIGKey('got signed message without '
+                                             'keyring')
+        secret = keyring.get(name)
+        if secret is None:
+            raise dns.message.UnknownTSIGKey("key '%s' unknown" % name)
+        # WireData turns reads past the end into FormError, as in dnspython
+        wire = dns.wiredata.maybe_wrap(wire)
+        message.keyname = name
+        (message.keyalgorithm, message.mac) = \
+                    dns.tsig.get_algorithm_and_mac(wire, current, rdlen)
+        start = spans.enabled and time.time()
+        message.tsig_ctx = dns.tsig.validate(wire, name, secret,
+                                             int(time.time()),
+                                             message.request_mac, rr_start,
+                                             current, rdlen,
+                                             message.tsig_ctx, message.multi,
+                                             message.first)
+        if start:
+            spans.record('tsig', start)
+        message.had_tsig = True
+
+    return message
+
+
+# Set from [server] fast_parser
+fast_parser = True
+
+def setup_parser():
+    """Use the fast UPDATE parser unless [server] fast_parser is off."""
+
+    global fast_parser
+    try:
+        fast_parser = config.getboolean('server', 'fast_parser')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        fast_parser = True
+
+
+def message_from_wire(wire, keyring):
+    """Parse a DNS message, taking the fast path for UPDATEs."""
+
+    if fast_parser and len(wire) >= 12 and \
+            (ord(wire[2]) >> 3) & 0xf == dns.opcode.UPDATE:
+        return update_from_wire(wire, keyring)
+    return dns.message.from_wire(wire, keyring=keyring)
+
+
+# Set by SIGUSR1, cleared by its signal thread
+packets_requested = threading.Event()
+
+def sigusr1_handler(signum, frame):
+    """SIGUSR1 handler. Have a signal thread log the packets handled by
+    each worker."""
+    packets_requested.set()
+
+
+def log_packet_counts():
+    """Log the packets handled by each worker."""
+    if packet_counts is not None:
+        logging.info('packets per worker: %s' % \
+                        ' '.join([str(n) for n in packet_counts]))
+
+
+# Set by SIGUSR2, cleared by its signal thread
+profile_requested = threading.Event()
+
+def sigusr2_handler(signum, frame):
+    """SIGUSR2 handler. Have a signal thread start the profiler."""
+    profile_requested.set()
+
+
+# The running profiler, if any
+profiler = None
+
+def start_profiler():
+    """Sample every thread's stack in this process for [profile] seconds.
+    The parent passes SIGUSR2 on to every child; signal a worker directly
+    to profile just that one."""
+
+    global profiler
+
+    if multiprocessing.current_process().name == 'MainProcess':
+        for child in multiprocessing.active_children():
+            try:
+                os.kill(child.pid, signal.SIGUSR2)
+            except OSError, e:
+                logging.error('cannot signal %d: %s' % (child.pid, e))
+
+    if profiler is not None and profiler.is_alive():
+        logging.info('Caught SIGUSR2. Already profiling')
+        return
+
+    profiler = SamplingProfiler(*profile_settings())
+    profiler.start()
+
+
+# Set by SIGHUP, cleared by its signal thread
+reload_requested = threading.Event()
+
 def sighup_handler(signum, frame):
-    """SIGHUP handler. Catch and ignore."""
-    logging.info('Caught SIGHUP. Ignoring.')
+    """SIGHUP handler. Leave the reload to a signal thread: parsing the
+    config, rebuilding the indexes and logging all take locks the
+    interrupted code may hold."""
+    reload_requested.set()
+
+
+def reload_and_signal_children():
+    """Reload the config, then pass SIGHUP on to the child processes."""
+
+    logging.info('Caught SIGHUP. Reloading %s' % config_file)
+    try:
+        reload_config()
+    except Exception, e:
+        logging.error('reload failed: %s' % e)
+
+    for child in multiprocessing.active_children():
+        try:
+            os.kill(child.pid, signal.SIGHUP)
+        except OSError, e:
+            logging.error('cannot signal %d: %s' % (child.pid, e))
+
+
+def start_signal_thread(name, event, action):
+    """Run action in a thread of its own each time a signal handler sets
+    event."""
+
+    def run():
+        while True:
+            event.wait()
+            event.clear()
+            try:
+                action()
+            except Exception:
+                logging.exception(name)
+
+    thread = threading.Thread(target=run, name=name)
+    thread.daemon = True
+    thread.start()
+
+
+def start_signal_threads():
+    """Start the threads that do the work the signal handlers ask for.
+    Call once per process, after forking."""
+
+    start_signal_thread('reloader', reload_requested,
+                        reload_and_signal_children)
+    start_signal_thread('packet counts', packets_requested, log_packet_counts)
+    start_signal_thread('profiler', profile_requested, start_profiler)
 
 
 def sigterm_handler(signum, frame):
@@ -856,6 +4615,8 @@ def sig_handlers():
     """Install signal handlers."""
     signal.signal(signal.SIGHUP,  sighup_handler)
     signal.signal(signal.SIGTERM, sigterm_handler)
+    signal.signal(signal.SIGUSR1, sigusr1_handler)
+    signal.signal(signal.SIGUSR2, sigusr2_handler)
 
 
 def parse_args():
@@ -867,8 +4628,13 @@ def parse_args():
                       help='Path to configuration file. default: route53d.ini')
     parser.add_option('--debug', action='store_true', dest='debug',
                       help='Print debugging output.')
+    parser.add_option('--engine', type='choice', dest='engine',
+                      choices=('fork', 'async'),
+                      help='fork: serve from `processes\' worker processes. '
+                           'async: serve from one process with an event '
+                           'loop and a thread pool. default: fork')
 
-    parser.set_defaults(debug=False, config='route53d.ini')
+    parser.set_defaults(debug=False, config='route53d.ini', engine='fork')
 
     (opt, args) = parser.parse_args()
 
@@ -916,8 +4682,8 @@ def drop_privs():
         sys.exit(1)
 
 
-def bind_socket():
-    """Create a SocketServer.UDPServer instance."""
+def listen_address():
+    """Read the IP address and port to listen on from the config."""
 
     try:
         ip   = config.get('server', 'listen_ip')
@@ -928,9 +4694,19 @@ def bind_socket():
         sys.exit(1)
     else:
         logging.debug('ip: %s port: %d' % (ip, port))
+        return ip, port
+
+
+def bind_socket(reuseport=False):
+    """Create a SocketServer.UDPServer instance."""
+
+    ip, port = listen_address()
 
     try:
-        server = SocketServer.UDPServer((ip, port), UDPDNSHandler)
+        if reuseport:
+            server = ReusePortUDPServer((ip, port), UDPDNSHandler)
+        else:
+            server = SocketServer.UDPServer((ip, port), UDPDNSHandler)
     except Exception, e:
         logging.error('Cannot bind socket: %s' % e)
         logging.shutdown()
@@ -940,14 +4716,93 @@ def bind_socket():
         return server
 
 
+def bind_sockets(count):
+    """Return a list of count UDP servers, one per worker.
+
+    By default every worker shares one socket. With reuseport set each
+    worker gets a socket of its own bound with SO_REUSEPORT.
+
+    """
+
+    try:
+        reuseport = config.getint('server', 'reuseport')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        reuseport = False
+
+    if not reuseport:
+        return [bind_socket()] * count
+
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        logging.error('SO_REUSEPORT is not supported on this platform')
+        logging.shutdown()
+        sys.exit(1)
+
+    return [bind_socket(reuseport=True) for i in range(count)]
+
+
+# Every bound DNS server, so each process can close the sockets it doesn't
+# serve
+listen_servers = []
+
+def close_listen_servers(keep=None):
+    """Close the inherited listening sockets other than keep's. Otherwise
+    a worker's SO_REUSEPORT socket outlives it in the other processes and
+    the kernel keeps handing it datagrams nobody reads."""
+
+    for server in listen_servers:
+        if server is not keep:
+            server.socket.close()
+
+
+def bind_tcp_socket():
+    """Create a TCPDNSServer instance if TCP is enabled in the config."""
+
+    try:
+        if not config.getint('server', 'tcp'):
+            return None
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return None
+
+    ip, port = listen_address()
+
+    try:
+        idle_timeout = config.getint('server', 'tcp_idle_timeout')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        idle_timeout = 30
+
+    try:
+        max_connections = config.getint('server', 'tcp_max_connections')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        max_connections = 100
+
+    try:
+        server = TCPDNSServer((ip, port), TCPDNSHandler, idle_timeout,
+                              max_connections)
+    except Exception, e:
+        logging.error('Cannot bind TCP socket: %s' % e)
+        logging.shutdown()
+        sys.exit(1)
+    else:
+        logging.debug('tcp server: %s' % server)
+        return server
+
+
+# The config file, held open from startup. It is usually readable by root
+# only, and reloads run after the privileges are dropped. Every process
+# shares its file offset, so seek and read it under the lock.
+config_fp = None
+config_fp_lock = multiprocessing.Lock()
+
 def parse_config(filename):
     """Parse the config file into the `config' global variable."""
 
-    global config
+    global config, config_file, config_fp
+    config_file = filename
     config = ConfigParser.SafeConfigParser()
 
     try:
-        config.readfp(open(filename))
+        config_fp = open(filename)
+        config.readfp(config_fp)
     except Exception, e:
         print('error parsing %s config file: %s' % (filename, e))
         sys.stdout.flush()
@@ -955,20 +4810,355 @@ def parse_config(filename):
         sys.exit(1)
 
 
+def diff_dicts(old, new):
+    """Return sorted lists of the keys added to, removed from and changed
+    between two dicts."""
+
+    added = sorted([k for k in new if k not in old])
+    removed = sorted([k for k in old if k not in new])
+    changed = sorted([k for k in new if k in old and old[k] != new[k]])
+    return added, removed, changed
+
+
+def config_sections(cfg):
+    """Return {section: {option: value}} for the sections of cfg."""
+
+    return dict([(section, dict(cfg.items(section, raw=True)))
+                    for section in cfg.sections()])
+
+
+def read_config_file():
+    """Return the text of the config file. Reopen it by path if we still
+    can, so a file an editor replaced is picked up. Otherwise reread the
+    file opened at startup."""
+
+    try:
+        fp = open(config_file)
+    except IOError, e:
+        if e.errno != errno.EACCES or config_fp is None:
+            raise
+    else:
+        try:
+            return fp.read()
+        finally:
+            fp.close()
+
+    try:
+        replaced = os.stat(config_file).st_ino != \
+                        os.fstat(config_fp.fileno()).st_ino
+    except OSError:
+        replaced = False
+    if replaced:
+        raise IOError(errno.EACCES, '%s was replaced since startup and is '
+                      'not readable after dropping privileges. Edit it in '
+                      'place or restart' % config_file)
+
+    with config_fp_lock:
+        config_fp.seek(0)
+        return config_fp.read()
+
+
+def reload_config():
+    """Reparse the config file and swap in the new zone indexes, TSIG keys
+    and tunables. Caches, zone stores and API connections are kept for
+    zones that are still configured. Log what changed."""
+
+    global config
+
+    new = ConfigParser.SafeConfigParser()
+    try:
+        new.readfp(StringIO(read_config_file()), config_file)
+    except Exception, e:
+        logging.error('error parsing %s, keeping the current config: %s' % \
+                                                        (config_file, e))
+        return
+
+    old_sections = config_sections(config)
+    old_zones = hosted_zones().zones
+    old_masters = master_servers().zones
+
+    config = new
+    build_zone_indexes()
+    build_tsig_keys()
+
+    # only the parent reports the changes; the workers all reload too
+    if multiprocessing.current_process().name == 'MainProcess':
+        report = logging.info
+    else:
+        report = logging.debug
+
+    for what, old, diff in (('zone', old_zones, hosted_zones().zones),
+                            ('master', old_masters, master_servers().zones)):
+        added, removed, changed = diff_dicts(old, diff)
+        for verb, names in (('added', added), ('removed', removed),
+                            ('changed', changed)):
+            if names:
+                report('reload: %s %s: %s' % (what, verb,
+                            ', '.join([n.to_text() for n in names])))
+
+    new_sections = config_sections(config)
+    for section in sorted(set(old_sections.keys() + new_sections.keys())):
+        if section in ('hostedzone', 'slave'):
+            continue
+        added, removed, changed = diff_dicts(old_sections.get(section, {}),
+                                             new_sections.get(section, {}))
+        for verb, options in (('added', added), ('removed', removed),
+                              ('changed', changed)):
+            if options:
+                report('reload: [%s] %s: %s' % (section, verb,
+                                                ', '.join(options)))
+        if section == 'server' and (added or removed or changed):
+            report('reload: listen address, processes, tcp and async '
+                   'settings take effect on restart')
+
+    # Drop the state of zones that are no longer configured
+    zoneids = set(hosted_zones().zones.values())
+    for zoneid in rrset_caches.keys():
+        if zoneid not in zoneids:
+            del rrset_caches[zoneid]
+    for zoneid in zone_stores.keys():
+        if zoneid not in zoneids:
+            del zone_stores[zoneid]
+
+    # and load the zones added since startup where they're used
+    if multiprocessing.current_process().name != 'MainProcess':
+        preload_zones()
+
+    # Apply the new tunables to the long-lived objects while requests go
+    # on: a shrunk cache is trimmed on its next put() and a raised transfer
+    # limit is used on the next request.
+    size, ttl = cache_settings()
+    for cache in rrset_caches.values():
+        cache.size, cache.ttl = size, ttl
+
+    if api_pool is not None:
+        try:
+            api_pool.idle_timeout = config.getint('server',
+                                                  'api_idle_timeout')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            api_pool.idle_timeout = 50
+
+    setup_coalescer()
+    setup_spans()
+    setup_parser()
+
+    settings = rate_settings()
+    if rate_limiter is not None and settings is not None:
+        rate_limiter.configure(settings)
+    elif (rate_limiter is None) != (settings is None):
+        logging.warn('turning the API rate limit on or off needs a restart')
+
+    if change_poller is not None:
+        try:
+            change_poller.interval = config.getfloat('poller', 'interval')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            change_poller.interval = 2.0
+        try:
+            change_poller.max_interval = config.getfloat('poller',
+                                                         'max_interval')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            change_poller.max_interval = 30.0
+        try:
+            change_poller.max_failures = config.getint('poller',
+                                                       'max_failures')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            change_poller.max_failures = 10
+
+    if transfer_scheduler is not None:
+        try:
+            transfer_scheduler.max_transfers = config.getint('xfr',
+                                                         'max_transfers')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            transfer_scheduler.max_transfers = 4
+
+    if refresh_scheduler is not None:
+        (refresh_scheduler.spread, refresh_scheduler.timeout,
+         refresh_scheduler.max_outstanding, refresh_scheduler.min_refresh,
+         refresh_scheduler.max_refresh) = refresh_settings()
+        refresh_scheduler.reloaded = True
+
+    logging.debug('reload complete')
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def __init__(self, debug=False):
+        logging.Formatter.__init__(self)
+        self.debug = debug
+
+    def format(self, record):
+        entry = {'time': round(record.created, 6),
+                 'pid': record.process,
+                 'level': record.levelname,
+                 'msg': record.getMessage()}
+        if self.debug:
+            entry['file'] = record.filename
+            entry['line'] = record.lineno
+            entry['func'] = record.funcName
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, separators=(',', ':'))
+
+
+class QueueHandler(logging.Handler):
+    """Hand log records to the log writer process.
+
+    The message is rendered here, since the arguments may not pickle, but
+    the final formatting and the write to the stream happen in the writer.
+    A record is dropped rather than block the caller when the queue is full.
+
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.owner = os.getpid()
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging._defaultFormatter.formatException(
+                                                            record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def close(self):
+        # only the process that started the writer stops it
+        if os.getpid() == self.owner:
+            try:
+                self.queue.put(None, timeout=1)
+            except Full:
+                pass
+        logging.Handler.close(self)
+
+
+def log_writer(queue, handler):
+    """Log writer process. Write the records from the workers until the
+    parent goes away."""
+
+    # The parent tells us when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+    parent = os.getppid()
+    while True:
+        try:
+            record = queue.get(timeout=1)
+        except Empty:
+            if os.getppid() != parent:
+                break
+            continue
+        except (IOError, OSError), e:
+            if e.errno != errno.EINTR:
+                raise
+            continue
+
+        if record is None:
+            break
+        handler.handle(record)
+
+    handler.flush()
+
+
 def setup_logging(debug):
-    """Configure logging module parameters."""
+    """Configure logging module parameters.
+
+    [logging] format selects text or json lines, and [logging] queue moves
+    the formatting and writing to a log writer process."""
 
     datefmt='%Y-%m-%d %H:%M.%S %Z'
     if debug:
-        logging.basicConfig(level=logging.DEBUG, datefmt=datefmt,
-            format='%(asctime)s - %(process)d - %(levelname)s - ' \
-                   '%(filename)s:%(lineno)d %(funcName)s - %(message)s')
+        level = logging.DEBUG
+        fmt = '%(asctime)s - %(process)d - %(levelname)s - ' \
+              '%(filename)s:%(lineno)d %(funcName)s - %(message)s'
+    else:
+        level = logging.INFO
+        fmt = '%(asctime)s - %(process)d - %(levelname)s - %(message)s'
+
+    try:
+        style = config.get('logging', 'format')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        style = 'text'
+
+    try:
+        use_queue = config.getboolean('logging', 'queue')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        use_queue = False
+
+    try:
+        queue_size = config.getint('logging', 'queue_size')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        queue_size = 10000
+
+    handler = logging.StreamHandler()
+    if style == 'json':
+        handler.setFormatter(JSONFormatter(debug))
+    else:
+        handler.setFormatter(logging.Formatter(fmt, datefmt))
+
+    if use_queue:
+        log_queue = Queue(queue_size)
+        Process(target=log_writer, args=(log_queue, handler)).start()
+        handler = QueueHandler(log_queue)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+
+
+# CPUs in a cpu_set_t
+CPU_SETSIZE = 1024
+
+def set_cpu_affinity(cpu):
+    """Pin this process to one CPU. Linux only."""
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sched_setaffinity = libc.sched_setaffinity
+    except (OSError, AttributeError), e:
+        logging.error('cannot set CPU affinity: %s' % e)
+        return
+
+    if not 0 <= cpu < CPU_SETSIZE:
+        logging.error('config error: cpu_affinity CPU %d is not between 0 '
+                      'and %d' % (cpu, CPU_SETSIZE - 1))
+        return
+
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (CPU_SETSIZE / bits))()
+    mask[cpu / bits] = 1 << (cpu % bits)
+
+    if sched_setaffinity(0, ctypes.sizeof(mask), mask) != 0:
+        logging.error('cannot pin worker to CPU %d: %s' % \
+                            (cpu, os.strerror(ctypes.get_errno())))
     else:
-        logging.basicConfig(level=logging.INFO, datefmt=datefmt,
-            format='%(asctime)s - %(process)d - %(levelname)s - %(message)s')
+        logging.debug('pinned to CPU %d' % cpu)
 
 
-def worker(server):
+# Count of packets handled by each worker process, shared with the parent.
+# The async and TCP engines count from several threads.
+packet_counts = None
+packet_count_lock = threading.Lock()
+worker_id = None
+
+def worker(server, index=0):
     """Worker loop.
 
     Jumping to a signal handler can yield harmless select.error exceptions.
@@ -976,7 +5166,25 @@ def worker(server):
 
     """
 
-    logging.debug('Starting worker')
+    global worker_id
+    worker_id = index
+
+    close_listen_servers(getattr(server, 'server', server))
+    start_signal_threads()
+
+    try:
+        cpus = [int(c) for c in config.get('server', 'cpu_affinity').split(',')]
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+    except ValueError, e:
+        logging.error('invalid cpu_affinity: %s' % e)
+    else:
+        set_cpu_affinity(cpus[index % len(cpus)])
+
+    start_metrics_reporter()
+    start_zone_refresher()
+
+    logging.debug('Starting worker %d' % index)
     while True:
         try:
             server.serve_forever()
@@ -995,42 +5203,38 @@ def worker(server):
     return 0
 
 
+change_poller = None
+
 def status_poller():
     """Take change IDs from the global queue and poll the API for them until
        they're INSYNC
 
     """
 
-    logging.debug('Starting status poller')
-    cnxn = boto.route53.Route53Connection()
+    try:
+        concurrency = config.getint('poller', 'concurrency')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        concurrency = 10
 
-    while True:
-        try:
-            change_id = q.get_nowait()
-        except Empty:
-            logging.debug('queue is empty')
-        else:
-            # XXX catch exceptions!
-            result = cnxn.get_change(change_id)
-            logging.debug(result)
+    try:
+        interval = config.getfloat('poller', 'interval')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        interval = 2.0
 
-            try:
-                info = result.get('GetChangeResponse').get('ChangeInfo')
-            except KeyError:
-                # XXX need to parse error response
-                logging.error('invalid response: %s' % result)
-                raise
-            else:
-                status = info.get('Status')
-                logging.info('ChangeID: %s Status: %s' % (change_id, status))
-                if status == 'PENDING':
-                    try:
-                        q.put(change_id)
-                    except Full:
-                        logging.warn('status poller queue full, '
-                                     'discarding change %s' % change_id)
-        finally:
-            time.sleep(2)
+    try:
+        max_interval = config.getfloat('poller', 'max_interval')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        max_interval = 30.0
+
+    try:
+        max_failures = config.getint('poller', 'max_failures')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        max_failures = 10
+
+    global change_poller
+    change_poller = ChangePoller(q, concurrency, interval, max_interval,
+                                 journal, max_failures)
+    change_poller.run()
 
 
 def main():
@@ -1040,20 +5244,86 @@ def main():
     parse_config(opt.config)
     setup_logging(opt.debug)
     logging.info('Starting')
+    build_zone_indexes()
     sig_handlers()
-    server = bind_socket()
+    try:
+        processes = config.getint('server','processes')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError), e:
+        logging.error('config error: %s' % e)
+        return 1
+
+    if opt.engine == 'async':
+        processes = 1
+
+    servers = bind_sockets(processes)
+    tcp_server = bind_tcp_socket()
+    listen_servers.extend(set(servers))
+    if tcp_server is not None:
+        listen_servers.append(tcp_server)
+    metrics_server = bind_metrics_server()
     drop_privs()
+    preload_zones()
+    setup_coalescer()
+    setup_spans()
+    setup_parser()
+    setup_rate_limiter()
+    setup_change_feed()
 
     global q
     q = Queue()
 
+    # replayed before the XFR scheduler starts, so it inherits the serials
+    global journal
+    journal = open_journal()
+    if journal is not None:
+        journal_serials.update(journal.serials)
+
+    global metrics_queue
+    if metrics_server is not None:
+        metrics_queue = Queue(1000)
+
+    global xfr_queue
+    xfr_queue = Queue()
+    Process(target=xfr_scheduler).start()
+
+    # one slot per UDP worker plus one for the TCP process
+    global packet_counts
+    packet_counts = Array('L', processes + 1, lock=False)
+
     # Fire up worker processes
-    try:
-        for i in range(config.getint('server','processes')):
-            Process(target=worker, args=(server,)).start()
-    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError), e:
-        logging.error('config error: %s' % e)
-        return 1
+    if opt.engine == 'async':
+        try:
+            threads = config.getint('server', 'async_threads')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            threads = 64
+
+        try:
+            max_pending = config.getint('server', 'async_max_pending')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            max_pending = 1000
+
+        server = AsyncDNSServer(servers[0], threads, max_pending)
+        Process(target=worker, args=(server, 0)).start()
+    else:
+        for i, server in enumerate(servers):
+            Process(target=worker, args=(server, i)).start()
+
+    # TCP connections are served by threads in a process of their own
+    if tcp_server is not None:
+        Process(target=worker, args=(tcp_server, processes)).start()
+
+    # the parent serves none of them
+    close_listen_servers()
+
+    # The zones were preloaded here so that one listing serves every child.
+    # Nothing keeps the parent's copies up to date, so free them.
+    zone_stores.clear()
+
+    # the metrics threads start once every child is forked, so none of them
+    # inherits a lock held by one of those threads
+    if metrics_server is not None:
+        start_metrics_server(metrics_server)
+    start_signal_threads()
 
     # Parent polls for pending changes
     try:
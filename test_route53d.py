@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+"""Tests for route53d. Run with: python -m unittest test_route53d"""
+
+import ConfigParser
+import os
+import pwd
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from cStringIO import StringIO
+from multiprocessing import Process, Queue
+
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+import dns.tsigkeyring
+import dns.update
+
+import route53d
+
+
+def configure(text):
+    """Make text the daemon's config."""
+
+    route53d.config = ConfigParser.SafeConfigParser()
+    route53d.config.readfp(StringIO(text))
+    route53d.build_zone_indexes()
+    route53d.build_tsig_keys()
+
+
+def rrset(name, ttl, rdtype, *values):
+    return dns.rrset.from_text(name, ttl, 'IN', rdtype, *values)
+
+
+def name(text):
+    return dns.name.from_text(text)
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def reopen(self, journal):
+        journal.map.close()
+        journal = route53d.Journal(self.path, 4096, sync=False)
+        journal.replay()
+        return journal
+
+    def test_replay_after_compact_keeps_latest_serial(self):
+        j = route53d.Journal(self.path, 4096, sync=False)
+        j.replay()
+        # every other change stays pending, and enough of them to compact
+        for serial in range(1, 301):
+            j.submitted('C%d' % serial, 0.0, 'example.com.', serial)
+            if serial % 2 == 0:
+                j.insync('C%d' % serial)
+        self.assertEqual(j.serials['example.com.'], 300)
+
+        j.compact()
+        j = self.reopen(j)
+        self.assertEqual(j.serials['example.com.'], 300)
+        self.assertEqual(len(j.pending), 150)
+        self.assertEqual(j.pending.keys()[-1], 'C299')
+
+        # and again, replaying a file that replay() itself compacted
+        j = self.reopen(j)
+        self.assertEqual(j.serials['example.com.'], 300)
+        self.assertEqual(len(j.pending), 150)
+        j.map.close()
+
+    def test_replay_stops_at_torn_record(self):
+        j = route53d.Journal(self.path, 4096, sync=False)
+        j.replay()
+        j.submitted('C1', 0.0, 'example.com.', 1)
+        offset = j.offset
+        j.submitted('C2', 0.0, 'example.com.', 2)
+        j.map[offset + 10] = chr(ord(j.map[offset + 10]) ^ 0xff)
+
+        j = self.reopen(j)
+        self.assertEqual(j.pending.keys(), ['C1'])
+        self.assertEqual(j.serials['example.com.'], 1)
+        j.map.close()
+
+
+class ChangeFeedTest(unittest.TestCase):
+
+    def publish(self, feed, count, start=0):
+        """Publish count changes from another process."""
+
+        def run():
+            for i in range(start, start + count):
+                name = dns.name.from_text('n%d.example.com.' % i)
+                rrset = dns.rrset.from_text(name, 300, 'IN', 'A',
+                                            '192.0.2.%d' % (i % 256))
+                feed.publish('Z1', name, dns.rdatatype.A, rrset)
+        p = Process(target=run)
+        p.start()
+        p.join()
+
+    def test_read_wraps_around_ring(self):
+        feed = route53d.ChangeFeed(1024)
+        for start in range(0, 40, 8):
+            self.publish(feed, 8, start)
+            records = feed.read()
+            self.assertEqual([r['n'] for r in records],
+                             ['n%d.example.com.' % i
+                              for i in range(start, start + 8)])
+            self.assertEqual(records[-1]['r'],
+                             ['192.0.2.%d' % (start + 7)])
+        self.assertEqual(feed.read(), [])
+
+    def test_skips_own_records(self):
+        feed = route53d.ChangeFeed(1024)
+        name = dns.name.from_text('www.example.com.')
+        feed.publish('Z1', name, dns.rdatatype.A, None, known=False)
+        self.assertEqual(feed.read(), [])
+
+    def test_falling_behind_is_reported(self):
+        feed = route53d.ChangeFeed(1024)
+        self.publish(feed, 40)
+        self.assertEqual(feed.read(), None)
+        self.publish(feed, 1)
+        self.assertEqual(len(feed.read()), 1)
+
+
+class ReloadConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.chmod(self.directory, 0755)
+        self.path = os.path.join(self.directory, 'route53d.ini')
+        self.write('[hostedzone]\nexample.com = Z1\n')
+        os.chmod(self.path, 0600)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, text):
+        f = open(self.path, 'w')
+        f.write(text)
+        f.close()
+
+    @unittest.skipUnless(os.getuid() == 0, 'needs root to drop privileges')
+    def test_reload_after_dropping_privileges(self):
+        route53d.parse_config(self.path)
+        self.write('[hostedzone]\nexample.com = Z1\nexample.org = Z2\n')
+        user = pwd.getpwnam('nobody')
+        zones = Queue()
+
+        def run():
+            os.setgid(user.pw_gid)
+            os.setgroups([user.pw_gid])
+            os.setuid(user.pw_uid)
+            self.assertRaises(IOError, open, self.path)
+            route53d.reload_config()
+            zones.put(sorted(route53d.hosted_zones().zones.values()))
+        p = Process(target=run)
+        p.start()
+        p.join()
+        self.assertEqual(zones.get(timeout=5), ['Z1', 'Z2'])
+        route53d.config_fp.close()
+
+
+class HostedZoneRequestTest(unittest.TestCase):
+
+    def setUp(self):
+        configure('[hostedzone]\nexample.com = Z1\n')
+        self.request = route53d.Route53HostedZoneRequest(name('example.com.'))
+        # the zone is empty, as far as the tests are concerned
+        self.request.get_record_set = lambda qname, qtype: None
+
+    def changes(self, request):
+        return [(action, str(change.name), change.type,
+                 sorted(str(v) for v in change.resource_records))
+                for action, change in request.r.changes]
+
+    def test_cancel_noops_drops_pairs_that_change_nothing(self):
+        same = rrset('a.example.com.', 300, 'A', '192.0.2.1')
+        self.request.replace(same, same.copy())
+        self.request.replace(rrset('b.example.com.', 300, 'A', '192.0.2.2'),
+                             rrset('b.example.com.', 600, 'A', '192.0.2.2'))
+        self.request.replace(rrset('c.example.com.', 300, 'A', '192.0.2.3'),
+                             rrset('c.example.com.', 300, 'A', '192.0.2.4'))
+
+        self.assertEqual(self.request.cancel_noops(), 1)
+        self.assertEqual([(a, n) for a, n, t, v in
+                          self.changes(self.request)],
+                         [('DELETE', 'b.example.com.'),
+                          ('CREATE', 'b.example.com.'),
+                          ('DELETE', 'c.example.com.'),
+                          ('CREATE', 'c.example.com.')])
+        self.assertEqual(self.request.rrcount, 4)
+        self.assertEqual(self.request.rrchars, 4 * len('192.0.2.2'))
+
+    def test_split_keeps_rrsets_whole_and_the_soa_last(self):
+        self.request.replace(
+            rrset('example.com.', 900, 'SOA', 'ns. host. 1 2 3 4 5'),
+            rrset('example.com.', 900, 'SOA', 'ns. host. 2 2 3 4 5'))
+        for i in range(300):
+            owner = 'h%d.example.com.' % i
+            self.request.replace(rrset(owner, 300, 'A', '10.0.0.1', '10.0.0.2'),
+                                 rrset(owner, 300, 'A', '10.0.1.1', '10.0.1.2'))
+
+        batches = self.request._split()
+        self.assertEqual(len(batches), 2)
+        seen = set()
+        for batch in batches:
+            keys = set((c.name, c.type) for a, c in batch.changes)
+            self.assertFalse(keys & seen)
+            seen |= keys
+            self.assertTrue(sum(len(c.resource_records)
+                                for a, c in batch.changes) <= 1000)
+        self.assertEqual([c.type for a, c in batches[-1].changes][-2:],
+                         ['SOA', 'SOA'])
+        self.assertEqual(len(seen), 301)
+
+    def test_split_stays_under_the_character_limit(self):
+        text = '"%s"' % ('x' * 250)
+        for i in range(80):
+            self.request.replace(None, rrset('t%d.example.com.' % i, 300,
+                                             'TXT', text))
+        self.assertTrue(self.request.rrchars > 20000)
+        route53d.MAX_RR_CHARS, limit = 5000, route53d.MAX_RR_CHARS
+        try:
+            batches = self.request._split()
+        finally:
+            route53d.MAX_RR_CHARS = limit
+
+        self.assertEqual(sum(len(b.changes) for b in batches), 80)
+        for batch in batches:
+            self.assertTrue(sum(len(str(v)) for a, c in batch.changes
+                                for v in c.resource_records) <= 5000)
+
+
+class UpdateCoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+        configure('[hostedzone]\nexample.com = Z1\n')
+        self.coalescer = route53d.UpdateCoalescer(60, 1000)
+        self.request = route53d.Route53HostedZoneRequest(name('example.com.'))
+        self.request.get_record_set = lambda qname, qtype: None
+        self.replies = list()
+
+    def tearDown(self):
+        for batch in self.coalescer.batches.values():
+            batch.timer.cancel()
+
+    def add(self, changes):
+        self.coalescer.add(self.request, changes, self.replies.append)
+
+    def test_failing_message_leaves_the_batch_unchanged(self):
+        self.add([('add', rrset('a.example.com.', 300, 'CNAME', 'x.'))])
+        batch = self.coalescer.batches['Z1']
+        state = (self.request.checkpoint(), batch.changes,
+                 len(batch.messages))
+
+        # the add is applied before the delete of a missing RRset fails
+        self.add([('add', rrset('b.example.com.', 300, 'CNAME', 'y.')),
+                  ('delete', rrset('c.example.com.', 900, 'A',
+                                   '192.0.2.1'))])
+
+        self.assertEqual(self.replies, [dns.rcode.NXRRSET])
+        self.assertEqual([(a, str(c.name)) for a, c in self.request.r.changes],
+                         [('CREATE', 'a.example.com.')])
+        self.assertEqual(self.request.checkpoint()[1:],
+                         state[0][1:])
+        self.assertEqual((batch.changes, len(batch.messages)), state[1:])
+        self.assertEqual(len(self.request.updates), 1)
+
+
+class ZoneIndexTest(unittest.TestCase):
+
+    def test_closest_enclosing_zone_wins(self):
+        configure('[hostedzone]\nexample.com = Z1\nsub.example.com. = Z2\n')
+        zones = route53d.hosted_zones()
+        self.assertEqual(zones.find(name('www.sub.example.com.')),
+                         (name('sub.example.com.'), 'Z2'))
+        self.assertEqual(zones.find(name('WWW.Example.COM.')),
+                         (name('example.com.'), 'Z1'))
+        self.assertEqual(zones.find(name('sub.example.com.'))[1], 'Z2')
+        self.assertEqual(zones.find(name('xsub.example.com.'))[1], 'Z1')
+        self.assertRaises(KeyError, zones.find, name('example.org.'))
+
+
+class TSIGKeyTableTest(unittest.TestCase):
+
+    def setUp(self):
+        configure('[tsig]\n'
+                  '192.0.2.1 = exact. MTIzNDU2Nzg5MDEyMzQ1Ng==\n'
+                  '192.0.2.0/24 = net24. MTIzNDU2Nzg5MDEyMzQ1Ng==\n'
+                  '192.0.0.0/16 = net16. MTIzNDU2Nzg5MDEyMzQ1Ng==\n')
+        self.table = route53d.tsig_keys()
+
+    def test_exact_address_beats_prefixes(self):
+        self.assertEqual(self.table.lookup('192.0.2.1').keyname, 'exact.')
+
+    def test_longest_prefix_wins(self):
+        self.assertEqual(self.table.lookup('192.0.2.2').keyname, 'net24.')
+        self.assertEqual(self.table.lookup('192.0.3.1').keyname, 'net16.')
+
+    def test_no_match_has_no_keyring(self):
+        for ip in ('198.51.100.1', '2001:db8::1', 'not an address'):
+            self.assertEqual(self.table.lookup(ip).keyring, None)
+
+
+class UpdateParserTest(unittest.TestCase):
+
+    keyring = dns.tsigkeyring.from_text({'k.': 'MTIzNDU2Nzg5MDEyMzQ1Ng=='})
+
+    def updates(self):
+        u = dns.update.Update('example.com.')
+        u.add('a', 300, 'A', '192.0.2.1', '192.0.2.2')
+        u.add('b', 60, 'AAAA', '2001:db8::1')
+        u.add('c', 60, 'CNAME', 'a')
+        u.add('d', 60, 'MX', '10 mx.example.com.')
+        u.add('e', 60, 'TXT', '"hello world" "x"')
+        yield u
+        u = dns.update.Update('example.com.')
+        u.present('z', 'A', '192.0.2.1')
+        u.delete('c', 'A', '192.0.2.1')
+        yield u
+        u = dns.update.Update('example.com.')
+        u.present('x')
+        u.absent('y', 'AAAA')
+        u.delete('a')
+        u.delete('b', 'A')
+        yield u
+        u = dns.update.Update('example.com.', keyring=self.keyring,
+                              keyname='k.')
+        u.add('a', 300, 'A', '192.0.2.1')
+        yield u
+
+    def parse(self, parser, wire):
+        try:
+            return self.parsed(parser(wire))
+        except Exception, e:
+            return type(e), str(e)
+
+    def parsed(self, message):
+        return (message.id, message.flags, message.to_text(),
+                [(r.name, r.rdtype, r.rdclass, r.deleting, r.ttl,
+                  sorted(r.to_text().split('\n')))
+                 for section in (message.question, message.answer,
+                                 message.authority)
+                 for r in section],
+                message.had_tsig, message.keyname)
+
+    def test_same_as_dnspython(self):
+        fast = lambda wire: route53d.update_from_wire(wire, self.keyring)
+        slow = lambda wire: dns.message.from_wire(wire, keyring=self.keyring)
+        for u in self.updates():
+            wire = u.to_wire()
+            self.assertEqual(self.parse(fast, wire), self.parse(slow, wire))
+
+    def test_fast_path_decodes_prerequisites_and_deletes_with_rdata(self):
+        wire = list(self.updates())[1].to_wire()
+        message, tsig = route53d._update_from_wire(wire, None)
+        self.assertEqual(tsig, None)
+        self.assertEqual(self.parsed(message),
+                         self.parsed(dns.message.from_wire(wire)))
+        self.assertEqual(message.authority[0].deleting,
+                         dns.rdataclass.NONE)
+
+    def test_malformed_message_raises_like_dnspython(self):
+        wire = list(self.updates())[0].to_wire()[:-3]
+        self.assertRaises(dns.exception.FormError,
+                          route53d.update_from_wire, wire, None)
+
+
+class ErrorResponseTest(unittest.TestCase):
+
+    def test_header_and_question(self):
+        query = dns.update.Update('example.com.')
+        query.add('a', 300, 'A', '192.0.2.1')
+        wire = query.to_wire()
+        reply = route53d.error_response(wire, dns.rcode.NOTAUTH)
+
+        expected = dns.message.make_response(
+                        dns.message.from_wire(wire, question_only=True))
+        expected.set_rcode(dns.rcode.NOTAUTH)
+        self.assertEqual(reply, expected.to_wire())
+
+        message = dns.message.from_wire(reply)
+        self.assertEqual(message.id, query.id)
+        self.assertEqual(message.opcode(), dns.opcode.UPDATE)
+        self.assertEqual(message.rcode(), dns.rcode.NOTAUTH)
+        self.assertTrue(message.flags & dns.flags.QR)
+        self.assertEqual(len(message.authority), 0)
+
+    def test_keeps_only_rd(self):
+        query = dns.message.make_query('www.example.com.', 'A')
+        query.flags |= dns.flags.AD | dns.flags.CD | dns.flags.RD
+        message = dns.message.from_wire(
+                    route53d.error_response(query.to_wire(),
+                                            dns.rcode.SERVFAIL))
+        self.assertEqual(message.flags & ~0xf,
+                         dns.flags.QR | dns.flags.RD)
+        self.assertEqual(message.rcode(), dns.rcode.SERVFAIL)
+
+    def test_gives_up_on_odd_questions(self):
+        query = dns.message.make_query('www.example.com.', 'A').to_wire()
+        self.assertEqual(route53d.error_response(query[:11], 1), None)
+        self.assertEqual(route53d.error_response(query[:20], 1), None)
+        pointer = query[:12] + '\xc0\x0c' + query[-4:]
+        self.assertEqual(route53d.error_response(pointer, 1), None)
+
+
+class ZoneStoreTest(unittest.TestCase):
+
+    zone = name('example.com.')
+
+    def setUp(self):
+        self.store = route53d.ZoneStore('Z1')
+        for r in (rrset('example.com.', 900, 'SOA',
+                        'ns. host. 1 3600 600 86400 300'),
+                  rrset('www.example.com.', 300, 'A', '192.0.2.1'),
+                  rrset('alias.example.com.', 300, 'CNAME',
+                        'www.example.com.'),
+                  rrset('out.example.com.', 300, 'CNAME', 'www.example.net.'),
+                  rrset('a.b.example.com.', 300, 'A', '192.0.2.2'),
+                  rrset('*.wild.example.com.', 300, 'TXT', '"wild"'),
+                  rrset('sub.example.com.', 300, 'NS', 'ns.sub.example.com.')):
+            self.store.snapshot.add(r.name, r.rdtype, r)
+        self.store.snapshot.add(name('elb.example.com.'), dns.rdatatype.A,
+                                None)
+        self.store.loaded = time.time()
+
+    def resolve(self, qname, rdtype):
+        return self.store.resolve(self.zone, name(qname),
+                                  dns.rdatatype.from_text(rdtype))
+
+    def test_nxdomain(self):
+        rcode, aa, answer, authority = self.resolve('nope.example.com.', 'A')
+        self.assertEqual((rcode, aa, answer), (dns.rcode.NXDOMAIN, True, []))
+        self.assertEqual(authority[0].rdtype, dns.rdatatype.SOA)
+        # the negative TTL is the SOA minimum
+        self.assertEqual(authority[0].ttl, 300)
+
+    def test_nodata(self):
+        for qname, rdtype in (('www.example.com.', 'AAAA'),
+                              ('b.example.com.', 'A')):
+            rcode, aa, answer, authority = self.resolve(qname, rdtype)
+            self.assertEqual((rcode, answer), (dns.rcode.NOERROR, []))
+            self.assertEqual(authority[0].rdtype, dns.rdatatype.SOA)
+
+    def test_cname_is_followed_inside_the_zone(self):
+        rcode, aa, answer, authority = self.resolve('alias.example.com.', 'A')
+        self.assertEqual(rcode, dns.rcode.NOERROR)
+        self.assertEqual([r.rdtype for r in answer],
+                         [dns.rdatatype.CNAME, dns.rdatatype.A])
+        self.assertEqual(answer[1].name, name('www.example.com.'))
+
+        rcode, aa, answer, authority = self.resolve('out.example.com.', 'A')
+        self.assertEqual([r.rdtype for r in answer], [dns.rdatatype.CNAME])
+
+        rcode, aa, answer, authority = self.resolve('alias.example.com.',
+                                                    'CNAME')
+        self.assertEqual(len(answer), 1)
+
+    def test_wildcard_and_delegation(self):
+        rcode, aa, answer, authority = self.resolve('x.wild.example.com.',
+                                                    'TXT')
+        self.assertEqual(answer[0].name, name('x.wild.example.com.'))
+        rcode, aa, answer, authority = self.resolve('h.sub.example.com.', 'A')
+        self.assertEqual((rcode, aa, answer), (dns.rcode.NOERROR, False, []))
+        self.assertEqual(authority[0].rdtype, dns.rdatatype.NS)
+
+    def test_alias_and_forgotten_rrsets_are_passed_through(self):
+        self.assertEqual(self.resolve('elb.example.com.', 'A'), None)
+        self.store.forget(name('www.example.com.'), dns.rdatatype.A)
+        self.assertEqual(self.resolve('www.example.com.', 'A'), None)
+        self.assertEqual(self.store.get(name('www.example.com.'),
+                                        dns.rdatatype.A), (False, None))
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        settings = dict((bucket, (0, 1)) for bucket in
+                        route53d.RateLimiter.BUCKETS)
+        settings['write'] = (10, 2)
+        self.limiter = route53d.RateLimiter(settings)
+
+    def take(self):
+        with self.limiter.lock:
+            return self.limiter._take('write', 0)
+
+    def test_refills_at_rate_up_to_burst(self):
+        self.assertEqual(self.take(), 0)
+        self.assertEqual(self.take(), 0)
+        wait = self.take()
+        self.assertTrue(0.05 < wait <= 0.1, wait)
+
+        # half a second later the bucket is full again, but no fuller
+        base = 1 + route53d.RateLimiter._fields * \
+                        route53d.RateLimiter.BUCKETS.index('write')
+        self.limiter.shared[base + 1] -= 0.5
+        self.assertEqual(self.take(), 0)
+        self.assertEqual(self.take(), 0)
+        self.assertTrue(self.take() > 0)
+
+    def test_unlimited_bucket_never_waits(self):
+        with self.limiter.lock:
+            for i in range(100):
+                self.assertEqual(self.limiter._take('read', 0), 0)
+
+
+class FakeTransfers(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.serials = dict()
+        self.requested = list()
+
+    def request(self, zonename):
+        self.requested.append(zonename)
+
+
+class RefreshSchedulerTest(unittest.TestCase):
+
+    zone = name('example.com.')
+
+    def setUp(self):
+        configure('[hostedzone]\nexample.com = Z1\n'
+                  '[slave]\nexample.com = 192.0.2.53\n')
+        self.transfers = FakeTransfers()
+        self.scheduler = route53d.RefreshScheduler(self.transfers, 10, 2,
+                                                   100, 60, 3600)
+        self.scheduler.sync_zones()
+
+    def tearDown(self):
+        route53d.zone_stores.clear()
+
+    def soa(self, serial, refresh=1800, retry=300):
+        return rrset('example.com.', 900, 'SOA', 'ns. host. %d %d %d 86400 '
+                     '300' % (serial, refresh, retry))[0]
+
+    def test_first_checks_spread_out(self):
+        due, zonename = self.scheduler.heap[0]
+        self.assertEqual(zonename, self.zone)
+        self.assertTrue(0 <= due - time.time() <= 10)
+
+    def test_intervals_are_clamped(self):
+        self.transfers.serials[self.zone] = 5
+        self.scheduler.heap = list()
+        self.scheduler.checked(self.zone, self.soa(5, refresh=10, retry=5))
+        self.assertEqual(self.scheduler.timers[self.zone][:2], [60, 60])
+        due, zonename = self.scheduler.heap[0]
+        self.assertTrue(54 <= due - time.time() <= 66)
+
+        self.scheduler.checked(self.zone, self.soa(5, refresh=86400))
+        self.assertEqual(self.scheduler.timers[self.zone][0], 3600)
+        self.assertEqual(self.transfers.requested, [])
+
+    def test_transfers_only_when_the_serial_moved(self):
+        self.transfers.serials[self.zone] = 5
+        self.scheduler.checked(self.zone, self.soa(6))
+        self.assertEqual(self.transfers.requested, [self.zone])
+
+    def test_unknown_serial_is_read_from_the_zone_store(self):
+        store = route53d.ZoneStore('Z1')
+        soa = rrset('example.com.', 900, 'SOA',
+                    'ns. host. 7 1800 300 86400 300')
+        store.snapshot.add(soa.name, soa.rdtype, soa)
+        store.loaded = time.time()
+        route53d.zone_stores['Z1'] = store
+
+        self.scheduler.checked(self.zone, self.soa(7))
+        self.assertEqual(self.transfers.requested, [])
+        self.assertEqual(self.transfers.serials[self.zone], 7)
+        self.scheduler.checked(self.zone, self.soa(8))
+        self.assertEqual(self.transfers.requested, [self.zone])
+
+
+if __name__ == '__main__':
+    unittest.main()